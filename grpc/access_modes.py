@@ -0,0 +1,51 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import csi_pb2
+
+Mode = csi_pb2.VolumeCapability.AccessMode.Mode
+
+# A volume is staged once per node and bind mounted on every target, so
+# several writers or readers on the node share one filesystem mount.
+SUPPORTED_MODES = [
+    Mode.SINGLE_NODE_WRITER,
+    Mode.SINGLE_NODE_SINGLE_WRITER,
+    Mode.SINGLE_NODE_MULTI_WRITER,
+    Mode.SINGLE_NODE_READER_ONLY,
+    Mode.MULTI_NODE_READER_ONLY,
+]
+
+READ_ONLY_MODES = [Mode.SINGLE_NODE_READER_ONLY, Mode.MULTI_NODE_READER_ONLY]
+
+MULTI_NODE_MODES = [Mode.MULTI_NODE_READER_ONLY]
+
+
+def mode_name(mode):
+    try:
+        return Mode.Name(mode)
+    except ValueError:
+        return str(mode)
+
+
+def check_mode(mode):
+    """
+    :return: an error message if mode is not supported, else None
+    """
+    if mode not in SUPPORTED_MODES:
+        return "Unsupported access mode: %s" % mode_name(mode)
+    return None
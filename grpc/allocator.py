@@ -0,0 +1,407 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger("springfield-csi")
+
+MiB = 1024 * 1024
+
+# LVM's default physical extent size.
+EXTENT_SIZE = 4 * MiB
+
+# Space kept back at the start of every disk for labels and metadata.
+DISK_RESERVE = 1 * MiB
+
+BEST_FIT = "best-fit"
+SPREAD = "spread"
+POLICIES = [BEST_FIT, SPREAD]
+
+
+class AllocationError(Exception):
+    pass
+
+
+def round_up(value, multiple):
+    return -(-value // multiple) * multiple
+
+
+class DiskSpace:
+    """
+    Free extents of one disk, kept as a sorted list of (start, length) runs.
+    """
+
+    def __init__(self, name, extents):
+        self.name = name
+        self.extents = extents
+        self.runs = [(0, extents)] if extents else []
+        self.free = extents
+
+    def take(self, count):
+        """
+        Allocate count extents, smallest fitting run first, splitting over
+        several runs if none is large enough.
+        :return: list of (start, length) taken
+        """
+        taken = list()
+        fitting = [run for run in self.runs if run[1] >= count]
+        if fitting:
+            candidates = [min(fitting, key=lambda run: run[1])]
+        else:
+            candidates = sorted(self.runs, key=lambda run: run[1], reverse=True)
+
+        for start, length in candidates:
+            if count == 0:
+                break
+            used = min(count, length)
+            self.runs.remove((start, length))
+            if used < length:
+                bisect.insort(self.runs, (start + used, length - used))
+            taken.append((start, used))
+            count -= used
+
+        self.free -= sum(length for _, length in taken)
+        return taken
+
+    def claim(self, start, length):
+        """
+        Mark a specific run as used, e.g. when restoring saved allocations.
+        """
+        index = bisect.bisect(self.runs, (start, float("inf"))) - 1
+        if index < 0:
+            raise AllocationError("%s: extents %d+%d are not free" % (self.name, start, length))
+        run_start, run_length = self.runs[index]
+        if start + length > run_start + run_length:
+            raise AllocationError("%s: extents %d+%d are not free" % (self.name, start, length))
+
+        self.runs.pop(index)
+        if start > run_start:
+            self.runs.insert(index, (run_start, start - run_start))
+            index += 1
+        end = start + length
+        if end < run_start + run_length:
+            self.runs.insert(index, (end, run_start + run_length - end))
+        self.free -= length
+
+    def give(self, start, length):
+        """
+        Return a run, merging it with its neighbours.
+        """
+        index = bisect.bisect(self.runs, (start, length))
+        if index > 0:
+            prev_start, prev_length = self.runs[index - 1]
+            if prev_start + prev_length == start:
+                self.runs.pop(index - 1)
+                index -= 1
+                start, length = prev_start, prev_length + length
+        if index < len(self.runs):
+            next_start, next_length = self.runs[index]
+            if start + length == next_start:
+                self.runs.pop(index)
+                length += next_length
+        self.runs.insert(index, (start, length))
+        self.free += length
+
+
+class PoolSpace:
+    def __init__(self, name, disk_sizes, extent_size, overcommit=None):
+        self.name = name
+        self.extent_size = extent_size
+        self.overcommit = overcommit
+        self.disk_sizes = dict(disk_sizes)
+        self.disks = dict()
+        for disk, size in disk_sizes.items():
+            extents = max(0, int(size) - DISK_RESERVE) // extent_size
+            self.disks[disk] = DiskSpace(disk, extents)
+
+        self.total_extents = sum(d.extents for d in self.disks.values())
+        self.free_extents = self.total_extents
+        self.free_runs = sum(len(d.runs) for d in self.disks.values())
+        self.allocations = dict()
+        # Thin pools only: extents promised to volumes, at most
+        # total_extents * overcommit.
+        self.virtual_extents = 0
+
+    def virtual_limit(self):
+        return int(self.total_extents * self.overcommit)
+
+
+class ExtentAllocator:
+    """
+    Tracks free extents per pool and per disk.
+
+    Volumes are described by a layout of `copies` mirrors of `stripes`
+    stripes plus `parity` parity disks, which needs copies * stripes +
+    parity distinct disks each holding size / stripes.  Sizes are rounded up to a whole number of extents per
+    stripe.  The disks are picked with one of POLICIES:
+
+    best-fit: the disks with the least free space that still fit, which
+              keeps large contiguous space available for large volumes.
+    spread:   the disks with the most free space, which spreads volumes
+              across spindles.
+
+    The placement is a model used to admit volumes: blivet builds them on
+    all of a pool's disks and the volume manager picks the extents.
+
+    Capacity and fragmentation of a pool are kept as running counters.
+
+    A pool added with an `overcommit` ratio is thin: its volumes get no
+    extents at all, only a share of total * overcommit virtual bytes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = dict()
+
+    def has_pool(self, pool_name):
+        return pool_name in self._pools
+
+    def add_pool(self, pool_name, disk_sizes, extent_size=EXTENT_SIZE, overcommit=None):
+        with self._lock:
+            self._pools[pool_name] = PoolSpace(pool_name, disk_sizes, extent_size, overcommit)
+            logger.info(
+                "add_pool(): %s, %d extents of %d bytes",
+                pool_name,
+                self._pools[pool_name].total_extents,
+                extent_size,
+            )
+
+    def set_overcommit(self, pool_name, overcommit):
+        with self._lock:
+            pool = self._pool(pool_name)
+            if pool.overcommit is None:
+                raise AllocationError("%s is not a thin pool" % pool_name)
+            pool.overcommit = overcommit
+
+    def remove_pool(self, pool_name):
+        with self._lock:
+            self._pools.pop(pool_name, None)
+
+    def _pool(self, pool_name):
+        pool = self._pools.get(pool_name)
+        if pool is None:
+            raise AllocationError("Unknown pool: %s" % pool_name)
+        return pool
+
+    def round_size(self, pool_name, size, stripes=1):
+        with self._lock:
+            pool = self._pool(pool_name)
+            return round_up(max(int(size), 1), pool.extent_size * stripes)
+
+    def allocate(self, pool_name, volume, size, copies=1, stripes=1, policy=BEST_FIT, parity=0):
+        """
+        Reserve space for volume.
+        :return: the allocated size in bytes, size rounded up to the layout
+        :raises AllocationError: if the pool cannot hold the volume
+        """
+        if policy not in POLICIES:
+            raise AllocationError("Unknown placement policy: %s" % policy)
+
+        with self._lock:
+            pool = self._pool(pool_name)
+            if volume in pool.allocations:
+                raise AllocationError("%s is already allocated" % volume)
+
+            rounded = round_up(max(int(size), 1), pool.extent_size * stripes)
+
+            if pool.overcommit is not None:
+                extents = rounded // pool.extent_size
+                if pool.virtual_extents + extents > pool.virtual_limit():
+                    raise AllocationError(
+                        "Thin pool %s cannot promise %d more bytes at overcommit %.2f"
+                        % (pool_name, rounded, pool.overcommit)
+                    )
+                pool.virtual_extents += extents
+                pool.allocations[volume] = (rounded, [])
+                return rounded
+
+            per_disk = rounded // stripes // pool.extent_size
+            placement = self._place(pool, per_disk, copies * stripes + parity, policy)
+            pool.allocations[volume] = (rounded, placement)
+            return rounded
+
+    def _place(self, pool, per_disk, needed, policy, prefer=()):
+        """
+        Take per_disk extents on each of `needed` disks, from the disks in
+        `prefer` first.  Called with the lock held.
+        :return: the placement taken
+        """
+        candidates = [d for d in pool.disks.values() if d.free >= per_disk]
+        if len(candidates) < needed:
+            raise AllocationError(
+                "Pool %s cannot fit %d extents on %d disk(s)"
+                % (pool.name, per_disk * needed, needed)
+            )
+
+        candidates.sort(key=lambda d: d.free, reverse=(policy == SPREAD))
+        candidates.sort(key=lambda d: d.name not in prefer)
+
+        placement = list()
+        for disk in candidates[:needed]:
+            runs_before = len(disk.runs)
+            for start, length in disk.take(per_disk):
+                placement.append((disk.name, start, length))
+            pool.free_runs += len(disk.runs) - runs_before
+
+        pool.free_extents -= per_disk * needed
+        return placement
+
+    def resize(self, pool_name, volume, size, copies=1, stripes=1, policy=BEST_FIT, parity=0):
+        """
+        Grow volume's allocation to size, taking the extra extents on the
+        disks that already hold it where they fit, as lvextend does.
+        :return: the new allocated size in bytes
+        :raises AllocationError: if the pool cannot hold the extra space
+        """
+        with self._lock:
+            pool = self._pool(pool_name)
+            if volume not in pool.allocations:
+                raise AllocationError("%s is not allocated" % volume)
+            old_size, placement = pool.allocations[volume]
+
+            rounded = round_up(max(int(size), 1), pool.extent_size * stripes)
+            if rounded <= old_size:
+                return old_size
+            extra = (rounded - old_size) // pool.extent_size
+
+            if pool.overcommit is not None:
+                if pool.virtual_extents + extra > pool.virtual_limit():
+                    raise AllocationError(
+                        "Thin pool %s cannot promise %d more bytes at overcommit %.2f"
+                        % (pool_name, rounded - old_size, pool.overcommit)
+                    )
+                pool.virtual_extents += extra
+                pool.allocations[volume] = (rounded, placement)
+                return rounded
+
+            disks = set(disk for disk, _, _ in placement)
+            added = self._place(pool, extra // stripes, copies * stripes + parity, policy, disks)
+            pool.allocations[volume] = (rounded, list(placement) + added)
+            return rounded
+
+    def disk_sizes(self, pool_name):
+        with self._lock:
+            return dict(self._pool(pool_name).disk_sizes)
+
+    def get_allocation(self, pool_name, volume):
+        """
+        :return: (size, placement) as accepted by restore(), or None
+        """
+        with self._lock:
+            pool = self._pools.get(pool_name)
+            if pool is None:
+                return None
+            return pool.allocations.get(volume)
+
+    def restore(self, pool_name, volume, size, placement):
+        """
+        Re-apply an allocation returned by get_allocation().
+        """
+        with self._lock:
+            pool = self._pool(pool_name)
+            placement = [tuple(p) for p in placement]
+            for disk_name, start, length in placement:
+                disk = pool.disks[disk_name]
+                runs_before = len(disk.runs)
+                disk.claim(start, length)
+                pool.free_runs += len(disk.runs) - runs_before
+                pool.free_extents -= length
+            if pool.overcommit is not None:
+                pool.virtual_extents += size // pool.extent_size
+            pool.allocations[volume] = (size, placement)
+
+    def rename(self, pool_name, volume, new_name):
+        """
+        Move volume's allocation to new_name, e.g. when a warm volume is
+        handed to CreateVolume.
+        """
+        with self._lock:
+            pool = self._pool(pool_name)
+            pool.allocations[new_name] = pool.allocations.pop(volume)
+
+    def free(self, pool_name, volume):
+        with self._lock:
+            pool = self._pools.get(pool_name)
+            if pool is None or volume not in pool.allocations:
+                return
+            size, placement = pool.allocations.pop(volume)
+            if pool.overcommit is not None:
+                pool.virtual_extents -= size // pool.extent_size
+            for disk_name, start, length in placement:
+                disk = pool.disks[disk_name]
+                runs_before = len(disk.runs)
+                disk.give(start, length)
+                pool.free_runs += len(disk.runs) - runs_before
+                pool.free_extents += length
+
+    def placement(self, pool_name, volume):
+        """
+        :return: list of the disks holding volume
+        """
+        with self._lock:
+            _, placement = self._pool(pool_name).allocations.get(volume, (0, []))
+            return sorted(set(disk for disk, _, _ in placement))
+
+    def capacity(self, pool_name):
+        """
+        :return: (total bytes, free bytes)
+        """
+        with self._lock:
+            pool = self._pool(pool_name)
+            if pool.overcommit is not None:
+                return (
+                    pool.virtual_limit() * pool.extent_size,
+                    (pool.virtual_limit() - pool.virtual_extents) * pool.extent_size,
+                )
+            return (
+                pool.total_extents * pool.extent_size,
+                pool.free_extents * pool.extent_size,
+            )
+
+    def usable(self, pool_name, copies=1, stripes=1, parity=0):
+        """
+        :return: (free bytes usable by volumes of this layout,
+                  size of the largest volume that can still be allocated)
+        """
+        with self._lock:
+            pool = self._pool(pool_name)
+            if pool.overcommit is not None:
+                free = max(0, pool.virtual_limit() - pool.virtual_extents) * pool.extent_size
+                return (free, free)
+            needed = copies * stripes + parity
+            frees = sorted((d.free for d in pool.disks.values()), reverse=True)
+            if len(frees) < needed:
+                return (0, 0)
+            largest = frees[needed - 1] * stripes * pool.extent_size
+            free = pool.free_extents * stripes // needed * pool.extent_size
+            return (free, largest)
+
+    def fragmentation(self, pool_name):
+        """
+        :return: 0.0 when every disk's free space is one run, approaching
+                 1.0 as free space is split into many small runs
+        """
+        with self._lock:
+            pool = self._pool(pool_name)
+            if pool.free_runs == 0:
+                return 0.0
+            disks_with_free = sum(1 for d in pool.disks.values() if d.free)
+            return 1.0 - disks_with_free / pool.free_runs
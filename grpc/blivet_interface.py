@@ -21,13 +21,20 @@ import argparse
 import sys
 import sh
 import dbus
+import dbus.mainloop.glib
 import logging
+import threading
 import time
 
+from gi.repository import GLib
+
 timeout=600
 
 logger = logging.getLogger("springfield-csi")
 
+# blivet.devicefactory.SIZE_POLICY_MAX: grow the container to fill its disks
+SIZE_POLICY_MAX = -1
+
 class StorageType():
     DEVICE_TYPE_LVM = 0
     DEVICE_TYPE_MD = 1
@@ -39,8 +46,16 @@ class StorageType():
     DEVICE_TYPE_STRATIS = 7
 
 OBJECT_MANAGER = "org.freedesktop.DBus.ObjectManager"
+
+# Signals from blivetd are only delivered while a GLib main loop is running.
+# The loop is started on its own thread the first time the object cache is
+# loaded, see ManagedObjectCache.load().
+dbus.mainloop.glib.threads_init()
+dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
 BUS = dbus.SystemBus()
 BUS_NAME = "com.redhat.Blivet0"
+OBJECT_MANAGER_PATH = "/com/redhat/Blivet0"
 TOP_OBJECT = "/com/redhat/Blivet0/Blivet"
 
 
@@ -79,20 +94,442 @@ def get_managed_objects():
     # that intentional?
     logger.info("get_managed_objects()")
     object_manager = dbus.Interface(
-        BUS.get_object(BUS_NAME, "/com/redhat/Blivet0"),
+        BUS.get_object(BUS_NAME, OBJECT_MANAGER_PATH),
         OBJECT_MANAGER,
     )
     return object_manager.GetManagedObjects(timeout=TIMEOUT)
 
 
+_main_loop_thread = None
+_main_loop_lock = threading.Lock()
+
+
+def start_main_loop():
+    """
+    Run a GLib main loop on a daemon thread so D-Bus signals are dispatched.
+    Safe to call more than once.
+    """
+    global _main_loop_thread
+
+    with _main_loop_lock:
+        if _main_loop_thread is not None:
+            return
+        loop = GLib.MainLoop()
+        _main_loop_thread = threading.Thread(
+            target=loop.run, name="blivet-signals", daemon=True
+        )
+        _main_loop_thread.start()
+
+
+class ManagedObjectCache:
+    """
+    In-process mirror of the blivetd object tree.
+
+    The tree is fetched once with GetManagedObjects and then kept current
+    from the InterfacesAdded, InterfacesRemoved and PropertiesChanged
+    signals.  Lookups by object path and by device name are dict reads.
+    The interface dicts handed out are never modified in place, a signal
+    replaces them, so callers must treat them as read-only.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._objects = dict()
+        self._by_name = dict()
+        self._loaded = False
+        self._subscribed = False
+        # Signals that arrive while GetManagedObjects is in flight are
+        # queued and replayed on top of the snapshot.
+        self._loading = False
+        self._pending = list()
+
+    def _subscribe(self):
+        if self._subscribed:
+            return
+        BUS.add_signal_receiver(
+            self._interfaces_added,
+            signal_name="InterfacesAdded",
+            dbus_interface=OBJECT_MANAGER,
+            bus_name=BUS_NAME,
+        )
+        BUS.add_signal_receiver(
+            self._interfaces_removed,
+            signal_name="InterfacesRemoved",
+            dbus_interface=OBJECT_MANAGER,
+            bus_name=BUS_NAME,
+        )
+        BUS.add_signal_receiver(
+            self._properties_changed,
+            signal_name="PropertiesChanged",
+            dbus_interface=PROPERTIES_INTERFACE,
+            bus_name=BUS_NAME,
+            path_keyword="object_path",
+        )
+        self._subscribed = True
+        start_main_loop()
+
+    def load(self):
+        """
+        (Re)build the mirror from a full GetManagedObjects scan.
+        """
+        logger.info("ManagedObjectCache.load()")
+        with self._lock:
+            self._subscribe()
+            self._loading = True
+            self._pending = list()
+
+        try:
+            managed_objects = get_managed_objects()
+        except Exception:
+            with self._lock:
+                self._loading = False
+                self._pending = list()
+            raise
+
+        with self._lock:
+            self._objects = dict()
+            self._by_name = dict()
+            for object_path, obj_data in managed_objects.items():
+                self._set_object(str(object_path), dict(obj_data))
+            pending = self._pending
+            self._pending = list()
+            self._loading = False
+            self._loaded = True
+            for handler, args in pending:
+                handler(*args)
+
+    def invalidate(self):
+        """
+        Drop the mirror.  The next lookup reloads it.
+        """
+        with self._lock:
+            self._loaded = False
+            self._objects = dict()
+            self._by_name = dict()
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def peek(self, object_path):
+        """
+        Like get_object() but never triggers a load.
+        """
+        with self._lock:
+            return self._objects.get(str(object_path))
+
+    def _set_object(self, object_path, interfaces):
+        old = self._objects.get(object_path)
+        if old is not None and DEVICE_INTERFACE in old:
+            old_name = str(old[DEVICE_INTERFACE].get("Name", ""))
+            if self._by_name.get(old_name) == object_path:
+                del self._by_name[old_name]
+
+        if not interfaces:
+            self._objects.pop(object_path, None)
+            return
+
+        self._objects[object_path] = interfaces
+        if DEVICE_INTERFACE in interfaces:
+            name = interfaces[DEVICE_INTERFACE].get("Name")
+            if name:
+                self._by_name[str(name)] = object_path
+
+    def _queue_or_apply(self, handler, *args):
+        with self._lock:
+            if self._loading:
+                self._pending.append((handler, args))
+            elif self._loaded:
+                handler(*args)
+
+    def _interfaces_added(self, object_path, interfaces):
+        self._queue_or_apply(self._apply_added, str(object_path), interfaces)
+
+    def _interfaces_removed(self, object_path, interfaces):
+        self._queue_or_apply(self._apply_removed, str(object_path), interfaces)
+
+    def _properties_changed(self, interface, changed, invalidated, object_path=None):
+        self._queue_or_apply(
+            self._apply_changed, str(object_path), str(interface), changed, invalidated
+        )
+
+    def _apply_added(self, object_path, interfaces):
+        merged = dict(self._objects.get(object_path, {}))
+        for interface, props in interfaces.items():
+            merged[str(interface)] = dict(props)
+        self._set_object(object_path, merged)
+
+    def _apply_removed(self, object_path, interfaces):
+        remaining = dict(self._objects.get(object_path, {}))
+        for interface in interfaces:
+            remaining.pop(str(interface), None)
+        self._set_object(object_path, remaining)
+
+    def _apply_changed(self, object_path, interface, changed, invalidated):
+        current = self._objects.get(object_path)
+        if current is None:
+            return
+        props = dict(current.get(interface, {}))
+        props.update(changed)
+        for name in invalidated:
+            props.pop(name, None)
+        updated = dict(current)
+        updated[interface] = props
+        self._set_object(object_path, updated)
+
+    def get_object(self, object_path):
+        """
+        :return: dict of interface name to properties, or None
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return self._objects.get(str(object_path))
+
+    def get_object_path_by_name(self, name):
+        """
+        :return: object path of the device called name, or None
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return self._by_name.get(name)
+
+    def get_device_by_name(self, name):
+        """
+        :return: Device interface properties of the device called name, or None
+        """
+        with self._lock:
+            self._ensure_loaded()
+            object_path = self._by_name.get(name)
+            if object_path is None:
+                return None
+            return self._objects[object_path].get(DEVICE_INTERFACE)
+
+    def device_paths(self):
+        """
+        :return: dict of device node (the Path property) to object path
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return {
+                str(obj_data[DEVICE_INTERFACE].get("Path")): object_path
+                for object_path, obj_data in self._objects.items()
+                if DEVICE_INTERFACE in obj_data
+            }
+
+    def _find(self, block_path, names):
+        if block_path:
+            for object_path, obj_data in self._objects.items():
+                device = obj_data.get(DEVICE_INTERFACE)
+                if device is not None and str(device.get("Path")) == block_path:
+                    return object_path
+        for name in names:
+            object_path = self._by_name.get(name)
+            if object_path is not None:
+                return object_path
+        return None
+
+    def resolve(self, block_path=None, names=()):
+        """
+        Find a device by its device node or by one of its names.  The
+        mirror can lag behind blivetd (a signal not yet delivered or
+        missed), so a miss is confirmed with a full rescan before it is
+        believed.  Object paths are not looked up, a Reset() renumbers
+        them.
+        :return: its object path, or None if blivetd has no such device
+        """
+        with self._lock:
+            self._ensure_loaded()
+            object_path = self._find(block_path, names)
+        if object_path is not None:
+            return object_path
+
+        self.load()
+        with self._lock:
+            return self._find(block_path, names)
+
+    def device_objects(self):
+        with self._lock:
+            self._ensure_loaded()
+            return [
+                obj_data[DEVICE_INTERFACE]
+                for obj_data in self._objects.values()
+                if DEVICE_INTERFACE in obj_data
+            ]
+
+    def verify(self, repair=False):
+        """
+        Compare the mirror against a full GetManagedObjects rescan.
+        :param repair: replace the mirror with the rescan if they differ
+        :return: list of object paths that differ
+        """
+        logger.info("ManagedObjectCache.verify()")
+        managed_objects = {
+            str(object_path): {
+                str(interface): dict(props) for interface, props in obj_data.items()
+            }
+            for object_path, obj_data in get_managed_objects().items()
+        }
+
+        with self._lock:
+            self._ensure_loaded()
+            mismatched = [
+                object_path
+                for object_path in set(managed_objects) | set(self._objects)
+                if managed_objects.get(object_path) != self._objects.get(object_path)
+            ]
+
+            if mismatched:
+                logger.warning(
+                    "object cache out of sync for %d objects: %s",
+                    len(mismatched),
+                    mismatched,
+                )
+                if repair:
+                    self._objects = dict()
+                    self._by_name = dict()
+                    for object_path, interfaces in managed_objects.items():
+                        self._set_object(object_path, interfaces)
+
+        return mismatched
+
+
+object_cache = ManagedObjectCache()
+
+
+class PropertyCache:
+    """
+    Cache of proxy objects and GetAll property bundles, keyed by object
+    path and (object path, interface).
+
+    Bundles are served from the managed object mirror when it is loaded,
+    otherwise fetched with a single GetAll.  A PropertiesChanged or
+    InterfacesRemoved signal drops the entries of that object and commit()
+    drops everything, since a Commit can change any device.
+
+    GetAll runs outside the lock.  PropertiesChanged bumps the generation
+    of its object path, InterfacesRemoved drops it and, like invalidate(),
+    bumps the epoch, so a bundle fetched while one of them arrived is
+    returned but not cached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proxies = dict()
+        self._bundles = dict()
+        self._generations = dict()
+        self._epoch = 0
+        self._subscribed = False
+
+    def _bump(self, object_path):
+        self._generations[object_path] = self._generations.get(object_path, 0) + 1
+
+    def _subscribe(self):
+        if self._subscribed:
+            return
+        BUS.add_signal_receiver(
+            self._properties_changed,
+            signal_name="PropertiesChanged",
+            dbus_interface=PROPERTIES_INTERFACE,
+            bus_name=BUS_NAME,
+            path_keyword="object_path",
+        )
+        BUS.add_signal_receiver(
+            self._interfaces_removed,
+            signal_name="InterfacesRemoved",
+            dbus_interface=OBJECT_MANAGER,
+            bus_name=BUS_NAME,
+        )
+        self._subscribed = True
+        start_main_loop()
+
+    def _properties_changed(self, interface, changed, invalidated, object_path=None):
+        with self._lock:
+            self._bump(str(object_path))
+            self._bundles.pop((str(object_path), str(interface)), None)
+
+    def _interfaces_removed(self, object_path, interfaces):
+        self.invalidate_path(object_path)
+
+    def invalidate_path(self, object_path):
+        object_path = str(object_path)
+        with self._lock:
+            # The object is gone, so is its generation.  Bumping the
+            # epoch instead keeps a GetAll in flight from being cached.
+            self._generations.pop(object_path, None)
+            self._epoch += 1
+            self._proxies.pop(object_path, None)
+            for key in [key for key in self._bundles if key[0] == object_path]:
+                del self._bundles[key]
+
+    def invalidate(self):
+        with self._lock:
+            self._epoch += 1
+            self._bundles = dict()
+
+    def get_proxy(self, object_path):
+        object_path = str(object_path)
+        with self._lock:
+            proxy = self._proxies.get(object_path)
+            if proxy is None:
+                proxy = BUS.get_object(BUS_NAME, object_path)
+                self._proxies[object_path] = proxy
+            return proxy
+
+    def get_properties(self, object_path, interface):
+        """
+        :return: dict of all properties of interface on object_path
+        """
+        object_path = str(object_path)
+        key = (object_path, interface)
+
+        with self._lock:
+            self._subscribe()
+            props = self._bundles.get(key)
+            generation = (self._epoch, self._generations.get(object_path, 0))
+        if props is not None:
+            return props
+
+        if object_cache.loaded:
+            obj_data = object_cache.peek(object_path)
+            if obj_data is not None and interface in obj_data:
+                return obj_data[interface]
+
+        properties_interface = dbus.Interface(
+            self.get_proxy(object_path), dbus_interface=PROPERTIES_INTERFACE
+        )
+        props = properties_interface.GetAll(interface, timeout=TIMEOUT)
+
+        with self._lock:
+            # A change that landed during GetAll may not be in props.
+            if generation == (self._epoch, self._generations.get(object_path, 0)):
+                self._bundles[key] = props
+        return props
+
+
+property_cache = PropertyCache()
+
+
 def remove_device(device_object_path, blockdevs_list, mountpoint):
     logger.info("remove_device()")
+    queue_remove_device(device_object_path, blockdevs_list)
+    commit()
+
+
+def queue_remove_device(device_object_path, blockdevs_list):
+    """
+    Queue the removal of a device and the disks it used without
+    committing.  See group_commit.GroupCommit.
+    """
+    logger.info("queue_remove_device()")
 
     # Using the format_interface.Teardown() will unmount the FS if mounted
     format_object_path = get_property(device_object_path, DEVICE_INTERFACE, "Format")
-    format_proxy = BUS.get_object(BUS_NAME, format_object_path)
     format_interface = dbus.Interface(
-        format_proxy,
+        property_cache.get_proxy(format_object_path),
         FORMAT_INTERFACE,
     )
     format_interface.Teardown()
@@ -105,19 +542,18 @@ def remove_device(device_object_path, blockdevs_list, mountpoint):
     for disk_object_path in object_paths:
         blivet_interface.RemoveDevice(disk_object_path, timeout=TIMEOUT)
 
-    blivet_interface.Commit(timeout=TIMEOUT)
+
+def commit():
+    try:
+        blivet_interface.Commit(timeout=TIMEOUT)
+    finally:
+        # Even a failed Commit() may have carried out some actions.
+        property_cache.invalidate()
 
 
 def list_device_objects():
     logger.info("list_device_objects()")
-    managed_objects = get_managed_objects().items()
-
-    return_objects = [
-        obj_data[DEVICE_INTERFACE]
-        for _, obj_data in managed_objects
-        if DEVICE_INTERFACE in obj_data
-    ]
-    return return_objects
+    return object_cache.device_objects()
 
 def print_object_paths(dict_type, print_dict):
     print(dict_type)
@@ -139,27 +575,45 @@ def print_dict(dict_type, print_dict):
 
 
 def print_properties(path, interface):
-    path = BUS.get_object(BUS_NAME, path)
-    properties_interface = dbus.Interface(
-        path, dbus_interface="org.freedesktop.DBus.Properties"
-    )
-    props = properties_interface.GetAll(interface)
+    props = property_cache.get_properties(path, interface)
     print_dict(interface, props)
 
 
 def get_property(object_path, interface, value):
     logger.info("get_property()")
-    property_object = BUS.get_object(BUS_NAME, object_path)
-    properties_interface = dbus.Interface(
-        property_object, dbus_interface="org.freedesktop.DBus.Properties"
-    )
-    props = properties_interface.GetAll(interface)
-    
+    props = property_cache.get_properties(object_path, interface)
+
     return props.get(value)
-    
-def lvm_create(disk_list, fs_name, size):
-    logger.info("lvm_create()")
-    kwargs = {
+
+
+def get_properties_bulk(object_paths, interface, names):
+    """
+    Read several properties of several devices from the managed object
+    mirror, never with a call per device.  If the mirror does not know a
+    device it is reloaded once with GetManagedObjects, devices still
+    missing after that get None for every property.
+    :return: dict of object path to dict of property name to value
+    """
+    logger.info("get_properties_bulk()")
+    object_paths = [str(object_path) for object_path in object_paths]
+    objects = {object_path: object_cache.get_object(object_path) for object_path in object_paths}
+
+    if any(obj_data is None for obj_data in objects.values()):
+        object_cache.load()
+        objects = {object_path: object_cache.get_object(object_path) for object_path in object_paths}
+
+    result = dict()
+    for object_path, obj_data in objects.items():
+        if obj_data is None:
+            logger.warning("get_properties_bulk(): %s is not in blivetd's model", object_path)
+        props = (obj_data or {}).get(interface, {})
+        result[object_path] = {name: props.get(name) for name in names}
+
+    return result
+
+
+def lvm_kwargs(disk_list, fs_name, size):
+    return {
         "device_type": StorageType.DEVICE_TYPE_LVM,
         "size": size,
         "disks": disk_list,
@@ -168,12 +622,33 @@ def lvm_create(disk_list, fs_name, size):
         "raid_level": "raid1",
     }
 
+
+def lvm_create(disk_list, fs_name, size):
+    logger.info("lvm_create()")
+    kwargs = lvm_kwargs(disk_list, fs_name, size)
+
     return blivet_interface.Factory(kwargs, timeout=TIMEOUT)
 
 
-def btrfs_create(disk_list, fs_name, size):
-    logger.info("btrfs_create()")
-    kwargs = {
+def lvm_thinp_kwargs(disk_list, fs_name, size):
+    return {
+        "device_type": StorageType.DEVICE_TYPE_LVM_THINP,
+        "size": size,
+        "disks": disk_list,
+        "fstype": "xfs",
+        "name": fs_name,
+    }
+
+
+def lvm_thinp_create(disk_list, fs_name, size):
+    logger.info("lvm_thinp_create()")
+    kwargs = lvm_thinp_kwargs(disk_list, fs_name, size)
+
+    return blivet_interface.Factory(kwargs, timeout=TIMEOUT)
+
+
+def btrfs_kwargs(disk_list, fs_name, size):
+    return {
         "device_type": StorageType.DEVICE_TYPE_BTRFS,
         "size": size,
         "disks": disk_list,
@@ -183,12 +658,16 @@ def btrfs_create(disk_list, fs_name, size):
         "container_raid_level": "raid0",
     }
 
+
+def btrfs_create(disk_list, fs_name, size):
+    logger.info("btrfs_create()")
+    kwargs = btrfs_kwargs(disk_list, fs_name, size)
+
     return blivet_interface.Factory(kwargs, timeout=TIMEOUT)
 
 
-def md_create(disk_list, fs_name, size):
-    logger.info("md_create()")
-    kwargs = {
+def md_kwargs(disk_list, fs_name, size):
+    return {
         "device_type": StorageType.DEVICE_TYPE_MD,
         "size": size,
         "disks": disk_list,
@@ -198,20 +677,52 @@ def md_create(disk_list, fs_name, size):
         "container_raid_level": "raid1",
     }
 
+
+def md_create(disk_list, fs_name, size):
+    logger.info("md_create()")
+    kwargs = md_kwargs(disk_list, fs_name, size)
+
     return blivet_interface.Factory(kwargs, timeout=TIMEOUT)
 
 
-def stratis_create(disk_list, fs_name, size):
-    logger.info("stratis_create()")
-    kwargs = {
+def stratis_kwargs(disk_list, fs_name, size):
+    return {
         "device_type": StorageType.DEVICE_TYPE_STRATIS,
         "size": size,
         "disks": disk_list,
         "name": fs_name,
     }
 
+
+def stratis_create(disk_list, fs_name, size):
+    logger.info("stratis_create()")
+    kwargs = stratis_kwargs(disk_list, fs_name, size)
+
+    return blivet_interface.Factory(kwargs, timeout=TIMEOUT)
+
+
+def factory(kwargs):
+    logger.info("factory()")
     return blivet_interface.Factory(kwargs, timeout=TIMEOUT)
 
+
+def factory_kwargs(storage_type, disk_list, fs_name, size):
+    """
+    :return: the Factory() arguments for storage_type, or None if unsupported
+    """
+    builders = {
+        StorageType.DEVICE_TYPE_LVM: lvm_kwargs,
+        StorageType.DEVICE_TYPE_LVM_THINP: lvm_thinp_kwargs,
+        StorageType.DEVICE_TYPE_BTRFS: btrfs_kwargs,
+        StorageType.DEVICE_TYPE_MD: md_kwargs,
+        StorageType.DEVICE_TYPE_STRATIS: stratis_kwargs,
+    }
+    builder = builders.get(storage_type)
+    if builder is None:
+        return None
+    return builder(disk_list, fs_name, size)
+
+
 def get_object_paths(blockdevs_list):
     logger.info("get_object_paths()")
 
@@ -224,7 +735,7 @@ def get_object_paths(blockdevs_list):
     print("object paths:", object_paths)
     return object_paths
 
-def initialize_disks(blockdevs_list):
+def initialize_disks(blockdevs_list, commit_changes=True):
     
     object_paths = get_object_paths(blockdevs_list)
 
@@ -234,27 +745,46 @@ def initialize_disks(blockdevs_list):
         blivet_interface.InitializeDisk(disk_object_path, timeout=TIMEOUT)
         print_properties(disk_object_path, DEVICE_INTERFACE)
 
-    blivet_interface.Commit(timeout=TIMEOUT)
-    print("initialize_disks: blivet_interface.Commit() completed")
+    if commit_changes:
+        commit()
+        print("initialize_disks: blivet_interface.Commit() completed")
     return object_paths
 
 def reset():
     blivet_interface.Reset(timeout=TIMEOUT)
+    object_cache.invalidate()
+    property_cache.invalidate()
 
 def fs_destroy(path, disks):
     logger.info("fs_destroy()")
-    mount_point = get_property(newdev_object_path, DEVICE_INTERFACE, "Mountpoint")
+    mount_point = get_property(path, DEVICE_INTERFACE, "Mountpoint")
     remove_device(path, disks, mount_point)
 
 def fs_create(name, disks_list, storage_type, size):
     logger.info("fs_create()")
-    
-    disk_object_paths = initialize_disks(disks_list)
+
+    newdev_object_path = queue_fs_create(name, disks_list, storage_type, size)
+    commit()
+
+    return newdev_object_path
+
+def queue_fs_create(name, disks_list, storage_type, size):
+    """
+    Queue disk initialization and the factory call for a new device
+    without committing.  Blivet resolves the factory against the queued
+    disk labels, so both land in the same Commit().
+    :return: object path of the new device
+    """
+    logger.info("queue_fs_create()")
+
+    disk_object_paths = initialize_disks(disks_list, commit_changes=False)
     newdev_object_path = None
-    SIZE = "3GiB"
+    SIZE = str(size)
 
     if storage_type == StorageType.DEVICE_TYPE_LVM:
         newdev_object_path = lvm_create(disk_object_paths, name, SIZE)
+    elif storage_type == StorageType.DEVICE_TYPE_LVM_THINP:
+        newdev_object_path = lvm_thinp_create(disk_object_paths, name, SIZE)
     elif storage_type == StorageType.DEVICE_TYPE_BTRFS:
         newdev_object_path = btrfs_create(disk_object_paths, name, SIZE)
     elif storage_type == StorageType.DEVICE_TYPE_MD:
@@ -262,8 +792,6 @@ def fs_create(name, disks_list, storage_type, size):
     elif storage_type == StorageType.DEVICE_TYPE_STRATIS:
         newdev_object_path = stratis_create(disk_object_paths, name, SIZE)
 
-    blivet_interface.Commit(timeout=TIMEOUT)
-
     return newdev_object_path
 
 
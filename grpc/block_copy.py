@@ -0,0 +1,306 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+from concurrent import futures
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger("springfield-csi")
+
+MiB = 1024 * 1024
+
+DEFAULT_CHUNK_SIZE = 8 * MiB
+DEFAULT_WORKERS = 4
+
+# O_DIRECT needs buffers, offsets and lengths aligned to the logical block
+# size.  4KiB covers every device we use.
+ALIGNMENT = 4096
+
+# Granularity at which runs of zeroes read from the source are zeroed on
+# the target instead of written.
+ZERO_BLOCK = 64 * 1024
+
+# linux/fs.h
+BLKGETSIZE64 = 0x80081272
+BLKZEROOUT = 0x127F
+
+
+class CopyError(Exception):
+    pass
+
+
+def device_size(fd):
+    """
+    :return: size in bytes of a block device or regular file
+    """
+    try:
+        buf = fcntl.ioctl(fd, BLKGETSIZE64, b"\0" * 8)
+        return struct.unpack("Q", buf)[0]
+    except OSError:
+        return os.fstat(fd).st_size
+
+
+def data_ranges(fd, size):
+    """
+    Yield the (offset, length) runs of fd that hold data, skipping holes
+    with SEEK_DATA/SEEK_HOLE.  Block devices report all of themselves as
+    data, as do files on filesystems without the calls.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            if e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                yield (offset, size - offset)
+                return
+            raise
+        end = min(end, size)
+        if start >= end:
+            return
+        yield (start, end - start)
+        offset = end
+
+
+def zero_range(fd, offset, length):
+    """
+    Zero a range of a block device without writing the zeroes ourselves.
+    Falls back to nothing for regular files, whose holes already read as
+    zeroes.
+    """
+    try:
+        fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", offset, length))
+    except OSError as e:
+        if e.errno not in (errno.ENOTTY, errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+
+
+def zero_runs(buf, length, block=ZERO_BLOCK):
+    """
+    Split the first length bytes of buf into runs of data and of zeroes.
+    :return: list of (offset, length, is_zero), covering all of it
+    """
+    zeroes = memoryview(bytes(block))
+    runs = list()
+    for offset in range(0, length, block):
+        count = min(block, length - offset)
+        is_zero = buf[offset:offset + count] == zeroes[:count]
+        if runs and runs[-1][2] == is_zero:
+            start, run_length, _ = runs[-1]
+            runs[-1] = (start, run_length + count, is_zero)
+        else:
+            runs.append((offset, count, is_zero))
+    return runs
+
+
+def _open(path, flags, direct):
+    if direct and hasattr(os, "O_DIRECT"):
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            logger.info("block copy: %s does not support O_DIRECT", path)
+    return os.open(path, flags), False
+
+
+class CopyProgress:
+    """
+    Bytes copied so far, updated from the worker threads.
+    """
+
+    def __init__(self, total, callback=None, interval=5.0):
+        self.total = total
+        self.copied = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+        self._callback = callback
+        self._interval = interval
+        self._reported = self.started
+        self._lock = threading.Lock()
+
+    def add(self, copied=0, skipped=0):
+        with self._lock:
+            self.copied += copied
+            self.skipped += skipped
+            now = time.monotonic()
+            if now - self._reported < self._interval:
+                return
+            self._reported = now
+        self.report()
+
+    def report(self):
+        done = self.copied + self.skipped
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        logger.info(
+            "block copy: %d/%d bytes (%d copied, %d skipped), %.1f MiB/s",
+            done,
+            self.total,
+            self.copied,
+            self.skipped,
+            self.copied / elapsed / MiB,
+        )
+        if self._callback is not None:
+            self._callback(done, self.total)
+
+
+def copy_device(
+    source,
+    target,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    workers=DEFAULT_WORKERS,
+    direct=True,
+    progress=None,
+):
+    """
+    Copy the block device or image `source` onto `target`.
+
+    Holes in the source are not read, and blocks that read as zeroes are
+    not written; the same ranges of the target are zeroed with BLKZEROOUT
+    instead, as a new LV may hold stale data.  Only the latter helps for
+    block device sources, which have no holes.  The data is copied in
+    chunk_size pieces by `workers` threads, with O_DIRECT where both ends
+    support it so the copy does not go through the page cache.
+    :param progress: optional callable(done_bytes, total_bytes)
+    :return: the CopyProgress of the finished copy
+    :raises CopyError: if target is smaller than source or IO fails
+    """
+    if chunk_size % ALIGNMENT:
+        raise CopyError("chunk_size must be a multiple of %d" % ALIGNMENT)
+
+    src_fd, src_direct = _open(source, os.O_RDONLY, direct)
+    try:
+        dst_fd, dst_direct = _open(target, os.O_WRONLY, direct)
+    except OSError:
+        os.close(src_fd)
+        raise
+    tail_fd = None
+
+    try:
+        size = device_size(src_fd)
+        target_size = device_size(dst_fd)
+        if target_size < size:
+            raise CopyError("%s is smaller than %s" % (target, source))
+        if dst_direct and size % ALIGNMENT and target_size < size + ALIGNMENT - size % ALIGNMENT:
+            # The unaligned end of an image cannot be written with O_DIRECT
+            # nor padded, the target ends there too.
+            tail_fd = os.open(target, os.O_WRONLY)
+
+        logger.info(
+            "copy_device(): %s -> %s, %d bytes, %d workers, direct=%s",
+            source, target, size, workers, src_direct and dst_direct,
+        )
+        state = CopyProgress(size, progress)
+        local = threading.local()
+
+        def buffer():
+            if not hasattr(local, "buf"):
+                # mmap memory is page aligned, as O_DIRECT wants.
+                local.buf = mmap.mmap(-1, chunk_size)
+            return local.buf
+
+        def write(buf, offset, length):
+            written = 0
+            while written < length:
+                written += os.pwritev(dst_fd, [buf[written:length]], offset + written)
+
+        def write_tail(buf, offset, length):
+            # Only the last chunk of an image can end unaligned.
+            tail = length % ALIGNMENT
+            if not dst_direct or not tail:
+                write(buf, offset, length)
+            elif tail_fd is None:
+                # Pad with zeroes to the next block, the target is larger.
+                aligned = length + ALIGNMENT - tail
+                buf[length:aligned] = bytes(ALIGNMENT - tail)
+                write(buf, offset, aligned)
+            else:
+                write(buf, offset, length - tail)
+                os.pwrite(tail_fd, buf[length - tail:length], offset + length - tail)
+
+        def copy_chunk(offset, length):
+            buf = memoryview(buffer())
+            # The last chunk of a device may not be aligned; read it
+            # through a full buffer and write exactly what was read.
+            aligned = -(-length // ALIGNMENT) * ALIGNMENT
+            done = 0
+            while done < length:
+                count = os.preadv(src_fd, [buf[done:aligned]], offset + done)
+                if count == 0:
+                    raise CopyError("%s: short read at %d" % (source, offset + done))
+                done += count
+            for start, run_length, is_zero in zero_runs(buf, length):
+                # BLKZEROOUT wants whole sectors, write an unaligned end.
+                if is_zero and run_length % ALIGNMENT == 0:
+                    zero_range(dst_fd, offset + start, run_length)
+                    state.add(skipped=run_length)
+                elif start + run_length == length:
+                    write_tail(buf[start:], offset + start, run_length)
+                    state.add(copied=run_length)
+                else:
+                    write(buf[start:], offset + start, run_length)
+                    state.add(copied=run_length)
+
+        def zero_chunk(offset, length):
+            zero_range(dst_fd, offset, length)
+            state.add(skipped=length)
+
+        jobs = list()
+        position = 0
+        for start, length in data_ranges(src_fd, size):
+            end = start + length
+            # Keep chunk boundaries aligned for O_DIRECT.  A chunk may run
+            # past the end of its data run, so never go back before it.
+            chunk_start = max(position, start - start % ALIGNMENT)
+            if chunk_start >= end:
+                continue
+            if chunk_start > position:
+                jobs.append((zero_chunk, position, chunk_start - position))
+            while chunk_start < end:
+                chunk_length = min(chunk_size, size - chunk_start)
+                jobs.append((copy_chunk, chunk_start, chunk_length))
+                chunk_start += chunk_length
+            position = chunk_start
+        if position < size:
+            jobs.append((zero_chunk, position, size - position))
+
+        with futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="block-copy") as pool:
+            for future in [pool.submit(*job) for job in jobs]:
+                future.result()
+
+        os.fsync(dst_fd)
+        if tail_fd is not None:
+            os.fsync(tail_fd)
+        state.report()
+        return state
+    except OSError as e:
+        raise CopyError("%s -> %s: %s" % (source, target, e))
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+        if tail_fd is not None:
+            os.close(tail_fd)
@@ -0,0 +1,73 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import logging
+import os
+
+logger = logging.getLogger("springfield-csi")
+
+# StorageClass parameter -> (volume context key, sysfs queue attribute)
+QUEUE_PARAMETERS = {
+    "queueScheduler": ("queue_scheduler", "scheduler"),
+    "readAheadKB": ("read_ahead_kb", "read_ahead_kb"),
+    "nrRequests": ("nr_requests", "nr_requests"),
+}
+
+SCHEDULERS = ["none", "mq-deadline", "kyber", "bfq"]
+
+
+def queue_context(parameters):
+    """
+    Check the queue settings of a StorageClass.
+    :return: dict of them for the volume context
+    :raises ValueError: if one is invalid
+    """
+    context = dict()
+    for parameter, (key, _) in QUEUE_PARAMETERS.items():
+        value = parameters.get(parameter)
+        if value is None:
+            continue
+        if parameter == "queueScheduler":
+            if value not in SCHEDULERS:
+                raise ValueError("queueScheduler must be one of %s" % SCHEDULERS)
+        elif not value.isdigit():
+            raise ValueError("%s must be a non-negative integer: %s" % (parameter, value))
+        context[key] = value
+    return context
+
+
+def apply_queue_settings(rdev, context):
+    """
+    Write the queue settings found in a volume context to the block
+    device rdev.  Device-mapper devices have no scheduler of their own,
+    so a setting the kernel refuses is logged and skipped.
+    :return: list of the attributes that were set
+    """
+    queue = "/sys/dev/block/%d:%d/queue" % (os.major(rdev), os.minor(rdev))
+    applied = list()
+    for key, attribute in QUEUE_PARAMETERS.values():
+        value = context.get(key)
+        if value is None:
+            continue
+        try:
+            with open(os.path.join(queue, attribute), "w") as f:
+                f.write(value)
+            applied.append(attribute)
+        except OSError as e:
+            logger.warning("apply_queue_settings(): %s/%s = %s: %s", queue, attribute, value, e.strerror)
+    return applied
@@ -0,0 +1,85 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import logging
+import threading
+
+logger = logging.getLogger("springfield-csi")
+
+DEFAULT_RECONCILE_INTERVAL = 60
+
+
+def class_key(parameters):
+    return frozenset(parameters.items())
+
+
+class CapacityIndex:
+    """
+    Free and allocatable bytes per pool and node, plus the mapping from
+    StorageClass parameter sets to pools, so GetCapacity is two dict reads.
+
+    The controller updates a pool's entry after every create, delete and
+    expand.  A background thread runs a reconcile function against Blivet
+    every `interval` seconds to catch changes made behind our back.
+    """
+
+    def __init__(self, interval=DEFAULT_RECONCILE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._classes = dict()
+        self._pools = dict()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register_class(self, parameters, pool_name):
+        with self._lock:
+            self._classes[class_key(parameters)] = pool_name
+
+    def update(self, pool_name, node, free, allocatable):
+        with self._lock:
+            self._pools[(pool_name, node)] = (free, allocatable)
+
+    def lookup(self, parameters, node):
+        """
+        :return: (free, allocatable), or None if the class is not known yet
+        """
+        with self._lock:
+            pool_name = self._classes.get(class_key(parameters))
+            if pool_name is None:
+                return None
+            return self._pools.get((pool_name, node), (0, 0))
+
+    def start_reconciler(self, reconcile):
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(self.interval):
+                try:
+                    reconcile()
+                except Exception as e:
+                    logger.error("capacity reconcile failed: %s", e)
+
+        self._thread = threading.Thread(
+            target=run, name="capacity-reconcile", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,219 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import argparse
+import logging
+import os
+import struct
+import sys
+import xml.etree.ElementTree as ElementTree
+
+import sh
+
+from blivet_interface import StorageType
+from snapshots import SnapshotMap, SnapshotError, cow_device, btrfs_path, run_tool
+from state_store import StateStore, DEFAULT_STATE_DIR, SNAPSHOTS
+from thin_pool import THIN_POOL_LV
+
+logger = logging.getLogger("springfield-csi")
+
+SECTOR_SIZE = 512
+
+# Changed-block stream: a header, then one record per extent of the newer
+# snapshot that differs from the older one.  DATA records are followed by
+# `length` bytes, ZERO records mark extents that are unmapped in the newer
+# snapshot.  END closes the stream.
+DELTA_MAGIC = b"SFDELTA1"
+HEADER = struct.Struct("<8sQ")
+RECORD = struct.Struct("<BQQ")
+DATA = 0
+ZERO = 1
+END = 2
+
+COPY_CHUNK = 4 * 1024 * 1024
+
+
+def thin_id(pool_name, name):
+    output = run_tool(sh.lvs, "--noheadings", "-o", "thin_id", "%s/%s" % (pool_name, name))
+    return int(str(output).strip())
+
+
+def thin_changed_blocks(pool_name, older, newer):
+    """
+    Diff the mappings of two thin LVs of a pool with thin_delta.  Only the
+    pool metadata is read, never the data.
+    :return: list of (kind, offset, length) in bytes, kind DATA or ZERO
+    """
+    tpool = "/dev/mapper/%s-%s-tpool" % (pool_name, THIN_POOL_LV)
+    tmeta = "/dev/mapper/%s-%s_tmeta" % (pool_name, THIN_POOL_LV)
+
+    # thin_delta must read a consistent copy of the live metadata.
+    run_tool(sh.dmsetup, "message", tpool, "0", "reserve_metadata_snap")
+    try:
+        output = run_tool(
+            sh.thin_delta,
+            "--metadata-snap",
+            "--snap1", str(thin_id(pool_name, older)),
+            "--snap2", str(thin_id(pool_name, newer)),
+            tmeta,
+        )
+    finally:
+        run_tool(sh.dmsetup, "message", tpool, "0", "release_metadata_snap")
+
+    superblock = ElementTree.fromstring(str(output))
+    block_size = int(superblock.get("data_block_size")) * SECTOR_SIZE
+
+    changes = list()
+    for entry in superblock.iter():
+        if entry.tag in ("different", "right_only"):
+            kind = DATA
+        elif entry.tag == "left_only":
+            kind = ZERO
+        else:
+            continue
+        offset = int(entry.get("begin")) * block_size
+        length = int(entry.get("length")) * block_size
+        # Merge with the previous extent when they touch.
+        if changes and changes[-1][0] == kind and sum(changes[-1][1:]) == offset:
+            changes[-1] = (kind, changes[-1][1], changes[-1][2] + length)
+        else:
+            changes.append((kind, offset, length))
+    return changes
+
+
+def write_delta(changes, device, output):
+    """
+    Stream the changed extents of device to the file object output.
+    :return: number of data bytes written
+    """
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        output.write(HEADER.pack(DELTA_MAGIC, size))
+        written = 0
+        for kind, offset, length in changes:
+            length = min(length, size - offset)
+            if length <= 0:
+                continue
+            output.write(RECORD.pack(kind, offset, length))
+            if kind != DATA:
+                continue
+            done = 0
+            while done < length:
+                data = os.pread(fd, min(COPY_CHUNK, length - done), offset + done)
+                if not data:
+                    raise SnapshotError("%s: short read at %d" % (device, offset + done))
+                output.write(data)
+                done += len(data)
+            written += length
+        output.write(RECORD.pack(END, 0, 0))
+        output.flush()
+        return written
+    finally:
+        os.close(fd)
+
+
+def apply_delta(stream, device):
+    """
+    Apply a stream written by write_delta() to a copy of the older
+    snapshot.
+    """
+    magic, size = HEADER.unpack(stream.read(HEADER.size))
+    if magic != DELTA_MAGIC:
+        raise SnapshotError("Not a changed-block stream")
+
+    fd = os.open(device, os.O_WRONLY)
+    try:
+        while True:
+            kind, offset, length = RECORD.unpack(stream.read(RECORD.size))
+            if kind == END:
+                break
+            if kind == ZERO:
+                zeroes = bytes(min(COPY_CHUNK, length))
+            done = 0
+            while done < length:
+                count = min(COPY_CHUNK, length - done)
+                data = stream.read(count) if kind == DATA else zeroes[:count]
+                os.pwrite(fd, data, offset + done)
+                done += count
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def export_changes(older, newer, output):
+    """
+    Write what changed between two snapshots of the same volume to the
+    binary file object output: a changed-block stream for thinp, an
+    incremental `btrfs send` stream for btrfs.
+    :param older: SnapshotMap of the base snapshot
+    :param newer: SnapshotMap of the later snapshot
+    :raises SnapshotError: if the snapshots cannot be diffed
+    """
+    if older.source_volume_id != newer.source_volume_id:
+        raise SnapshotError("Snapshots are of different volumes")
+    if older.creation_time > newer.creation_time:
+        older, newer = newer, older
+
+    logger.info("export_changes(): %s -> %s", older.snapshot_id, newer.snapshot_id)
+
+    if newer.storage_type == StorageType.DEVICE_TYPE_LVM_THINP:
+        changes = thin_changed_blocks(newer.pool_name, older.name, newer.name)
+        device = cow_device(newer.storage_type, newer.pool_name, newer.device, newer.name)
+        written = write_delta(changes, device, output)
+        logger.info("export_changes(): %d extents, %d bytes", len(changes), written)
+    elif newer.storage_type == StorageType.DEVICE_TYPE_BTRFS:
+        run_tool(
+            sh.btrfs,
+            "send",
+            "-p", btrfs_path(older.pool_name, older.device, older.name),
+            btrfs_path(newer.pool_name, newer.device, newer.name),
+            _out=output,
+        )
+    else:
+        raise SnapshotError("Changed-block export needs thinp or btrfs snapshots")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export what changed between two snapshots of a volume"
+    )
+    parser.add_argument("older", help="snapshot_id of the base snapshot")
+    parser.add_argument("newer", help="snapshot_id of the later snapshot")
+    parser.add_argument(
+        "--output", default="-", help="file to write the changes to, - for stdout"
+    )
+    parser.add_argument(
+        "--state-dir", default=DEFAULT_STATE_DIR, help="the controller's state directory"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    store = StateStore(os.path.join(args.state_dir, "controller.db"))
+    records = [store.get(SNAPSHOTS, snapshot_id) for snapshot_id in (args.older, args.newer)]
+    store.close()
+    for snapshot_id, record in zip((args.older, args.newer), records):
+        if record is None:
+            sys.exit("Unknown snapshot: %s" % snapshot_id)
+
+    if args.output == "-":
+        export_changes(*map(SnapshotMap.from_record, records), sys.stdout.buffer)
+    else:
+        with open(args.output, "wb") as output:
+            export_changes(*map(SnapshotMap.from_record, records), output)
@@ -23,6 +23,7 @@ import argparse
 import os
 import logging
 import sys
+import time
 import grpc
 import socket
 
@@ -31,30 +32,126 @@ from csi_pb2 import ControllerServiceCapability
 from csi_pb2_grpc import ControllerServicer
 import json
 from blivet_interface import (
-    fs_create,
-    fs_destroy,
+    queue_remove_device,
     StorageType,
     get_property,
     DEVICE_INTERFACE,
     reset,
+    object_cache,
 )
+from group_commit import GroupCommit, DEFAULT_WINDOW
+from pools import PoolManager, PoolError
+from allocator import AllocationError, BEST_FIT, POLICIES
+from capacity import CapacityIndex
+from volume_registry import VolumeRegistry
+from state_store import StateStore, DEFAULT_STATE_DIR, VOLUMES, POOLS, WARM, SNAPSHOTS
+from intent_journal import IntentJournal, CREATE, DELETE, COMMITTED
+from singleflight import SingleFlight
+from warm_pool import WarmPool, WarmVolume, DEFAULT_REFILL_RATE, warm_name
+from thin_pool import (
+    ThinPoolMonitor,
+    DEFAULT_OVERCOMMIT,
+    DEFAULT_EXTEND_THRESHOLD,
+    DEFAULT_EXTEND_PERCENT,
+)
+from snapshots import (
+    SnapshotMap,
+    SnapshotRegistry,
+    SnapshotError,
+    COW_TYPES,
+    snapshot_name,
+    cow_exists,
+    cow_device,
+    create_cow_snapshot,
+    clone_cow_volume,
+    resize_cow_volume,
+    delete_cow,
+)
+from block_copy import copy_device, CopyError
+from raid_layout import RaidLayout
+from access_modes import check_mode, MULTI_NODE_MODES
+from mkfs_tuning import (
+    MkfsOptions,
+    MkfsError,
+    XFS_TYPES,
+    device_geometry,
+    raid_geometry,
+    make_xfs,
+    wipe_filesystem,
+)
+from block_queue import queue_context
+from google.protobuf.wrappers_pb2 import Int64Value
+from google.protobuf.timestamp_pb2 import Timestamp
 
-from google.protobuf.json_format import MessageToDict
+from google.protobuf.json_format import MessageToDict, ParseDict
 
 logger = logging.getLogger("springfield-csi")
 
 NODE_NAME_TOPOLOGY_KEY = "hostname"
 
-volume_list = list()
+volumes = VolumeRegistry()
+snapshots = SnapshotRegistry()
+
+SNAPSHOT = "snapshot"
+DELETE_SNAPSHOT = "delete-snapshot"
+EXPAND = "expand"
+
+# A create whose device is left behind is removed after nobody retried it
+# for this long, in seconds.
+ABANDONED_CREATE_AGE = 60 * 60
 
 
 class VolumeMap:
-    def __init__(self, real_name, csi_volume, fs_name, block_path):
+    def __init__(self, real_name, csi_volume, fs_name, block_path, object_path=None, disks=None, pool_name=None, short_name=None):
         self.real_name = real_name
+        self.short_name = short_name
         self.csi_volume = csi_volume
         self.fs_name = fs_name
         self.block_path = block_path
+        self.object_path = object_path
+        self.disks = disks if disks is not None else list()
+        self.pool_name = pool_name
         self.published_path = None
+        self.published_nodes = list()
+        # Cloned with the backend's CoW tools, so blivet does not know it.
+        self.cow = False
+        self.raid = None
+        # The CreateVolume parameters it was made with, None if unknown.
+        self.parameters = None
+
+    def to_record(self):
+        return {
+            "real_name": self.real_name,
+            "short_name": self.short_name,
+            "csi_volume": MessageToDict(self.csi_volume),
+            "fs_name": self.fs_name,
+            "block_path": self.block_path,
+            "object_path": self.object_path,
+            "disks": self.disks,
+            "pool_name": self.pool_name,
+            "published_nodes": self.published_nodes,
+            "cow": self.cow,
+            "raid": self.raid.to_record() if self.raid else None,
+            "parameters": self.parameters,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        volume_map = cls(
+            record["real_name"],
+            ParseDict(record["csi_volume"], csi_pb2.Volume()),
+            record["fs_name"],
+            record["block_path"],
+            record.get("object_path"),
+            record.get("disks"),
+            record.get("pool_name"),
+            record.get("short_name"),
+        )
+        volume_map.published_nodes = record.get("published_nodes", [])
+        volume_map.cow = record.get("cow", False)
+        volume_map.raid = RaidLayout.from_record(record.get("raid"))
+        volume_map.parameters = record.get("parameters")
+        return volume_map
 
 
 def get_major_minor_str(device):
@@ -62,22 +159,138 @@ def get_major_minor_str(device):
 
 
 def get_volume(fs_name):
-    print("Searching for {}", fs_name)
-    for volume_map in volume_list:
-        print("compare to : {}", volume_map.csi_volume.volume_id)
-        if volume_map.csi_volume.volume_id == fs_name:
-            print("found: {}", fs_name)
-            return volume_map
+    return volumes.get(fs_name)
+
+
+def volume_mismatch(volume_map, request, fstype=None):
+    """
+    Check a CreateVolume request against the volume of the same name.
+    :param fstype: the request's filesystem, "" for block, None to skip
+    :return: why the volume does not satisfy request, or None if it does
+    """
+    csi_volume = volume_map.csi_volume
+    # Sizes are rounded up by the allocator, so compare against the range.
+    capacity = csi_volume.capacity_bytes
+    if capacity < request.capacity_range.required_bytes or (
+        request.capacity_range.limit_bytes and capacity > request.capacity_range.limit_bytes
+    ):
+        return "Volume already exists with different capacity"
+    if volume_map.parameters is not None and dict(request.parameters) != volume_map.parameters:
+        return "Volume already exists with different parameters"
+    if fstype is not None and csi_volume.volume_context.get("fs_type", fstype) != fstype:
+        return "Volume already exists with a different access type or filesystem"
+    if request.HasField("volume_content_source") and request.volume_content_source != csi_volume.content_source:
+        return "Volume already exists with a different content source"
     return None
 
 
 def print_volume_list():
-    print("Volume List:")
-    for volume_map in volume_list:
-        print("Volume ID : ", volume_map.csi_volume.volume_id)
-        print("\tCapacity : ", volume_map.csi_volume.capacity_bytes)
-    print(volume_list)
-    print("\n")
+    logger.info("Volume List: %d volumes", len(volumes))
+
+
+def csi_snapshot(snapshot_map):
+    creation_time = Timestamp()
+    creation_time.FromNanoseconds(int(snapshot_map.creation_time * 1e9))
+    return csi_pb2.Snapshot(
+        size_bytes=snapshot_map.size_bytes,
+        snapshot_id=snapshot_map.snapshot_id,
+        source_volume_id=snapshot_map.source_volume_id,
+        creation_time=creation_time,
+        ready_to_use=True,
+    )
+
+
+class ControllerError(Exception):
+    """
+    A failure to report with context.abort() by every RPC that waited
+    for the operation.
+    """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class ContentSource:
+    """
+    The volume or snapshot a new volume is cloned from.  `device` is the
+    source's block device, or for snapshots the source volume's, and
+    `name` its name in the pool.
+    """
+
+    def __init__(self, pool_name, storage_type, device, name, size, snapshot):
+        self.pool_name = pool_name
+        self.storage_type = storage_type
+        self.device = device
+        self.name = name
+        self.size = size
+        self.snapshot = snapshot
+
+
+class StorageClassParameters:
+    """
+    The StorageClass parameters passed to CreateVolume and GetCapacity.
+    """
+
+    def __init__(self, parameters):
+        self.disks = list()
+        blivettype = ""
+        self.placement = BEST_FIT
+        self.warm_count = 0
+        self.warm_sizes = list()
+        self.overcommit = DEFAULT_OVERCOMMIT
+
+        for k, v in parameters.items():
+            logger.info(f"{k}: {v}")
+            if k == "disks":
+                self.disks = v.split(",")
+            if k == "blivettype":
+                blivettype = v
+            if k == "placement":
+                self.placement = v
+            if k == "overcommit":
+                try:
+                    self.overcommit = float(v)
+                except ValueError:
+                    raise ValueError("overcommit must be a number: %s" % v)
+            if k == "warmPoolCount":
+                try:
+                    self.warm_count = int(v)
+                except ValueError:
+                    raise ValueError("warmPoolCount must be an integer: %s" % v)
+            if k == "warmPoolSizes":
+                try:
+                    self.warm_sizes = [int(size) for size in v.split(",")]
+                except ValueError:
+                    raise ValueError("warmPoolSizes must be a list of byte counts: %s" % v)
+
+        if self.placement not in POLICIES:
+            raise ValueError("Unsupported placement policy: %s" % self.placement)
+        if self.warm_count < 0 or any(size <= 0 for size in self.warm_sizes):
+            raise ValueError("warmPoolCount and warmPoolSizes must be positive")
+        if self.warm_count and not self.warm_sizes:
+            raise ValueError("warmPoolCount needs warmPoolSizes")
+        if self.overcommit < 1.0:
+            raise ValueError("overcommit must be at least 1.0")
+
+        logger.info("blivettype = " + blivettype)
+        self.typeparam = StorageType.DEVICE_TYPE_LVM
+
+        if blivettype == "DEVICE_TYPE_LVM":
+            self.typeparam = StorageType.DEVICE_TYPE_LVM
+        elif blivettype in ["DEVICE_TYPE_LVM_THINP", "thinp"]:
+            self.typeparam = StorageType.DEVICE_TYPE_LVM_THINP
+        elif blivettype == "DEVICE_TYPE_MD":
+            self.typeparam = StorageType.DEVICE_TYPE_MD
+        elif blivettype == "DEVICE_TYPE_STRATIS":
+            self.typeparam = StorageType.DEVICE_TYPE_STRATIS
+        elif blivettype == "DEVICE_TYPE_BTRFS":
+            self.typeparam = StorageType.DEVICE_TYPE_BTRFS
+
+        self.raid = RaidLayout.from_parameters(parameters, self.typeparam, self.disks)
+        self.mkfs = MkfsOptions.from_parameters(parameters)
+        self.queue = queue_context(parameters)
 
 
 def get_capability(capability):
@@ -94,7 +307,7 @@ def get_capability(capability):
         )
 
     return csi_pb2.VolumeCapability(
-        mount=csi_pb2.VolumeCapability.BlockVolume(),
+        block=csi_pb2.VolumeCapability.BlockVolume(),
         access_mode=csi_pb2.VolumeCapability.AccessMode(
             mode=capability.access_mode.mode
         ),
@@ -102,13 +315,357 @@ def get_capability(capability):
 
 
 class SpringfieldControllerService(ControllerServicer):
-    def __init__(self, nodeid):
+    def __init__(
+        self,
+        nodeid,
+        commit_window=DEFAULT_WINDOW,
+        state_dir=DEFAULT_STATE_DIR,
+        warm_refill_rate=DEFAULT_REFILL_RATE,
+        thin_extend_threshold=DEFAULT_EXTEND_THRESHOLD,
+        thin_extend_percent=DEFAULT_EXTEND_PERCENT,
+    ):
         self.nodeid = nodeid
+        self.pools = PoolManager()
+        self.group_commit = GroupCommit(window=commit_window, on_failure=self.pools.refresh)
+        self.capacity = CapacityIndex()
+        self.state_dir = state_dir
+        self.store = None
+        self.journal = IntentJournal()
+        self.inflight = SingleFlight()
+        self.warm = WarmPool(refill_rate=warm_refill_rate)
+        self.thin_monitor = ThinPoolMonitor(
+            self.thin_pools,
+            threshold=thin_extend_threshold,
+            extend_percent=thin_extend_percent,
+        )
 
     # Only the controller may run reset.  Currently there are 
     # problems in the dbus server if it is run twice.
     def setup_controller(self):
+        self.store = StateStore(os.path.join(self.state_dir, "controller.db"))
+        self.journal = IntentJournal(self.store)
+        self.load_state()
         reset()
+        self.reconcile_volumes()
+        self.recover_intents()
+        self.capacity.start_reconciler(self.reconcile_capacity)
+        self.warm.start_filler(self.fill_warm)
+        self.thin_monitor.start()
+
+    def load_state(self):
+        """
+        Rebuild pools, allocations and the volume registry from the store.
+        """
+        for record in self.store.load(POOLS).values():
+            pool = self.pools.restore(record)
+            # Refill the warm pool before the first CreateVolume asks.
+            warm = record.get("warm")
+            if warm:
+                self.warm.configure(pool, warm["sizes"], warm["count"])
+
+        for record in self.store.load(VOLUMES).values():
+            volume_map = VolumeMap.from_record(record)
+            allocation = record.get("allocation")
+            if allocation and volume_map.pool_name:
+                self.pools.allocator.restore(volume_map.pool_name, volume_map.real_name, *allocation)
+            volumes.add(volume_map)
+
+        for record in self.store.load(SNAPSHOTS).values():
+            snapshots.add(SnapshotMap.from_record(record))
+
+        # A warm volume that was claimed just before a crash is already
+        # recorded as a regular volume.
+        claimed = set(volume_map.short_name for volume_map in volumes.snapshot())
+        for record in self.store.load(WARM).values():
+            warm = WarmVolume.from_record(record)
+            if warm.name in claimed:
+                self.store.delete(WARM, warm.name)
+                continue
+            allocation = record.get("allocation")
+            if allocation:
+                self.pools.allocator.restore(warm.pool_name, warm.name, *allocation)
+            self.warm.add(warm)
+
+        logger.info(
+            "load_state(): %d volumes, %d snapshots, %d warm volumes, %d pools",
+            len(volumes),
+            len(snapshots),
+            len(self.warm.ready()),
+            len(self.pools.pools()),
+        )
+
+    def reconcile_volumes(self):
+        """
+        Blivet object paths do not survive a rescan, so re-resolve every
+        restored volume through its device node.
+        """
+        device_paths = object_cache.device_paths()
+
+        for volume_map in volumes.snapshot():
+            if volume_map.cow:
+                continue
+            object_path = device_paths.get(volume_map.block_path)
+            if object_path is None:
+                logger.error(
+                    "reconcile_volumes: no device for %s at %s",
+                    volume_map.csi_volume.volume_id,
+                    volume_map.block_path,
+                )
+                continue
+            if object_path != volume_map.object_path:
+                volume_map.object_path = object_path
+                self.save_volume(volume_map)
+
+        for warm in self.warm.ready():
+            object_path = device_paths.get(warm.block_path)
+            if object_path is None:
+                logger.error("reconcile_volumes: warm volume %s is gone", warm.name)
+                self.warm.remove(warm.name)
+                self.pools.release(warm.pool_name, warm.name)
+                self.store.delete(WARM, warm.name)
+            elif object_path != warm.object_path:
+                warm.object_path = object_path
+                self.save_warm(warm)
+
+    def recover_intents(self):
+        """
+        Deal with operations that were cut short by a restart.  Creates
+        whose device exists keep their reserved space for the
+        provisioner's retry to adopt, until expire_intents() gives up on
+        them; creates without a device are rolled back.  Deletes whose
+        device is already gone are completed.
+        """
+        device_paths = object_cache.device_paths()
+
+        for intent in self.journal.pending():
+            op, name, params = intent["op"], intent["name"], intent["params"]
+            logger.info("recover_intents: %s %s in phase %s", op, name, intent["phase"])
+
+            if op == CREATE:
+                pool = self.pools.get_pool_by_name(params.get("pool"))
+                object_path = None
+                exists = False
+                if pool is not None and params.get("cow"):
+                    exists = self.cow_created(pool, params)
+                elif pool is not None:
+                    object_path = self.pools.find_device(pool, params["short_name"])
+                    exists = object_path is not None
+                if exists:
+                    allocation = params.get("allocation")
+                    if allocation and not self.pools.allocator.get_allocation(pool.name, name):
+                        self.pools.allocator.restore(pool.name, name, *allocation)
+                    if not params.get("warm"):
+                        continue
+                    # Nobody retries a warm fill, finish it here.
+                    warm = WarmVolume(
+                        name,
+                        pool.name,
+                        params["warm"],
+                        allocation[0],
+                        str(object_path),
+                        get_property(object_path, DEVICE_INTERFACE, "Path"),
+                    )
+                    self.save_warm(warm)
+                    self.warm.add(warm)
+                self.journal.finish(CREATE, name)
+
+            elif op == DELETE:
+                volume_map = get_volume(name)
+                if volume_map is not None and volume_map.cow:
+                    # Left for the provisioner's retry, which checks the
+                    # backend itself.
+                    continue
+                if volume_map is None or volume_map.block_path not in device_paths:
+                    if volume_map is not None:
+                        self.pools.release(volume_map.pool_name, name)
+                        volumes.remove(name)
+                    self.forget_volume(name)
+                    self.journal.finish(DELETE, name)
+
+    def cow_created(self, pool, params):
+        """
+        :return: True if the CoW clone of a CREATE intent exists, or may
+                 exist as far as we can tell
+        """
+        try:
+            return cow_exists(
+                pool.storage_type, pool.name, params.get("device"), params["short_name"], snapshot=False
+            )
+        except SnapshotError as e:
+            logger.warning("cow_created: cannot tell if %s exists: %s", params["short_name"], e)
+            return True
+
+    def expire_intents(self, max_age=ABANDONED_CREATE_AGE):
+        """
+        Remove the devices of creates that nobody retried for max_age
+        seconds and release their space.  The provisioner stops retrying
+        when the claim is deleted, so without this the device would leak.
+        """
+        now = time.time()
+        for intent in self.journal.pending():
+            if intent["op"] != CREATE or intent["params"].get("warm"):
+                continue
+            if now - intent.get("started", now) < max_age:
+                continue
+            name = intent["name"]
+            if self.inflight.in_flight((CREATE, name)):
+                continue
+            # Running under the create's key keeps a late retry from
+            # adopting the device while it is being removed.
+            try:
+                self.inflight.do((CREATE, name), self.abandon_create, name)
+            except ControllerError as e:
+                if e.code != grpc.StatusCode.ABORTED:
+                    logger.error("expire_intents: failed to clean up %s: %s", name, e.message)
+
+    def abandon_create(self, name):
+        """
+        Roll back the create of `name` that its intent records.
+        :raises ControllerError: ABORTED once done, so a CreateVolume that
+                                 joined the call retries from scratch
+        """
+        intent = self.journal.get(CREATE, name)
+        if intent is None:
+            return None
+        if get_volume(name) is not None:
+            # Registered just before a crash, only the intent was left.
+            self.journal.finish(CREATE, name)
+            return None
+
+        params = intent["params"]
+        pool = self.pools.get_pool_by_name(params.get("pool"))
+        if pool is not None:
+            logger.warning("abandon_create: nobody retried %s, removing it", name)
+            try:
+                if not params.get("cow"):
+                    self.group_commit.submit(self.queue_remove_created, pool, params["short_name"])
+                elif self.cow_created(pool, params):
+                    delete_cow(pool.storage_type, pool.name, params.get("device"), params["short_name"], snapshot=False)
+            except Exception as e:
+                raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to remove %s: %s" % (name, e))
+            self.pools.release(pool.name, name)
+            self.refresh_capacity(pool)
+        self.journal.finish(CREATE, name)
+        raise ControllerError(grpc.StatusCode.ABORTED, "Abandoned create of %s was rolled back, retry" % name)
+
+    def queue_remove_created(self, pool, short_name):
+        """
+        Queue removing the device an unfinished create left in pool.
+        """
+        object_path = self.pools.find_device(pool, short_name)
+        if object_path is not None:
+            queue_remove_device(object_path, [])
+
+    def save_volume(self, volume_map):
+        if self.store is None:
+            return
+        record = volume_map.to_record()
+        if volume_map.pool_name:
+            record["allocation"] = self.pools.allocator.get_allocation(
+                volume_map.pool_name, volume_map.real_name
+            )
+        self.store.put(VOLUMES, volume_map.csi_volume.volume_id, record)
+
+    def forget_volume(self, volume_id):
+        if self.store is not None:
+            self.store.delete(VOLUMES, volume_id)
+
+    def thin_pools(self):
+        return [pool.name for pool in self.pools.pools() if pool.thin and pool.initialized]
+
+    def save_warm(self, warm):
+        if self.store is None:
+            return
+        record = warm.to_record()
+        record["allocation"] = self.pools.allocator.get_allocation(warm.pool_name, warm.name)
+        self.store.put(WARM, warm.name, record)
+
+    def save_pool(self, pool):
+        if self.store is not None:
+            record = self.pools.to_record(pool)
+            record["warm"] = self.warm.target(pool.name)
+            self.store.put(POOLS, pool.name, record)
+
+    def refresh_capacity(self, pool):
+        free, allocatable = self.pools.usable(pool)
+        self.capacity.update(pool.name, self.nodeid, free, allocatable)
+
+    def reconcile_capacity(self):
+        """
+        Bring the allocator and capacity index back in line with Blivet:
+        repair the object mirror, drop volumes whose device has really
+        disappeared, releasing their space, and recompute every pool.
+        """
+        logger.info("reconcile_capacity()")
+        object_cache.verify(repair=True)
+        self.expire_intents()
+
+        for volume_map in volumes.snapshot():
+            if not volume_map.object_path or object_cache.get_object(volume_map.object_path) is not None:
+                continue
+            volume_id = volume_map.csi_volume.volume_id
+            with volumes.volume_lock(volume_id):
+                # The mirror may only be late, or the volume may have been
+                # deleted meanwhile.  resolve_volume() rescans blivetd
+                # before it says the device is gone.
+                if get_volume(volume_id) is not volume_map or self.resolve_volume(volume_map) is not None:
+                    continue
+                logger.warning("reconcile_capacity: device of %s is gone, dropping the volume", volume_id)
+                self.pools.release(volume_map.pool_name, volume_map.real_name)
+                self.forget_volume(volume_id)
+                volumes.remove(volume_id)
+
+        for pool in self.pools.pools():
+            self.refresh_capacity(pool)
+
+        logger.info("warm pool: %s", self.warm.stats())
+
+    def fill_warm(self, pool, size):
+        """
+        Create one warm volume of `size` in pool.  Runs on the warm pool's
+        filler thread.
+        :return: the new WarmVolume
+        """
+        name = warm_name()
+        capacity = self.pools.allocate(pool, name, size)
+        self.journal.begin(
+            CREATE,
+            name,
+            pool=pool.name,
+            short_name=name,
+            allocation=self.pools.allocator.get_allocation(pool.name, name),
+            warm=size,
+        )
+        try:
+            object_path = self.group_commit.submit(
+                self.pools.queue_create, pool, name, capacity, rollback=self.pools.unqueue_create
+            )
+        except Exception:
+            self.pools.release(pool.name, name)
+            self.journal.finish(CREATE, name)
+            raise
+
+        self.save_pool(pool)
+        block_path = get_property(object_path, DEVICE_INTERFACE, "Path")
+        try:
+            mkfs = self.tune_filesystem(pool, block_path, MkfsOptions())
+        except ControllerError as e:
+            logger.error("fill_warm(): %s", e.message)
+            mkfs = dict()
+        warm = WarmVolume(
+            name,
+            pool.name,
+            size,
+            capacity,
+            str(object_path),
+            block_path,
+            mkfs,
+        )
+        self.save_warm(warm)
+        self.journal.finish(CREATE, name)
+        self.refresh_capacity(pool)
+        logger.info("fill_warm(): %s, %d bytes in %s", name, capacity, pool.name)
+        return warm
 
     def CreateVolume(self, request, context):
         logger.info("CreateVolume()")
@@ -130,23 +687,15 @@ class SpringfieldControllerService(ControllerServicer):
         else:  # TODO: default to 10 MiB?
             size = 10485760
 
-        print_volume_list()
         volume_map = get_volume(request.name)
 
         # If the volume already exits - just return success
         if volume_map != None:
-            if (
-                volume_map.csi_volume.capacity_bytes
-                == request.capacity_range.limit_bytes
-                or volume_map.csi_volume.capacity_bytes
-                == request.capacity_range.required_bytes
-            ):
+            error = volume_mismatch(volume_map, request)
+            if error is None:
                 return csi_pb2.CreateVolumeResponse(volume=volume_map.csi_volume)
             else:
-                context.abort(
-                    grpc.StatusCode.ALREADY_EXISTS,
-                    "Volume already exists with different capacity",
-                )
+                context.abort(grpc.StatusCode.ALREADY_EXISTS, error)
         if len(request.volume_capabilities) == 0:
             context.abort(
                 grpc.StatusCode.INVALID_ARGUMENT, "Must have at least one capabiltiy"
@@ -170,6 +719,7 @@ class SpringfieldControllerService(ControllerServicer):
             logger.info("Topology key not found... why?")
 
         logger.info("request.volume_capabilities:")
+        block = False
         for capability in request.volume_capabilities:
             logger.info(capability)
             fstype = capability.mount.fs_type
@@ -179,46 +729,36 @@ class SpringfieldControllerService(ControllerServicer):
             access_type = capability.WhichOneof("access_type")
             assert access_type == "mount" or access_type == "block"
 
-            if fstype == "":
-                fstype = "xfs"
+            if access_type == "block":
+                block = True
+                metadata["volumeMode"] = "block"
+            else:
+                if fstype == "":
+                    fstype = "xfs"
 
-            if fstype not in ["xfs", "btrfs"]:
-                context.abort(
-                    grpc.StatusCode.INVALID_ARGUMENT,
-                    "Unsupported filesystem type: {fstype}",
-                )
-            if fstype == "":
-                fstype = "xfs"
+                if fstype not in ["xfs", "btrfs"]:
+                    context.abort(
+                        grpc.StatusCode.INVALID_ARGUMENT,
+                        "Unsupported filesystem type: {fstype}",
+                    )
 
-            if capability.access_mode.mode not in [
-                csi_pb2.VolumeCapability.AccessMode.Mode.SINGLE_NODE_WRITER
-            ]:
+            error = check_mode(capability.access_mode.mode)
+            if error is not None:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, error)
+
+        try:
+            class_parameters = StorageClassParameters(request.parameters)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        # An empty fstype asks for a raw block volume from here on.
+        if block:
+            if class_parameters.typeparam not in XFS_TYPES:
                 context.abort(
                     grpc.StatusCode.INVALID_ARGUMENT,
-                    "Unsupported access mode: {csi_pb2.VolumeCapability.AccessMode.Mode.Name(volume_capability.access_mode.mode)}",
+                    "Block volumes need an LVM, thinp or MD StorageClass",
                 )
-
-        disks = list()
-        blivettype = ""
-
-        for k, v in request.parameters.items():
-            logger.info(f"{k}: {v}")
-            if k == "disks":
-                disks = v.split(",")
-            if k == "blivettype":
-                blivettype = v
-
-        logger.info("blivettype = " + blivettype)
-        typeparam = StorageType.DEVICE_TYPE_LVM
-
-        if blivettype == "DEVICE_TYPE_LVM":
-            typeparam = StorageType.DEVICE_TYPE_LVM
-        elif blivettype == "DEVICE_TYPE_MD":
-            typeparam = StorageType.DEVICE_TYPE_MD
-        elif blivettype == "DEVICE_TYPE_STRATIS":
-            typeparam = StorageType.DEVICE_TYPE_STRATIS
-        elif blivettype == "DEVICE_TYPE_BTRFS":
-            typeparam = StorageType.DEVICE_TYPE_BTRFS
+            fstype = ""
 
         # LVM and MD will fail if long names are used.  K8 typically passes names for PVCs
         # similar to pvc-d5343444-7614-48bf-bd01-1d12d1313396.  For now, just take the last
@@ -230,16 +770,248 @@ class SpringfieldControllerService(ControllerServicer):
             short_name = request.name
 
         logger.info("request.name = %s, short_name = %s", request.name, short_name)
-        new_object_path = fs_create(short_name, disks, typeparam, "3GB")
 
-        logger.info("hostname = %s, nodename = %s", socket.gethostname(), node_name)
+        # external-provisioner retries while a create is still running.
+        # Let the retries wait for that create instead of starting another.
+        try:
+            csi_volume = self.inflight.do(
+                (CREATE, request.name),
+                self.provision_volume,
+                request,
+                class_parameters,
+                short_name,
+                size,
+                node_name,
+                fstype,
+            )
+        except ControllerError as e:
+            context.abort(e.code, e.message)
+
+        # A retry that joined a create in flight gets that create's volume,
+        # which may have been asked for with different arguments.
+        volume_map = get_volume(request.name)
+        if volume_map is not None:
+            error = volume_mismatch(volume_map, request, fstype)
+            if error is not None:
+                context.abort(grpc.StatusCode.ALREADY_EXISTS, error)
+
+        return csi_pb2.CreateVolumeResponse(volume=csi_volume)
+
+    def provision_volume(self, request, class_parameters, short_name, size, node_name, fstype):
+        """
+        The backend half of CreateVolume, run once per volume name however
+        many callers are waiting for it.
+        :param fstype: "" for a raw block volume
+        :return: the new csi_pb2.Volume
+        :raises ControllerError: with the status to report to every caller
+        """
+        volume_map = get_volume(request.name)
+        if volume_map is not None:
+            return volume_map.csi_volume
+
+        disks = class_parameters.disks
+        typeparam = class_parameters.typeparam
+        placement = class_parameters.placement
+
+        raid = class_parameters.raid
+        try:
+            pool = self.pools.get_pool(typeparam, disks)
+            self.pools.configure_raid(pool, raid)
+        except PoolError as e:
+            raise ControllerError(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        self.pools.set_overcommit(pool, class_parameters.overcommit)
+
+        source = self.content_source(request)
+        if source is not None:
+            # A clone is at least as large as its source.
+            size = max(size, source.size)
+            if source.pool_name == pool.name and pool.storage_type in COW_TYPES:
+                return self.clone_cow(
+                    request, pool, source, short_name, size, node_name, fstype, disks, class_parameters.queue
+                )
+
+        # A previous attempt may have been interrupted after reserving space
+        # or even after its Commit().  Pick up where it stopped.
+        intent = self.journal.get(CREATE, request.name)
+        allocation = self.pools.allocator.get_allocation(pool.name, request.name)
+
+        # Warm volumes are built with the pool's default layout and mkfs.
+        if (
+            fstype
+            and class_parameters.warm_count
+            and source is None
+            and (raid is None or pool.shared_raid)
+            and class_parameters.mkfs.is_default()
+        ):
+            if self.warm.configure(pool, class_parameters.warm_sizes, class_parameters.warm_count):
+                self.save_pool(pool)
+            if intent is None and allocation is None:
+                warm = self.warm.claim(pool.name, size, request.capacity_range.limit_bytes)
+                if warm is not None:
+                    return self.claim_warm_volume(
+                        request, pool, warm, node_name, fstype, disks, class_parameters.queue
+                    )
+
+        if allocation is not None:
+            size = allocation[0]
+        else:
+            try:
+                size = self.pools.allocate(pool, request.name, size, placement, raid)
+            except AllocationError as e:
+                raise ControllerError(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+
+        if request.capacity_range.limit_bytes and size > request.capacity_range.limit_bytes:
+            self.pools.release(pool.name, request.name)
+            self.journal.finish(CREATE, request.name)
+            raise ControllerError(
+                grpc.StatusCode.OUT_OF_RANGE,
+                "Rounded size %d exceeds limit_bytes" % size,
+            )
+
+        new_object_path = None
+        if intent is not None:
+            new_object_path = self.pools.find_device(pool, short_name)
+            if new_object_path is not None:
+                logger.info("CreateVolume: resuming %s from phase %s", request.name, intent["phase"])
+        else:
+            self.journal.begin(
+                CREATE,
+                request.name,
+                pool=pool.name,
+                short_name=short_name,
+                allocation=self.pools.allocator.get_allocation(pool.name, request.name),
+            )
+
+        if new_object_path is None:
+            try:
+                new_object_path = self.group_commit.submit(
+                    self.pools.queue_create,
+                    pool,
+                    short_name,
+                    size,
+                    raid,
+                    rollback=self.pools.unqueue_create,
+                )
+            except Exception as e:
+                logger.error("CreateVolume: failed to create %s: %s", short_name, e)
+                self.pools.release(pool.name, request.name)
+                self.journal.finish(CREATE, request.name)
+                raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to create volume: %s" % e)
+
+        # The pool's disks are initialized for good now, never wipe them again.
+        self.save_pool(pool)
+        self.journal.advance(CREATE, request.name, COMMITTED, object_path=str(new_object_path))
+
         block_path = get_property(new_object_path, DEVICE_INTERFACE, "Path")
+        volume_context = dict(class_parameters.queue)
+        if source is not None:
+            # Copying again after an interruption is harmless.
+            self.copy_source(source, block_path)
+        elif not fstype:
+            self.wipe_volume(block_path)
+        else:
+            # So is formatting again, nothing has been written yet.
+            volume_context.update(self.tune_filesystem(pool, block_path, class_parameters.mkfs, raid))
+
+        return self.register_volume(
+            request,
+            pool,
+            new_object_path,
+            block_path,
+            short_name,
+            size,
+            node_name,
+            fstype,
+            disks,
+            raid=raid,
+            context=volume_context,
+        )
+
+    def wipe_volume(self, block_path):
+        """
+        Blivet always makes a filesystem, remove it from a raw block volume.
+        :raises ControllerError: if it cannot be wiped
+        """
+        try:
+            wipe_filesystem(block_path)
+        except MkfsError as e:
+            logger.error("CreateVolume: %s", e)
+            raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to wipe volume: %s" % e)
+
+    def tune_filesystem(self, pool, block_path, options, raid=None):
+        """
+        Blivet formats with the default XFS geometry.  Format a new volume
+        again, aligned to the stripes of the device under it and with the
+        class's mkfs knobs, unless there is neither to apply.
+        :return: what was applied, for the volume context
+        :raises ControllerError: if mkfs fails
+        """
+        if pool.storage_type not in XFS_TYPES:
+            return dict()
+
+        geometry = device_geometry(block_path)
+        if geometry == (0, 0):
+            geometry = raid_geometry(pool.raid_layout(raid), len(pool.disks), pool.storage_type)
+        if geometry == (0, 0) and options.is_default():
+            return dict()
+        try:
+            return make_xfs(block_path, options, geometry)
+        except MkfsError as e:
+            logger.error("CreateVolume: %s", e)
+            raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to format volume: %s" % e)
+
+    def claim_warm_volume(self, request, pool, warm, node_name, fstype, disks, queue=None):
+        """
+        Hand a warm volume to request.name.  The device keeps its warm
+        name, only the allocation and the records change hands.
+        :return: the new csi_pb2.Volume
+        """
+        logger.info("CreateVolume: %s claims warm volume %s", request.name, warm.name)
+        self.pools.allocator.rename(pool.name, warm.name, request.name)
+        csi_volume = self.register_volume(
+            request,
+            pool,
+            warm.object_path,
+            warm.block_path,
+            warm.name,
+            warm.capacity,
+            node_name,
+            fstype,
+            disks,
+            context=dict(queue or {}, **warm.mkfs),
+        )
+        if self.store is not None:
+            self.store.delete(WARM, warm.name)
+        return csi_volume
+
+    def register_volume(
+        self,
+        request,
+        pool,
+        new_object_path,
+        block_path,
+        short_name,
+        size,
+        node_name,
+        fstype,
+        disks,
+        cow=False,
+        raid=None,
+        context=None,
+    ):
+        """
+        Record a newly provisioned device as the volume for request.
+        :param context: extra volume context, e.g. the mkfs geometry
+        :return: the new csi_pb2.Volume
+        """
+        logger.info("hostname = %s, nodename = %s", socket.gethostname(), node_name)
 
         csi_metadata = {
             "csi_name": request.name,
             "fs_type" : fstype,
             "block_path": block_path,
         }
+        csi_metadata.update(context or dict())
 
         csi_volume = csi_pb2.Volume(
             volume_context=csi_metadata,
@@ -249,36 +1021,238 @@ class SpringfieldControllerService(ControllerServicer):
                 csi_pb2.Topology(segments={"hostname": node_name})
             ],
         )
-
-        volume_map = VolumeMap(request.name, csi_volume, request.name, block_path)
+        if request.HasField("volume_content_source"):
+            csi_volume.content_source.CopyFrom(request.volume_content_source)
+
+        self.refresh_capacity(pool)
+
+        volume_map = VolumeMap(
+            request.name,
+            csi_volume,
+            request.name,
+            block_path,
+            str(new_object_path) if new_object_path else None,
+            disks,
+            pool.name,
+            short_name,
+        )
+        volume_map.cow = cow
+        volume_map.raid = raid
+        volume_map.parameters = dict(request.parameters)
         logger.info(volume_map)
-        volume_list.append(volume_map)
+        self.save_volume(volume_map)
+        volumes.add(volume_map)
+        self.journal.finish(CREATE, request.name)
 
-        logger.info(volume_list)
         print_volume_list()
 
-        return csi_pb2.CreateVolumeResponse(volume=csi_volume)
+        return csi_volume
+
+    def content_source(self, request):
+        """
+        Resolve request.volume_content_source.
+        :return: a ContentSource, or None for an empty volume
+        :raises ControllerError: NOT_FOUND if the source does not exist
+        """
+        content = request.volume_content_source
+        if content.HasField("snapshot"):
+            snapshot_map = snapshots.get(content.snapshot.snapshot_id)
+            if snapshot_map is None:
+                raise ControllerError(
+                    grpc.StatusCode.NOT_FOUND,
+                    "Source snapshot %s does not exist" % content.snapshot.snapshot_id,
+                )
+            return ContentSource(
+                snapshot_map.pool_name,
+                snapshot_map.storage_type,
+                snapshot_map.device,
+                snapshot_map.name,
+                snapshot_map.size_bytes,
+                snapshot=True,
+            )
+
+        if content.HasField("volume"):
+            volume_map = get_volume(content.volume.volume_id)
+            if volume_map is None:
+                raise ControllerError(
+                    grpc.StatusCode.NOT_FOUND,
+                    "Source volume %s does not exist" % content.volume.volume_id,
+                )
+            pool = self.pools.get_pool_by_name(volume_map.pool_name)
+            return ContentSource(
+                volume_map.pool_name,
+                pool.storage_type if pool is not None else None,
+                volume_map.block_path,
+                volume_map.short_name,
+                volume_map.csi_volume.capacity_bytes,
+                snapshot=False,
+            )
+
+        return None
+
+    def clone_cow(self, request, pool, source, short_name, size, node_name, fstype, disks, queue=None):
+        """
+        Clone source into a new volume of the same pool with the backend's
+        copy-on-write snapshot, which shares every block with the source.
+        :return: the new csi_pb2.Volume
+        """
+        if self.pools.allocator.get_allocation(pool.name, request.name) is None:
+            try:
+                size = self.pools.allocate(pool, request.name, size)
+            except AllocationError as e:
+                raise ControllerError(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+        else:
+            size = self.pools.allocator.get_allocation(pool.name, request.name)[0]
+
+        if request.capacity_range.limit_bytes and size > request.capacity_range.limit_bytes:
+            self.pools.release(pool.name, request.name)
+            raise ControllerError(
+                grpc.StatusCode.OUT_OF_RANGE,
+                "Rounded size %d exceeds limit_bytes" % size,
+            )
+
+        self.journal.begin(
+            CREATE,
+            request.name,
+            pool=pool.name,
+            short_name=short_name,
+            allocation=self.pools.allocator.get_allocation(pool.name, request.name),
+            cow=True,
+            device=source.device,
+        )
+        try:
+            # An interrupted attempt may have created it already.
+            if not cow_exists(pool.storage_type, pool.name, source.device, short_name, snapshot=False):
+                clone_cow_volume(
+                    pool.storage_type, pool.name, source.device, source.name, short_name, source.snapshot
+                )
+            if size > source.size:
+                resize_cow_volume(pool.storage_type, pool.name, short_name, size)
+            if pool.storage_type == StorageType.DEVICE_TYPE_BTRFS:
+                # The clone is a subvolume of the pool's filesystem, the
+                # node mounts it from the pool's device with subvol=.
+                block_path = source.device
+                queue = dict(queue or dict(), subvol=short_name)
+            else:
+                block_path = cow_device(pool.storage_type, pool.name, source.device, short_name)
+        except SnapshotError as e:
+            logger.error("CreateVolume: failed to clone %s: %s", request.name, e)
+            self.pools.release(pool.name, request.name)
+            self.journal.finish(CREATE, request.name)
+            raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to clone volume: %s" % e)
+        self.journal.advance(CREATE, request.name, COMMITTED)
+
+        return self.register_volume(
+            request, pool, None, block_path, short_name, size, node_name, fstype, disks, cow=True, context=queue
+        )
+
+    def copy_source(self, source, block_path):
+        """
+        Fill a new volume from a source in another pool, or on a backend
+        without CoW clones, with a block-level copy.
+        :raises ControllerError: if the source has no block device to copy
+        """
+        try:
+            if source.snapshot:
+                device = cow_device(source.storage_type, source.pool_name, source.device, source.name)
+            elif source.storage_type == StorageType.DEVICE_TYPE_BTRFS:
+                raise SnapshotError("btrfs subvolumes can only be cloned within their pool")
+            else:
+                device = source.device
+            copy_device(device, block_path)
+        except (SnapshotError, CopyError) as e:
+            logger.error("CreateVolume: failed to copy %s: %s", source.name, e)
+            raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to copy volume content: %s" % e)
 
     def DeleteVolume(self, request, context):
         logger.info("DeleteVolume()")
         if request.volume_id == None or request.volume_id == "":
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include volume_id")
 
-        volume_map = get_volume(request.volume_id)
+        try:
+            self.inflight.do((DELETE, request.volume_id), self.delete_volume, request.volume_id)
+        except ControllerError as e:
+            context.abort(e.code, e.message)
 
-        if volume_map == None:
-            return csi_pb2.DeleteVolumeResponse()
+        return csi_pb2.DeleteVolumeResponse()
 
-        if fs_destroy(CONTAINER_POOL, request.volume_id) == None:
-            logger.info("Failed to delete fs: " + request.volume_id)
+    def delete_volume(self, volume_id):
+        """
+        The backend half of DeleteVolume, run once per volume_id however
+        many callers are waiting for it.
+        :raises ControllerError: with the status to report to every caller
+        """
+        with volumes.volume_lock(volume_id):
+            volume_map = get_volume(volume_id)
 
-        for volume_map in volume_list:
-            if volume_map.csi_volume.volume_id == request.volume_id:
-                volume_list.remove(volume_map)
+            if volume_map == None:
+                return
+
+            # Only the volume goes away, the pool keeps its disks.  If an
+            # earlier attempt already removed the device, just finish up.
+            self.journal.begin(DELETE, volume_id, object_path=volume_map.object_path)
+            if volume_map.cow:
+                self.delete_cow_volume(volume_map)
+            elif self.resolve_volume(volume_map) is not None:
+                try:
+                    self.group_commit.submit(self.queue_remove_volume, volume_map)
+                except Exception as e:
+                    logger.error("Failed to delete fs: %s : %s", volume_id, e)
+                    raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to delete volume: %s" % e)
+            self.journal.advance(DELETE, volume_id, COMMITTED)
+
+            self.forget_volume(volume_id)
+            volumes.remove(volume_id)
+            self.journal.finish(DELETE, volume_id)
+
+        self.pools.release(volume_map.pool_name, volume_id)
+        pool = self.pools.get_pool_by_name(volume_map.pool_name)
+        if pool is not None:
+            self.refresh_capacity(pool)
 
         print_volume_list()
 
-        return csi_pb2.DeleteVolumeResponse()
+    def resolve_volume(self, volume_map):
+        """
+        Look the volume's device up in blivetd, rescanning if the object
+        mirror does not have it, and keep volume_map.object_path current.
+        :return: its object path, or None if the device is really gone
+        """
+        pool = self.pools.get_pool_by_name(volume_map.pool_name)
+        names = self.pools.device_names(pool, volume_map.short_name) if pool is not None else []
+        object_path = object_cache.resolve(volume_map.block_path, names)
+        if object_path is not None and object_path != volume_map.object_path:
+            logger.info(
+                "resolve_volume: %s moved from %s to %s",
+                volume_map.csi_volume.volume_id,
+                volume_map.object_path,
+                object_path,
+            )
+            volume_map.object_path = object_path
+            self.save_volume(volume_map)
+        return object_path
+
+    def queue_remove_volume(self, volume_map):
+        """
+        Queue removing the volume's device.  Resolves the device when the
+        actions are queued, object paths do not survive blivetd restarting.
+        """
+        object_path = self.resolve_volume(volume_map)
+        if object_path is not None:
+            queue_remove_device(object_path, [])
+
+    def delete_cow_volume(self, volume_map):
+        pool = self.pools.get_pool_by_name(volume_map.pool_name)
+        try:
+            if cow_exists(
+                pool.storage_type, pool.name, volume_map.block_path, volume_map.short_name, snapshot=False
+            ):
+                delete_cow(
+                    pool.storage_type, pool.name, volume_map.block_path, volume_map.short_name, snapshot=False
+                )
+        except SnapshotError as e:
+            logger.error("Failed to delete clone: %s : %s", volume_map.real_name, e)
+            raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to delete volume: %s" % e)
 
     def ControllerPublishVolume(self, request, context):
         logger.info("ControllerPublishVolume()")
@@ -308,9 +1282,29 @@ class SpringfieldControllerService(ControllerServicer):
 
         # if request.node_id != self.nodeid:
         #     context.abort(grpc.StatusCode.NOT_FOUND, "Mismatched node id")
+        mode = request.volume_capability.access_mode.mode
+        error = check_mode(mode)
+        if error is not None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, error)
+
+        # Single node modes may have any number of users, on one node.
+        others = [node for node in volume_map.published_nodes if node != request.node_id]
+        if others and mode not in MULTI_NODE_MODES:
+            context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION,
+                "Volume %s is already published on %s" % (request.volume_id, others[0]),
+            )
+
+        if request.node_id not in volume_map.published_nodes:
+            volume_map.published_nodes.append(request.node_id)
+            self.save_volume(volume_map)
+
         publish_context = {
             "block_path": volume_map.block_path,
         }
+        subvol = volume_map.csi_volume.volume_context.get("subvol")
+        if subvol:
+            publish_context["subvol"] = subvol
 
         return csi_pb2.ControllerPublishVolumeResponse(publish_context=publish_context)
 
@@ -323,6 +1317,11 @@ class SpringfieldControllerService(ControllerServicer):
 
         if volume_map == None:
             return csi_pb2.ControllerUnpublishVolumeResponse()
+
+        if request.node_id in volume_map.published_nodes:
+            volume_map.published_nodes.remove(request.node_id)
+            self.save_volume(volume_map)
+
         return csi_pb2.ControllerUnpublishVolumeResponse()
 
     def ValidateVolumeCapabilities(self, request, context):
@@ -359,13 +1358,10 @@ class SpringfieldControllerService(ControllerServicer):
                     "Unsupported filesystem type: {fstype}",
                 )
 
-        if volume_capability.access_mode.mode not in [
-            csi_pb2.VolumeCapability.AccessMode.Mode.SINGLE_NODE_WRITER
-        ]:
-            context.abort(
-                grpc.StatusCode.INVALID_ARGUMENT,
-                "Unsupported access mode: {csi_pb2.VolumeCapability.AccessMode.Mode.Name(volume_capability.access_mode.mode)}",
-            )
+        for capability in request.volume_capabilities:
+            error = check_mode(capability.access_mode.mode)
+            if error is not None:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, error)
 
         capabilities = []
         for capability in request.volume_capabilities:
@@ -401,15 +1397,15 @@ class SpringfieldControllerService(ControllerServicer):
                 "request.starting_token defined with no request.max_entries: {starting_token}",
             )
 
+        volume_snapshot = volumes.snapshot()
+        start = int(request.starting_token) if request.starting_token else 0
+
         if not request.max_entries:
-            csi_list = volume_list
-        elif request.starting_token:
-            csi_list = volume_list[
-                request.starting_token : request.starting_token + request.max_entries
-            ]
-            next_token = request.starting_token + request.max_entries + 1
+            csi_list = volume_snapshot[start:]
         else:
-            csi_list = volume_list[: request.max_entries]
+            csi_list = volume_snapshot[start : start + request.max_entries]
+            if start + request.max_entries < len(volume_snapshot):
+                next_token = str(start + request.max_entries)
 
         return_list = list()
 
@@ -418,32 +1414,41 @@ class SpringfieldControllerService(ControllerServicer):
                 volume_id=volume_map.csi_volume.volume_id,
                 capacity_bytes=volume_map.csi_volume.capacity_bytes,
             )
-            print(
-                "volume ID: %s bytes = %d",
-                volume_map.csi_volume.volume_id,
-                volume_map.csi_volume.capacity_bytes,
-            )
-
             entry = csi_pb2.ListVolumesResponse.Entry(volume=new_vol)
             return_list.append(entry)
 
-        logger.info(return_list)
+        logger.info("ListVolumes: returning %d entries", len(return_list))
 
         return csi_pb2.ListVolumesResponse(entries=return_list, next_token=next_token)
 
     def GetCapacity(self, request, context):
         logger.info("GetCapacity()")
-        for capability in request.volume_capabilities:
-            supported_capability = get_capability(capability)
-            print(supported_capability)
 
-        for key, value in request.parameters:
-            print(key, value)
+        node = request.accessible_topology.segments.get(
+            NODE_NAME_TOPOLOGY_KEY, self.nodeid
+        )
 
-        device = dbus_handle.devicetree.get_device_by_name(VOLUME_GROUP_NAME)
+        entry = self.capacity.lookup(request.parameters, node)
+        if entry is None:
+            # First poll for this class: resolve its pool once.
+            try:
+                class_parameters = StorageClassParameters(request.parameters)
+                pool = self.pools.get_pool(
+                    class_parameters.typeparam, class_parameters.disks
+                )
+            except (ValueError, PoolError) as e:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+            self.pools.set_overcommit(pool, class_parameters.overcommit)
+            self.refresh_capacity(pool)
+            self.capacity.register_class(request.parameters, pool.name)
+            entry = self.capacity.lookup(request.parameters, node)
+
+        free, allocatable = entry
 
         return csi_pb2.GetCapacityResponse(
-            available_capacity=int(volume_group.free_space.convert_to(B))
+            available_capacity=free,
+            maximum_volume_size=Int64Value(value=allocatable),
         )
 
     def ControllerGetCapabilities(self, request, context):
@@ -520,6 +1525,12 @@ class SpringfieldControllerService(ControllerServicer):
             )
         )
 
+        single_node_multi_writer = ControllerServiceCapability(
+            rpc=ControllerServiceCapability.RPC(
+                type=ControllerServiceCapability.RPC.SINGLE_NODE_MULTI_WRITER
+            )
+        )
+
         # TODO: add capabilties as support is implemented
 
         capabilities = [
@@ -535,68 +1546,286 @@ class SpringfieldControllerService(ControllerServicer):
             # list_volumes_published_nodes,
             volume_condition,
             get_volume,
+            single_node_multi_writer,
         ]
 
         return csi_pb2.ControllerGetCapabilitiesResponse(capabilities=capabilities)
 
     def CreateSnapshot(self, request, context):
         logger.info("CreateSnapshot()")
-        if request.volume_id == None:
-            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include volume_id")
+        if not request.name:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include name")
+        if not request.source_volume_id:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include source_volume_id")
+
+        snapshot_map = snapshots.get(request.name)
+        if snapshot_map is not None:
+            if snapshot_map.source_volume_id != request.source_volume_id:
+                context.abort(
+                    grpc.StatusCode.ALREADY_EXISTS,
+                    "Snapshot already exists for a different volume",
+                )
+            return csi_pb2.CreateSnapshotResponse(snapshot=csi_snapshot(snapshot_map))
 
-        volume_map = get_volume(request.volume_id)
+        volume_map = get_volume(request.source_volume_id)
 
         if volume_map == None:
             context.abort(
-                grpc.StatusCode.NOT_FOUND, "request.target_path does not exits"
+                grpc.StatusCode.NOT_FOUND, "request.source_volume_id does not exist"
+            )
+
+        pool = self.pools.get_pool_by_name(volume_map.pool_name)
+        if pool is None or pool.storage_type not in COW_TYPES:
+            context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                "Snapshots need a thinp, btrfs or stratis volume",
             )
 
-        context.abort(
-            grpc.StatusCode.UNIMPLEMENTED,
-            "CreateSnapshot not implemented",
+        try:
+            snapshot_map = self.inflight.do(
+                (SNAPSHOT, request.name), self.take_snapshot, request.name, volume_map, pool
+            )
+        except ControllerError as e:
+            context.abort(e.code, e.message)
+
+        return csi_pb2.CreateSnapshotResponse(snapshot=csi_snapshot(snapshot_map))
+
+    def take_snapshot(self, snapshot_id, volume_map, pool):
+        """
+        The backend half of CreateSnapshot.
+        :return: the new SnapshotMap
+        :raises ControllerError: with the status to report to every caller
+        """
+        snapshot_map = snapshots.get(snapshot_id)
+        if snapshot_map is not None:
+            return snapshot_map
+
+        name = snapshot_name(snapshot_id)
+        device = volume_map.block_path
+        try:
+            # An interrupted attempt may have created it already.
+            if not cow_exists(pool.storage_type, pool.name, device, name):
+                create_cow_snapshot(
+                    pool.storage_type, pool.name, device, volume_map.short_name, name
+                )
+        except SnapshotError as e:
+            logger.error("CreateSnapshot: %s: %s", snapshot_id, e)
+            raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to create snapshot: %s" % e)
+
+        snapshot_map = SnapshotMap(
+            snapshot_id,
+            volume_map.csi_volume.volume_id,
+            name,
+            pool.name,
+            pool.storage_type,
+            volume_map.csi_volume.capacity_bytes,
+            device,
         )
-        return csi_pb2.CreateSnapshotResponse()
+        if self.store is not None:
+            self.store.put(SNAPSHOTS, snapshot_id, snapshot_map.to_record())
+        snapshots.add(snapshot_map)
+        return snapshot_map
 
     def DeleteSnapshot(self, request, context):
         logger.info("DeleteSnapshot()")
-        if request.volume_id == None:
-            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include volume_id")
+        if not request.snapshot_id:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include snapshot_id")
+
+        try:
+            self.inflight.do(
+                (DELETE_SNAPSHOT, request.snapshot_id), self.remove_snapshot, request.snapshot_id
+            )
+        except ControllerError as e:
+            context.abort(e.code, e.message)
 
-        context.abort(
-            grpc.StatusCode.UNIMPLEMENTED,
-            "DeleteSnapshot not implemented",
-        )
         return csi_pb2.DeleteSnapshotResponse()
 
+    def remove_snapshot(self, snapshot_id):
+        """
+        The backend half of DeleteSnapshot.
+        :raises ControllerError: with the status to report to every caller
+        """
+        snapshot_map = snapshots.get(snapshot_id)
+        if snapshot_map is None:
+            return
+
+        try:
+            if cow_exists(
+                snapshot_map.storage_type, snapshot_map.pool_name, snapshot_map.device, snapshot_map.name
+            ):
+                delete_cow(
+                    snapshot_map.storage_type,
+                    snapshot_map.pool_name,
+                    snapshot_map.device,
+                    snapshot_map.name,
+                )
+        except SnapshotError as e:
+            logger.error("DeleteSnapshot: %s: %s", snapshot_id, e)
+            raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to delete snapshot: %s" % e)
+
+        if self.store is not None:
+            self.store.delete(SNAPSHOTS, snapshot_id)
+        snapshots.remove(snapshot_id)
+
     def ListSnapshots(self, request, context):
         logger.info("ListSnapshots()")
-        if request.volume_id == None:
-            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include volume_id")
+        next_token = None
+        if request.starting_token:
+            try:
+                int(request.starting_token)
+            except ValueError:
+                context.abort(
+                    grpc.StatusCode.ABORTED,
+                    "request.starting_token must be an integer: {starting_token}",
+                )
 
-        volume_map = get_volume(request.volume_id)
+        if request.snapshot_id:
+            snapshot_map = snapshots.get(request.snapshot_id)
+            snapshot_list = [snapshot_map] if snapshot_map is not None else []
+            if request.source_volume_id:
+                snapshot_list = [
+                    s for s in snapshot_list if s.source_volume_id == request.source_volume_id
+                ]
+        elif request.source_volume_id:
+            snapshot_list = snapshots.list_by_source(request.source_volume_id)
+        else:
+            snapshot_list = snapshots.snapshot()
 
-        if volume_map == None:
+        start = int(request.starting_token) if request.starting_token else 0
+        if start > len(snapshot_list):
             context.abort(
-                grpc.StatusCode.NOT_FOUND, "request.target_path does not exits"
+                grpc.StatusCode.ABORTED,
+                "request.starting_token is past the end of the list",
             )
 
-        context.abort(
-            grpc.StatusCode.UNIMPLEMENTED,
-            "ListSnapshots not implemented",
-        )
-        return csi_pb2.CreateSnapshotResponse()
+        if not request.max_entries:
+            page = snapshot_list[start:]
+        else:
+            page = snapshot_list[start : start + request.max_entries]
+            if start + request.max_entries < len(snapshot_list):
+                next_token = str(start + request.max_entries)
+
+        entries = [
+            csi_pb2.ListSnapshotsResponse.Entry(snapshot=csi_snapshot(snapshot_map))
+            for snapshot_map in page
+        ]
+
+        logger.info("ListSnapshots: returning %d entries", len(entries))
+
+        return csi_pb2.ListSnapshotsResponse(entries=entries, next_token=next_token)
 
     def ControllerExpandVolume(self, request, context):
         logger.info("ControllerExpandVolume()")
         if request.volume_id == None or request.volume_id == "":
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include volume_id")
 
+        required = request.capacity_range.required_bytes
+        if not required:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include capacity_range")
+
         volume_map = get_volume(request.volume_id)
 
         if volume_map == None:
             context.abort(grpc.StatusCode.NOT_FOUND, "request.volume_id does not exits")
 
-        return csi_pb2.ControllerExpandVolumeResponse()
+        # Refuse before the device is touched: the size is rounded up to
+        # the pool's extents and stripes, which may go past limit_bytes.
+        limit = request.capacity_range.limit_bytes
+        pool = self.pools.get_pool_by_name(volume_map.pool_name)
+        if limit and pool is not None:
+            size = max(
+                self.pools.round_size(pool, required, volume_map.raid),
+                volume_map.csi_volume.capacity_bytes,
+            )
+            if size > limit:
+                context.abort(
+                    grpc.StatusCode.OUT_OF_RANGE,
+                    "Volume would be %d bytes, larger than limit_bytes" % size,
+                )
+
+        # The resizer may retry, or ask again with a larger size while an
+        # expansion is running.  Join the running one, and go again if it
+        # was for less than we need.
+        try:
+            while True:
+                capacity = self.inflight.do(
+                    (EXPAND, request.volume_id), self.expand_volume, request.volume_id, required
+                )
+                if capacity >= required:
+                    break
+        except ControllerError as e:
+            context.abort(e.code, e.message)
+
+        if limit and capacity > limit:
+            context.abort(grpc.StatusCode.OUT_OF_RANGE, "Volume is larger than limit_bytes")
+
+        access_type = request.volume_capability.WhichOneof("access_type")
+
+        return csi_pb2.ControllerExpandVolumeResponse(
+            capacity_bytes=capacity,
+            node_expansion_required=(access_type != "block"),
+        )
+
+    def expand_volume(self, volume_id, required):
+        """
+        The backend half of ControllerExpandVolume: grow the device, the
+        filesystem is grown by the node.
+        :return: the volume's capacity afterwards
+        :raises ControllerError: with the status to report to every caller
+        """
+        with volumes.volume_lock(volume_id):
+            volume_map = get_volume(volume_id)
+            if volume_map is None:
+                raise ControllerError(grpc.StatusCode.NOT_FOUND, "request.volume_id does not exits")
+
+            capacity = volume_map.csi_volume.capacity_bytes
+            if capacity >= required:
+                return capacity
+
+            pool = self.pools.get_pool_by_name(volume_map.pool_name)
+            before = self.pools.allocator.get_allocation(pool.name, volume_id)
+            try:
+                if before is None:
+                    # Nothing is reserved for the volume (e.g. its state
+                    # was lost), reserve all of it anew.
+                    logger.warning("expand_volume(): %s has no allocation, allocating %d", volume_id, required)
+                    size = self.pools.allocate(pool, volume_id, required, raid=volume_map.raid)
+                else:
+                    size = self.pools.resize(pool, volume_id, required, raid=volume_map.raid)
+            except AllocationError as e:
+                raise ControllerError(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+
+            logger.info("expand_volume(): %s %d -> %d", volume_id, capacity, size)
+            try:
+                if volume_map.cow:
+                    resize_cow_volume(pool.storage_type, pool.name, volume_map.short_name, size)
+                elif pool.storage_type not in [
+                    StorageType.DEVICE_TYPE_BTRFS,
+                    StorageType.DEVICE_TYPE_STRATIS,
+                ]:
+                    self.group_commit.submit(
+                        self.pools.queue_resize,
+                        pool,
+                        volume_map.object_path,
+                        volume_map.short_name,
+                        size,
+                        volume_map.raid,
+                    )
+                # btrfs subvolumes and Stratis filesystems have no size of
+                # their own, only the reservation grows.
+            except Exception as e:
+                logger.error("expand_volume(): failed to grow %s: %s", volume_id, e)
+                # Put the old reservation back.
+                self.pools.release(pool.name, volume_id)
+                if before is not None:
+                    self.pools.allocator.restore(pool.name, volume_id, *before)
+                raise ControllerError(grpc.StatusCode.INTERNAL, "Failed to expand volume: %s" % e)
+
+            volume_map.csi_volume.capacity_bytes = size
+            self.save_volume(volume_map)
+
+        self.refresh_capacity(pool)
+        return size
 
     def ControllerGetVolume(self, request, context):
         logger.info("ControllerGetVolume()")
@@ -0,0 +1,162 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+from concurrent import futures
+import logging
+import queue
+import threading
+import time
+
+import blivet_interface
+
+logger = logging.getLogger("springfield-csi")
+
+# How long the first request of a batch waits for others to join it.
+DEFAULT_WINDOW = 0.05
+DEFAULT_MAX_BATCH = 64
+
+
+class _Request:
+    def __init__(self, queue_actions, args, rollback):
+        self.queue_actions = queue_actions
+        self.args = args
+        self.rollback = rollback
+        self.future = futures.Future()
+        self.result = None
+
+
+class GroupCommit:
+    """
+    Batch the blivet actions of concurrent requests into one Commit().
+
+    Callers pass a function that only queues actions (for example
+    blivet_interface.queue_fs_create) to submit().  A single worker thread
+    collects requests for up to `window` seconds, runs their queue functions
+    one after the other and then issues one Commit() for the whole batch.
+
+    A request whose queue function raises gets its own exception and the
+    rest of the batch goes on.  Blivet's device factory puts the model
+    back the way it was when it fails, so queue functions must leave
+    nothing behind when they raise.  If the shared Commit() fails every
+    request that was part of it gets that error, and those submitted with
+    a `rollback` have it called with what their queue function returned,
+    to take back what they queued.  `on_failure` is called after that, for
+    callers that keep state derived from the model.  blivetd's model is
+    never reset, it does not survive more than one Reset().
+
+    Queueing and committing are serialized on the worker thread.  Reads
+    (properties, the object mirror, ResolveDevice) still happen on the
+    callers' threads.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, max_batch=DEFAULT_MAX_BATCH, on_failure=None):
+        self.window = window
+        self.max_batch = max_batch
+        self.on_failure = on_failure
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="group-commit", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, queue_actions, *args, rollback=None):
+        """
+        Queue actions through queue_actions(*args) and wait for the batch
+        they end up in to be committed.  The calling thread blocks until
+        then.
+        :param rollback: called with what queue_actions returned if the
+                         Commit() fails
+        :return: what queue_actions returned
+        """
+        self._start()
+        request = _Request(queue_actions, args, rollback)
+        self._queue.put(request)
+        return request.future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _queue_batch(self, requests):
+        """
+        Queue the actions of requests, failing those that do not queue.
+        :return: the requests whose actions are queued
+        """
+        queued = list()
+        for request in requests:
+            try:
+                request.result = request.queue_actions(*request.args)
+                queued.append(request)
+            except Exception as e:
+                logger.warning("group commit: queueing failed: %s", e)
+                request.future.set_exception(e)
+        return queued
+
+    def _roll_back(self, requests):
+        for request in reversed(requests):
+            if request.rollback is None:
+                continue
+            try:
+                request.rollback(request.result)
+            except Exception as e:
+                logger.error("group commit: rollback failed: %s", e)
+
+        if self.on_failure is not None:
+            try:
+                self.on_failure()
+            except Exception as e:
+                logger.error("group commit: on_failure failed: %s", e)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            queued = self._queue_batch(batch)
+
+            if not queued:
+                continue
+
+            logger.info("group commit: committing %d request(s)", len(queued))
+            try:
+                blivet_interface.commit()
+            except Exception as e:
+                logger.error("group commit: Commit() failed: %s", e)
+                self._roll_back(queued)
+                for request in queued:
+                    request.future.set_exception(e)
+                continue
+
+            for request in queued:
+                request.future.set_result(request.result)
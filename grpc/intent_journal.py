@@ -0,0 +1,88 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import logging
+import time
+
+from state_store import INTENTS
+
+logger = logging.getLogger("springfield-csi")
+
+CREATE = "create"
+DELETE = "delete"
+
+# Phases, in order.  An intent is removed once the operation is complete.
+STARTED = "started"
+COMMITTED = "committed"
+
+
+class IntentJournal:
+    """
+    Write-ahead record of multi-step blivet operations.
+
+    begin() is written before the first blivet call, advance() after each
+    phase that must not be repeated and finish() once the result is stored
+    elsewhere.  Whatever is left after a crash tells the next attempt, or
+    the controller at start-up, where to resume or what to roll back.
+    Without a store every call is a no-op.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+
+    @staticmethod
+    def _key(op, name):
+        return "%s:%s" % (op, name)
+
+    def begin(self, op, name, **params):
+        record = {
+            "op": op,
+            "name": name,
+            "phase": STARTED,
+            "started": time.time(),
+            "params": params,
+        }
+        if self.store is not None:
+            self.store.put(INTENTS, self._key(op, name), record)
+        return record
+
+    def advance(self, op, name, phase, **params):
+        if self.store is None:
+            return
+        key = self._key(op, name)
+        record = self.store.get(INTENTS, key)
+        if record is None:
+            return
+        record["phase"] = phase
+        record["params"].update(params)
+        self.store.put(INTENTS, key, record)
+
+    def get(self, op, name):
+        if self.store is None:
+            return None
+        return self.store.get(INTENTS, self._key(op, name))
+
+    def finish(self, op, name):
+        if self.store is not None:
+            self.store.delete(INTENTS, self._key(op, name))
+
+    def pending(self):
+        if self.store is None:
+            return []
+        return list(self.store.load(INTENTS).values())
@@ -0,0 +1,163 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import logging
+import os
+
+import sh
+
+from blivet_interface import StorageType
+
+logger = logging.getLogger("springfield-csi")
+
+# Pool types whose volumes blivet formats as XFS on a device of their own.
+# btrfs subvolumes share the pool's filesystem and Stratis makes its own.
+XFS_TYPES = [
+    StorageType.DEVICE_TYPE_LVM,
+    StorageType.DEVICE_TYPE_LVM_THINP,
+    StorageType.DEVICE_TYPE_MD,
+]
+
+INODE_SIZES = [256, 512, 1024, 2048]
+MiB = 1024 * 1024
+
+
+class MkfsError(Exception):
+    pass
+
+
+class MkfsOptions:
+    """
+    The XFS knobs of a StorageClass: xfsLogSize (bytes), xfsAgCount and
+    xfsInodeSize.  Unset knobs keep the mkfs.xfs default.
+    """
+
+    def __init__(self, log_size=0, ag_count=0, inode_size=0):
+        self.log_size = log_size
+        self.ag_count = ag_count
+        self.inode_size = inode_size
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        """
+        :raises ValueError: if a knob is out of range
+        """
+        try:
+            options = cls(
+                int(parameters.get("xfsLogSize", 0)),
+                int(parameters.get("xfsAgCount", 0)),
+                int(parameters.get("xfsInodeSize", 0)),
+            )
+        except ValueError:
+            raise ValueError("xfsLogSize, xfsAgCount and xfsInodeSize must be integers")
+
+        if options.log_size and (options.log_size < 4 * MiB or options.log_size % MiB):
+            raise ValueError("xfsLogSize must be a whole number of MiB, at least 4MiB")
+        if options.ag_count < 0:
+            raise ValueError("xfsAgCount must be positive")
+        if options.inode_size and options.inode_size not in INODE_SIZES:
+            raise ValueError("xfsInodeSize must be one of %s" % INODE_SIZES)
+        return options
+
+    def is_default(self):
+        return not (self.log_size or self.ag_count or self.inode_size)
+
+
+def device_geometry(device):
+    """
+    Read the stripe geometry the kernel reports for device: MD and LVM
+    RAID set minimum_io_size to the chunk and optimal_io_size to a full
+    stripe.
+    :return: (stripe unit, stripe width in units), or (0, 0)
+    """
+    rdev = os.stat(device).st_rdev
+    queue = "/sys/dev/block/%d:%d/queue" % (os.major(rdev), os.minor(rdev))
+    try:
+        with open(os.path.join(queue, "minimum_io_size")) as f:
+            minimum = int(f.read())
+        with open(os.path.join(queue, "optimal_io_size")) as f:
+            optimal = int(f.read())
+    except (OSError, ValueError):
+        return (0, 0)
+
+    if optimal <= minimum or minimum <= 4096 or optimal % minimum:
+        return (0, 0)
+    return (minimum, optimal // minimum)
+
+
+def raid_geometry(raid, disk_count, storage_type):
+    """
+    Fall back to the class's RAID layout when the kernel reports none.
+    :return: (stripe unit, stripe width in units), or (0, 0)
+    """
+    if raid is None or not raid.stripe_size:
+        return (0, 0)
+    _, stripes, _ = raid.geometry(storage_type, disk_count)
+    if stripes < 2:
+        return (0, 0)
+    return (raid.stripe_size, stripes)
+
+
+def make_xfs(device, options, geometry):
+    """
+    Re-create the XFS on a new, empty volume with its stripe geometry and
+    the class's knobs.  Blivet's mkfs discarded the device already, so
+    this one does not.
+    :param geometry: (stripe unit, stripe width in units), or (0, 0)
+    :return: dict of what was applied, for the volume context
+    :raises MkfsError: if mkfs.xfs fails
+    """
+    unit, width = geometry
+    data = list()
+    if unit:
+        data += ["su=%dk" % (unit // 1024), "sw=%d" % width]
+    if options.ag_count:
+        data.append("agcount=%d" % options.ag_count)
+
+    args = list()
+    if data:
+        args += ["-d", ",".join(data)]
+    if options.log_size:
+        args += ["-l", "size=%dm" % (options.log_size // MiB)]
+    if options.inode_size:
+        args += ["-i", "size=%d" % options.inode_size]
+
+    logger.info("make_xfs(): mkfs.xfs -f -K %s %s", " ".join(args), device)
+    try:
+        sh.Command("mkfs.xfs")("-f", "-K", *args, device)
+    except sh.ErrorReturnCode as e:
+        raise MkfsError("mkfs.xfs failed on %s: %s" % (device, e.stderr.decode(errors="replace").strip()))
+
+    applied = {"mkfs_options": " ".join(args)}
+    if unit:
+        applied["stripe_unit"] = str(unit)
+        applied["stripe_width"] = str(width)
+    return applied
+
+
+def wipe_filesystem(device):
+    """
+    Remove the filesystem Blivet made on a volume meant for raw block
+    access.
+    :raises MkfsError: if wipefs fails
+    """
+    logger.info("wipe_filesystem(): %s", device)
+    try:
+        sh.wipefs("-a", device)
+    except sh.ErrorReturnCode as e:
+        raise MkfsError("wipefs failed on %s: %s" % (device, e.stderr.decode(errors="replace").strip()))
@@ -0,0 +1,228 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+
+logger = logging.getLogger("springfield-csi")
+
+# <sys/mount.h>
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_SYNCHRONOUS = 16
+MS_REMOUNT = 32
+MS_DIRSYNC = 128
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+MS_BIND = 4096
+MS_REC = 16384
+MS_RELATIME = 1 << 21
+MS_STRICTATIME = 1 << 24
+
+MNT_FORCE = 1
+MNT_DETACH = 2
+UMOUNT_NOFOLLOW = 8
+
+# mount(8) options that are flags rather than filesystem data.
+FLAG_OPTIONS = {
+    "ro": (MS_RDONLY, True),
+    "rw": (MS_RDONLY, False),
+    "nosuid": (MS_NOSUID, True),
+    "suid": (MS_NOSUID, False),
+    "nodev": (MS_NODEV, True),
+    "dev": (MS_NODEV, False),
+    "noexec": (MS_NOEXEC, True),
+    "exec": (MS_NOEXEC, False),
+    "sync": (MS_SYNCHRONOUS, True),
+    "async": (MS_SYNCHRONOUS, False),
+    "dirsync": (MS_DIRSYNC, True),
+    "noatime": (MS_NOATIME, True),
+    "atime": (MS_NOATIME, False),
+    "nodiratime": (MS_NODIRATIME, True),
+    "diratime": (MS_NODIRATIME, False),
+    "relatime": (MS_RELATIME, True),
+    "norelatime": (MS_RELATIME, False),
+    "strictatime": (MS_STRICTATIME, True),
+    "defaults": (0, True),
+}
+
+# (offset, magic) of the superblocks mount(8) would otherwise find with blkid.
+SUPERBLOCKS = [
+    ("xfs", 0, b"XFSB"),
+    ("btrfs", 0x10040, b"_BHRfS_M"),
+    ("ext4", 0x438, b"\x53\xef"),
+]
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+_libc.mount.argtypes = [
+    ctypes.c_char_p,
+    ctypes.c_char_p,
+    ctypes.c_char_p,
+    ctypes.c_ulong,
+    ctypes.c_char_p,
+]
+_libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+
+
+class MountError(OSError):
+    """
+    A failed mount(2) or umount2(2).  An OSError, so callers catching
+    those keep working.
+    """
+
+
+class MountBusyError(MountError):
+    """The target is in use, or the source is already mounted there."""
+
+
+class MountNotFoundError(MountError):
+    """The source or target does not exist."""
+
+
+class MountPermissionError(MountError):
+    pass
+
+
+class NotMountedError(MountError):
+    """umount2() of a path that is not a mount point."""
+
+
+class UnknownFilesystemError(MountError):
+    """No filesystem could be detected, or the kernel lacks it."""
+
+
+_ERRORS = {
+    errno.EBUSY: MountBusyError,
+    errno.ENOENT: MountNotFoundError,
+    errno.ENOTDIR: MountNotFoundError,
+    errno.ENXIO: MountNotFoundError,
+    errno.EPERM: MountPermissionError,
+    errno.EACCES: MountPermissionError,
+    errno.ENODEV: UnknownFilesystemError,
+}
+
+
+def _error(op, path, umount=False):
+    code = ctypes.get_errno()
+    if umount and code == errno.EINVAL:
+        cls = NotMountedError
+    else:
+        cls = _ERRORS.get(code, MountError)
+    return cls(code, "%s: %s" % (op, os.strerror(code)), path)
+
+
+def _bytes(value):
+    if value is None:
+        return None
+    return os.fsencode(value)
+
+
+def parse_options(options):
+    """
+    Split mount(8) style options, e.g. the mount_flags of a
+    VolumeCapability, into mount(2) flags and filesystem data.
+    :return: (flags, data)
+    """
+    flags = 0
+    data = list()
+    for option in options:
+        for word in option.split(","):
+            if not word:
+                continue
+            if word in FLAG_OPTIONS:
+                flag, on = FLAG_OPTIONS[word]
+                flags = flags | flag if on else flags & ~flag
+            else:
+                data.append(word)
+    return flags, ",".join(data)
+
+
+def probe_fstype(device):
+    """
+    :return: the filesystem on device, from its superblock
+    :raises UnknownFilesystemError: if it is none of SUPERBLOCKS
+    """
+    with open(device, "rb") as f:
+        for fstype, offset, magic in SUPERBLOCKS:
+            f.seek(offset)
+            if f.read(len(magic)) == magic:
+                return fstype
+    raise UnknownFilesystemError(errno.EINVAL, "no known filesystem", device)
+
+
+def mount(source, target, fstype=None, flags=0, data=""):
+    """
+    mount(2) a filesystem, detecting its type if not given.
+    :raises MountError: or one of its subclasses
+    """
+    if fstype is None:
+        fstype = probe_fstype(source)
+    logger.debug("mount(): %s on %s type %s flags %#x %s", source, target, fstype, flags, data)
+    if _libc.mount(_bytes(source), _bytes(target), _bytes(fstype), flags, _bytes(data or None)) != 0:
+        raise _error("mount %s" % source, target)
+
+
+def bind_mount(source, target, flags=0):
+    """
+    Bind source on target.  The kernel ignores per-mount flags such as
+    MS_RDONLY on the bind itself, so they are applied with a remount.
+    :raises MountError: or one of its subclasses
+    """
+    logger.debug("bind_mount(): %s on %s flags %#x", source, target, flags)
+    if _libc.mount(_bytes(source), _bytes(target), None, MS_BIND, None) != 0:
+        raise _error("bind mount %s" % source, target)
+    if flags:
+        try:
+            remount(target, flags, bind=True)
+        except MountError:
+            umount(target, detach=True)
+            raise
+
+
+def remount(target, flags=0, data="", bind=False):
+    """
+    Change the flags, or with bind=False the filesystem options, of a
+    mount.
+    :raises MountError: or one of its subclasses
+    """
+    flags |= MS_REMOUNT
+    if bind:
+        flags |= MS_BIND
+    if _libc.mount(None, _bytes(target), None, flags, _bytes(data or None)) != 0:
+        raise _error("remount", target)
+
+
+def umount(target, detach=False, force=False):
+    """
+    umount2(2) target without following a symlink in its last component.
+    :raises NotMountedError: if target is not a mount point
+    :raises MountError: or another of its subclasses
+    """
+    flags = UMOUNT_NOFOLLOW
+    if detach:
+        flags |= MNT_DETACH
+    if force:
+        flags |= MNT_FORCE
+    logger.debug("umount(): %s flags %#x", target, flags)
+    if _libc.umount2(_bytes(target), flags) != 0:
+        raise _error("umount", target, umount=True)
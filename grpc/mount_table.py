@@ -0,0 +1,199 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import logging
+import os
+import re
+import select
+import threading
+
+logger = logging.getLogger("springfield-csi")
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+def _unescape(field):
+    # Spaces, tabs, newlines and backslashes are octal escaped.
+    return _ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+class MountEntry:
+    """
+    One line of mountinfo.  `device` is the (major, minor) of the
+    filesystem, shared by the mount and all its binds, `root` the
+    directory of it mounted at `target`.  `parent_id` is the mount it sits
+    on, the one it hides if both are on the same target.
+    """
+
+    def __init__(self, mount_id, device, root, target, options, fstype, source, parent_id=None):
+        self.mount_id = mount_id
+        self.parent_id = parent_id
+        self.device = device
+        self.root = root
+        self.target = target
+        self.options = options
+        self.fstype = fstype
+        self.source = source
+
+    @classmethod
+    def parse(cls, line):
+        fields = line.split()
+        # Optional fields end with a lone "-".
+        separator = fields.index("-", 6)
+        major, minor = fields[2].split(":")
+        return cls(
+            int(fields[0]),
+            (int(major), int(minor)),
+            _unescape(fields[3]),
+            _unescape(fields[4]),
+            fields[5].split(","),
+            fields[separator + 1],
+            _unescape(fields[separator + 2]),
+            int(fields[1]),
+        )
+
+    @property
+    def readonly(self):
+        return "ro" in self.options
+
+
+def _stack(entries):
+    """
+    Order the mounts on one target bottom to top: every mount comes after
+    the one it was mounted on.
+    :return: list of MountEntry, the visible one last
+    """
+    ids = set(entry.mount_id for entry in entries)
+    children = dict()
+    for entry in sorted(entries, key=lambda entry: entry.mount_id):
+        parent = entry.parent_id if entry.parent_id in ids and entry.parent_id != entry.mount_id else None
+        children.setdefault(parent, list()).append(entry)
+
+    order = list()
+    pending = list(children.get(None, ()))
+    while pending:
+        entry = pending.pop(0)
+        order.append(entry)
+        pending.extend(children.get(entry.mount_id, ()))
+
+    if len(order) < len(entries):
+        # Only a parent loop, which the kernel does not create, lands here.
+        seen = set(entry.mount_id for entry in order)
+        order.extend(
+            entry for entry in sorted(entries, key=lambda entry: entry.mount_id) if entry.mount_id not in seen
+        )
+    return order
+
+
+class MountTable:
+    """
+    The node's mounts, indexed by mount ID, target path and device.
+    poll() on mountinfo reports any change to the mount namespace, so
+    lookups only re-read it after one, and only re-index the lines that
+    changed.
+    """
+
+    def __init__(self, path=MOUNTINFO):
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDONLY)
+        self._poller = select.poll()
+        self._poller.register(self._fd, select.POLLPRI | select.POLLERR)
+        self._lines = dict()
+        self._entries = dict()
+        self._by_target = dict()
+        self._by_device = dict()
+        with self._lock:
+            self._reload()
+
+    def _read(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        chunks = list()
+        while True:
+            chunk = os.read(self._fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks).decode(errors="surrogateescape").splitlines()
+
+    def _reload(self):
+        lines = dict()
+        for line in self._read():
+            lines[int(line.split(None, 1)[0])] = line
+
+        for mount_id in set(self._lines) - set(lines):
+            self._unindex(mount_id)
+        for mount_id, line in lines.items():
+            old = self._lines.get(mount_id)
+            if old == line:
+                continue
+            if old is not None:
+                self._unindex(mount_id)
+            self._index(MountEntry.parse(line))
+        self._lines = lines
+
+    def _index(self, entry):
+        self._entries[entry.mount_id] = entry
+        self._by_target.setdefault(entry.target, dict())[entry.mount_id] = entry
+        self._by_device.setdefault(entry.device, dict())[entry.mount_id] = entry
+
+    def _unindex(self, mount_id):
+        entry = self._entries.pop(mount_id)
+        for index, key in [(self._by_target, entry.target), (self._by_device, entry.device)]:
+            entries = index[key]
+            del entries[mount_id]
+            if not entries:
+                del index[key]
+
+    def _sync(self):
+        if self._poller.poll(0):
+            self._reload()
+
+    def stacked(self, target):
+        """
+        :return: the MountEntries on target, the visible one last
+        """
+        target = os.path.normpath(target)
+        with self._lock:
+            self._sync()
+            return _stack(list(self._by_target.get(target, dict()).values()))
+
+    def get(self, target):
+        """
+        :return: the MountEntry visible on target, or None
+        """
+        entries = self.stacked(target)
+        return entries[-1] if entries else None
+
+    def is_mount(self, target):
+        return self.get(target) is not None
+
+    def by_device(self, rdev):
+        """
+        :param rdev: st_rdev of a block device
+        :return: the MountEntries of the filesystem on it, binds included
+        """
+        with self._lock:
+            self._sync()
+            entries = self._by_device.get((os.major(rdev), os.minor(rdev)), dict())
+            return sorted(entries.values(), key=lambda entry: entry.mount_id)
+
+    def close(self):
+        self._poller.unregister(self._fd)
+        os.close(self._fd)
@@ -39,37 +39,209 @@ from csi_pb2 import (
 
 import grpc
 
-import controller
 import logging
 import os
-from sh import mount, umount
+import sh
+
+from singleflight import SingleFlight
+from mount_table import MountTable
+from volume_stats import StatsSampler, DEFAULT_SAMPLE_INTERVAL
+from node_registry import NodeRegistry
+from state_store import StateStore, DEFAULT_STATE_DIR, NODE_TABLES
+from access_modes import check_mode, Mode, READ_ONLY_MODES
+from block_queue import apply_queue_settings
+from mount_syscalls import (
+    MountError,
+    MountNotFoundError,
+    MountPermissionError,
+    NotMountedError,
+    UnknownFilesystemError,
+    MS_RDONLY,
+    mount,
+    bind_mount,
+    umount,
+    parse_options,
+)
 
 logger = logging.getLogger("springfield-csi")
 
 # CSI Spec https://github.com/container-storage-interface/spec/blob/master/spec.md
 
 
+def device_size(device):
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def grow_filesystem(path, fstype):
+    """
+    Grow the filesystem mounted on path to fill its device, online.
+    """
+    if fstype == "xfs":
+        sh.xfs_growfs(path)
+    elif fstype == "btrfs":
+        sh.btrfs("filesystem", "resize", "max", path)
+    else:
+        raise ValueError("Cannot grow %s filesystems" % fstype)
+
+
+def mount_status(e):
+    """
+    :return: the grpc.StatusCode to report a MountError with
+    """
+    if isinstance(e, MountNotFoundError):
+        return grpc.StatusCode.NOT_FOUND
+    if isinstance(e, MountPermissionError):
+        return grpc.StatusCode.PERMISSION_DENIED
+    if isinstance(e, UnknownFilesystemError):
+        return grpc.StatusCode.FAILED_PRECONDITION
+    return grpc.StatusCode.INTERNAL
+
+
 class SpringfieldNodeService(NodeServicer):
-    def __init__(self, nodeid):
+    def __init__(self, nodeid, stats_interval=DEFAULT_SAMPLE_INTERVAL, state_dir=DEFAULT_STATE_DIR):
         self.nodeid = nodeid
+        self.state_dir = state_dir
+        self.inflight = SingleFlight()
+        self.mounts = MountTable()
+        self.stats = StatsSampler(stats_interval)
+        self.registry = NodeRegistry()
+
+    def setup_node(self):
+        store = StateStore(os.path.join(self.state_dir, "node.db"), tables=NODE_TABLES)
+        self.registry.open(store)
+        self.restore_volumes()
+        self.stats.start()
+
+    def restore_volumes(self):
+        """
+        Check the registry against the mount table after a restart: forget
+        the targets that were unmounted meanwhile and resume sampling the
+        volumes still staged.
+        """
+        for volume in self.registry.snapshot():
+            for target in list(volume.targets):
+                if not self.mounts.is_mount(target):
+                    logger.info("restore_volumes: %s is no longer published on %s", volume.volume_id, target)
+                    self.registry.unpublish(volume.volume_id, target)
+            if volume.block:
+                self.track_block(volume.volume_id, volume.device)
+            elif self.mounts.is_mount(volume.staging_path):
+                self.track_staged(volume.volume_id, volume.staging_path)
+            elif not volume.targets:
+                logger.info("restore_volumes: %s is no longer staged", volume.volume_id)
+                self.registry.unstage(volume.volume_id)
+
+    def track_staged(self, volume_id, staging_target_path):
+        """
+        Have the stats sampler follow the filesystem staged for volume_id.
+        """
+        staged = self.mounts.get(staging_target_path)
+        if staged is not None:
+            self.stats.track(volume_id, staging_target_path, os.makedev(*staged.device))
+
+    def track_block(self, volume_id, dev_path):
+        try:
+            self.stats.track(volume_id, None, os.stat(dev_path).st_rdev)
+        except FileNotFoundError:
+            logger.warning("track_block: %s of %s is gone", dev_path, volume_id)
+
+    def apply_queue(self, volume, volume_context):
+        """
+        Apply the queue settings of a volume's StorageClass to its device.
+        """
+        if volume is None:
+            return
+        try:
+            rdev = os.stat(volume.device).st_rdev
+        except FileNotFoundError:
+            return
+        applied = apply_queue_settings(rdev, volume_context)
+        if applied:
+            logger.info("apply_queue: %s: set %s", volume.volume_id, ", ".join(applied))
+
+    def unmount_all(self, target):
+        """
+        Unmount target, including any mounts stacked on it by retries.
+        :raises MountError: if one cannot be unmounted
+        """
+        for _ in self.mounts.stacked(target):
+            try:
+                umount(target)
+            except NotMountedError:
+                break
 
     def NodeStageVolume(self, request, context):
         logger.info("NodeStageVolume() : ", request.publish_context)
         
         staging_target_path = request.staging_target_path
         dev_path = request.publish_context["block_path"].replace("dev","hostdev", 1)
-        exists = os.path.exists(staging_target_path)
-        if not exists:
-            os.makedirs(staging_target_path)
 
-        logger.info("mount :" + dev_path + " on: " + staging_target_path )
+        capability = request.volume_capability
+        error = check_mode(capability.access_mode.mode)
+        if error is not None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, error)
+
         try:
-            mount(dev_path, staging_target_path)
-        except OSError as e:
-          logger.warning(
-                "Warining mount failed: %s : %s" % (staging_target_path, e.strerror)
-            )
+            rdev = os.stat(dev_path).st_rdev
+        except FileNotFoundError:
+            context.abort(grpc.StatusCode.NOT_FOUND, "%s does not exist" % dev_path)
+
+        if capability.WhichOneof("access_type") == "block":
+            # Nothing to mount, each publish binds the device itself.
+            self.registry.stage(request.volume_id, dev_path, staging_target_path, "", block=True)
+            self.stats.track(request.volume_id, None, rdev)
+            return NodeStageVolumeResponse()
+
+        # btrfs clones share the pool's device and differ in the subvolume.
+        subvol = request.publish_context.get("subvol") or request.volume_context.get("subvol")
+
+        staged = self.mounts.get(staging_target_path)
+        if staged is not None:
+            # btrfs subvolumes are mounted with an anonymous device number.
+            if (staged.source != dev_path and staged.device != (os.major(rdev), os.minor(rdev))) or (
+                subvol and staged.root != "/" + subvol
+            ):
+                context.abort(
+                    grpc.StatusCode.ALREADY_EXISTS,
+                    "%s is mounted from %s" % (staging_target_path, staged.source),
+                )
+            logger.info("NodeStageVolume: %s is already mounted", staging_target_path)
+            self.registry.stage(request.volume_id, dev_path, staging_target_path, staged.fstype)
+            self.track_staged(request.volume_id, staging_target_path)
+            return NodeStageVolumeResponse()
+
+        elsewhere = [entry.target for entry in self.mounts.by_device(rdev)]
+        if elsewhere:
+            logger.warning("NodeStageVolume: %s is already mounted on %s", dev_path, elsewhere)
+
+        os.makedirs(staging_target_path, exist_ok=True)
+
+        fstype = capability.mount.fs_type or request.volume_context.get("fs_type") or None
+        flags, data = parse_options(capability.mount.mount_flags)
+        if subvol:
+            data = ",".join(filter(None, [data, "subvol=%s" % subvol]))
+        if capability.access_mode.mode in READ_ONLY_MODES:
+            flags |= MS_RDONLY
 
+        logger.info("mount :" + dev_path + " on: " + staging_target_path )
+        try:
+            mount(dev_path, staging_target_path, fstype, flags, data)
+        except MountError as e:
+            logger.error("NodeStageVolume: %s", e)
+            context.abort(mount_status(e), str(e))
+
+        mounted = self.mounts.get(staging_target_path)
+        self.registry.stage(
+            request.volume_id,
+            dev_path,
+            staging_target_path,
+            mounted.fstype if mounted is not None else fstype or "",
+        )
+        self.track_staged(request.volume_id, staging_target_path)
         return NodeStageVolumeResponse()
     
     def NodeUnstageVolume(self, request, context):
@@ -78,14 +250,39 @@ class SpringfieldNodeService(NodeServicer):
 
         staging_target_path = request.staging_target_path
 
-        if not os.path.ismount(staging_target_path):
-            logger.warning('NodeUnpublishVolume: {} is already un-mounted'.format(staging_target_path))
+        # Every publish is a bind of the staging mount, it stays until the
+        # last one is gone.
+        volume = self.registry.get(request.volume_id)
+        if volume is not None:
+            for target in list(volume.targets):
+                if not self.mounts.is_mount(target):
+                    self.registry.unpublish(request.volume_id, target)
+            if volume.refcount:
+                context.abort(
+                    grpc.StatusCode.FAILED_PRECONDITION,
+                    "%s is still published on %s" % (request.volume_id, ", ".join(volume.targets)),
+                )
+
+        self.stats.untrack(request.volume_id)
+
+        if volume is not None and volume.block:
+            logger.debug("NodeUnstageVolume: %s is a block volume, nothing to unmount", request.volume_id)
+        elif not self.mounts.is_mount(staging_target_path):
+            logger.warning('NodeUnstageVolume: {} is already un-mounted'.format(staging_target_path))
         else:
-            umount(staging_target_path)
+            try:
+                self.unmount_all(staging_target_path)
+            except MountError as e:
+                logger.error("NodeUnstageVolume: %s", e)
+                context.abort(mount_status(e), str(e))
 
-        if os.path.isdir(staging_target_path):
-            logger.debug('NodeUnstageVolume removing stage dir: {}'.format(staging_target_path))
+        self.registry.unstage(request.volume_id)
+
+        try:
             os.rmdir(staging_target_path)
+            logger.debug('NodeUnstageVolume removed stage dir: {}'.format(staging_target_path))
+        except FileNotFoundError:
+            pass
 
         return NodeUnstageVolumeResponse()
     
@@ -116,27 +313,109 @@ class SpringfieldNodeService(NodeServicer):
         #     )
 
 
-        if volume_capability.access_mode.mode not in [
-            csi_pb2.VolumeCapability.AccessMode.Mode.SINGLE_NODE_WRITER
-        ]:
+        error = check_mode(volume_capability.access_mode.mode)
+        if error is not None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, error)
+
+        readonly = (
+            request.readonly
+            or volume_capability.access_mode.mode in READ_ONLY_MODES
+        )
+
+        volume = self.registry.get(request.volume_id)
+        if volume_capability.WhichOneof("access_type") == "block":
+            return self.publish_block(request, context, volume, readonly)
+
+        staged = self.mounts.get(staging_target_path)
+        if staged is None:
             context.abort(
-                grpc.StatusCode.INVALID_ARGUMENT,
-                "Unsupported access mode: {csi_pb2.VolumeCapability.AccessMode.Mode.Name(volume_capability.access_mode.mode)}",
+                grpc.StatusCode.FAILED_PRECONDITION,
+                "%s is not staged" % staging_target_path,
             )
 
-        exists = os.path.exists(publish_path)
-        if not exists:
-            os.makedirs(publish_path)
-
+        published = self.mounts.get(publish_path)
+        if published is not None:
+            if published.device != staged.device or published.readonly != (readonly or staged.readonly):
+                context.abort(
+                    grpc.StatusCode.ALREADY_EXISTS,
+                    "%s is mounted from %s with other flags" % (publish_path, published.source),
+                )
+            logger.info("NodePublishVolume: %s is already mounted", publish_path)
+            self.registry.publish(request.volume_id, publish_path, readonly)
+            return NodePublishVolumeResponse()
+
+        self.claim_target(request, context, readonly)
+        os.makedirs(publish_path, exist_ok=True)
+
+        # A read-only publish is a bind remounted read-only, the staged
+        # filesystem is never mounted a second time.
+        flags, _ = parse_options(volume_capability.mount.mount_flags)
+        if readonly:
+            flags |= MS_RDONLY
 
         logger.info("mount :" + staging_target_path + " on: " + publish_path + " with : --bind")
         try:
-            mount(staging_target_path, publish_path, "--bind")
-        except OSError as e:
-          logger.warning(
-                "Warining mount failed: %s : %s" % (staging_target_path, e.strerror)
+            bind_mount(staging_target_path, publish_path, flags)
+        except MountError as e:
+            logger.error("NodePublishVolume: %s", e)
+            self.registry.unpublish(request.volume_id, publish_path)
+            context.abort(mount_status(e), str(e))
+
+        self.registry.publish(request.volume_id, publish_path, readonly)
+        self.apply_queue(volume, request.volume_context)
+        return NodePublishVolumeResponse()
+
+    def claim_target(self, request, context, readonly):
+        """
+        A SINGLE_NODE_SINGLE_WRITER volume may be published on one target
+        only.  The target is recorded before it is mounted.
+        """
+        if request.volume_capability.access_mode.mode != Mode.SINGLE_NODE_SINGLE_WRITER:
+            return
+        if not self.registry.claim(request.volume_id, request.target_path, readonly):
+            context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION,
+                "%s is already published on another target" % request.volume_id,
+            )
+
+    def publish_block(self, request, context, volume, readonly):
+        """
+        The block half of NodePublishVolume: bind the staged device node
+        on the target file.
+        """
+        publish_path = request.target_path
+        if volume is None or not volume.block:
+            context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION,
+                "%s is not staged as a block volume" % request.volume_id,
             )
 
+        if self.mounts.is_mount(publish_path):
+            if self.registry.by_path(publish_path) is not volume:
+                context.abort(
+                    grpc.StatusCode.ALREADY_EXISTS,
+                    "%s is already in use" % publish_path,
+                )
+            logger.info("NodePublishVolume: %s is already bound", publish_path)
+            return NodePublishVolumeResponse()
+
+        self.claim_target(request, context, readonly)
+        os.makedirs(os.path.dirname(publish_path), exist_ok=True)
+        # A bind of a device node needs a file to cover.
+        with open(publish_path, "a"):
+            pass
+
+        flags = MS_RDONLY if readonly else 0
+        logger.info("mount :" + volume.device + " on: " + publish_path + " with : --bind")
+        try:
+            bind_mount(volume.device, publish_path, flags)
+        except MountError as e:
+            logger.error("NodePublishVolume: %s", e)
+            self.registry.unpublish(request.volume_id, publish_path)
+            context.abort(mount_status(e), str(e))
+
+        self.registry.publish(request.volume_id, publish_path, readonly)
+        self.apply_queue(volume, request.volume_context)
         return NodePublishVolumeResponse()
 
     def NodeUnpublishVolume(self, request, context):
@@ -147,18 +426,27 @@ class SpringfieldNodeService(NodeServicer):
 
         if request.target_path == None or request.target_path == "":
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include target_path")
-        if not os.path.exists(request.target_path):
-            context.abort(
-                grpc.StatusCode.NOT_FOUND, "request.target_path does not exits"
-            )
         volume_id = request.volume_id
         target_path = request.target_path
+        volume = self.registry.get(volume_id)
 
-        if not os.path.ismount(target_path):
+        if not self.mounts.is_mount(target_path):
             logger.warning('NodeUnpublishVolume: {} is already un-mounted'.format(target_path))
         else:
-            umount(target_path)
-
+            try:
+                self.unmount_all(target_path)
+            except MountError as e:
+                logger.error("NodeUnpublishVolume: %s", e)
+                context.abort(mount_status(e), str(e))
+
+        if volume is not None and volume.block:
+            # The file publish_block() created to bind the device on.
+            try:
+                os.remove(target_path)
+            except FileNotFoundError:
+                pass
+
+        self.registry.unpublish(volume_id, target_path)
         return NodeUnpublishVolumeResponse()
 
     def NodeGetCapabilities(self, request, context):
@@ -177,7 +465,13 @@ class SpringfieldNodeService(NodeServicer):
             rpc=NodeServiceCapability.RPC(type=NodeServiceCapability.RPC.EXPAND_VOLUME)
         )
 
-        capabilities = [get_volume_stats, stage_unstage, expand_volume]
+        single_node_multi_writer = NodeServiceCapability(
+            rpc=NodeServiceCapability.RPC(
+                type=NodeServiceCapability.RPC.SINGLE_NODE_MULTI_WRITER
+            )
+        )
+
+        capabilities = [get_volume_stats, stage_unstage, expand_volume, single_node_multi_writer]
         return NodeGetCapabilitiesResponse(capabilities=capabilities)
 
     def NodeGetInfo(self, request, context):
@@ -188,9 +482,37 @@ class SpringfieldNodeService(NodeServicer):
         )
 
     def NodeExpandVolume(self, request, context):
-        logger.info("NodeExpandVolume() called, which is not implemented")
+        logger.info("NodeExpandVolume()")
+        if request.volume_id == None or request.volume_id == "":
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include volume_id")
 
-        return NodeExpandVolumeResponse()
+        # The filesystem is mounted on the staging path, the publish path
+        # is a bind mount of it.
+        path = request.staging_target_path or request.volume_path
+        if path == None or path == "":
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include volume_path")
+
+        volume = self.registry.get(request.volume_id)
+        if volume is not None and volume.block:
+            # The controller grew the device, there is no filesystem.
+            return NodeExpandVolumeResponse(capacity_bytes=device_size(volume.device))
+
+        mounted = self.mounts.get(path)
+        if mounted is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, "%s is not mounted" % path)
+        device, fstype = mounted.source, mounted.fstype
+
+        if request.volume_capability.WhichOneof("access_type") != "block":
+            # Concurrent requests for one volume share a single grow.
+            try:
+                self.inflight.do(path, grow_filesystem, path, fstype)
+            except ValueError as e:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+            except sh.ErrorReturnCode as e:
+                logger.error("NodeExpandVolume: %s: %s", path, e.stderr)
+                context.abort(grpc.StatusCode.INTERNAL, "Failed to grow filesystem on %s" % path)
+
+        return NodeExpandVolumeResponse(capacity_bytes=device_size(device))
 
     def NodeGetVolumeStats(self, request, context):
         logger.info("NodeGetVolumeStats()")
@@ -200,18 +522,74 @@ class SpringfieldNodeService(NodeServicer):
         if request.volume_path == None or request.volume_path == "":
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Must include volume_id")
 
-        volume_map = controller.get_volume(request.volume_id)
+        volume = self.registry.get(request.volume_id)
+        if volume is not None and self.registry.by_path(request.volume_path) is not volume:
+            context.abort(
+                grpc.StatusCode.NOT_FOUND,
+                "%s is not volume %s" % (request.volume_path, request.volume_id),
+            )
 
-        if volume_map == None:
+        if volume is not None and volume.block:
+            return self.block_stats(volume)
+
+        mounted = self.mounts.get(request.volume_path)
+        if mounted is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, "%s is not mounted" % request.volume_path)
+
+        tracked = self.stats.tracked(request.volume_id)
+        if tracked is None:
+            # Staged before this node service started, sample it once now
+            # and in the background from then on.
+            self.stats.track(request.volume_id, request.volume_path, os.makedev(*mounted.device))
+        elif (os.major(tracked[1]), os.minor(tracked[1])) != mounted.device:
             context.abort(
-                grpc.StatusCode.NOT_FOUND, "request.target_path does not exits"
+                grpc.StatusCode.NOT_FOUND,
+                "%s is not volume %s" % (request.volume_path, request.volume_id),
             )
 
-        if volume_map.published_path != request.volume_path:
-            context.abort(grpc.StatusCode.NOT_FOUND, "Invalid volume path")
-        usage = []
-        usage.append(VolumeUsage(available=100, total=10000, used=9900, unit=1))
+        sample = self.stats.get(request.volume_id) or self.stats.sample(request.volume_id)
+        if sample.error is not None:
+            condition = VolumeCondition(abnormal=True, message=sample.error)
+            return NodeGetVolumeStatsResponse(volume_condition=condition)
+
+        usage = [
+            VolumeUsage(
+                available=sample.bytes_available,
+                total=sample.bytes_total,
+                used=sample.bytes_used,
+                unit=VolumeUsage.BYTES,
+            ),
+            VolumeUsage(
+                available=sample.inodes_free,
+                total=sample.inodes_total,
+                used=sample.inodes_used,
+                unit=VolumeUsage.INODES,
+            ),
+        ]
+        condition = VolumeCondition(
+            abnormal=False,
+            message="Ok, %d bytes read, %d written, %d I/Os in flight"
+            % (sample.read_bytes, sample.write_bytes, sample.in_flight),
+        )
 
-        condition = VolumeCondition(abnormal=False, message="Ok")
+        return NodeGetVolumeStatsResponse(usage=usage, volume_condition=condition)
 
+    def block_stats(self, volume):
+        """
+        NodeGetVolumeStats of a raw block volume, which only has a size.
+        """
+        sample = self.stats.get(volume.volume_id) or self.stats.sample(volume.volume_id)
+        if sample is None:
+            self.track_block(volume.volume_id, volume.device)
+            sample = self.stats.sample(volume.volume_id)
+        if sample is None or sample.error is not None:
+            message = sample.error if sample is not None else "%s is gone" % volume.device
+            return NodeGetVolumeStatsResponse(volume_condition=VolumeCondition(abnormal=True, message=message))
+
+        usage = [VolumeUsage(total=sample.bytes_total, unit=VolumeUsage.BYTES)]
+        condition = VolumeCondition(
+            abnormal=False,
+            message="Ok, %d bytes read, %d written, %d I/Os in flight"
+            % (sample.read_bytes, sample.write_bytes, sample.in_flight),
+        )
         return NodeGetVolumeStatsResponse(usage=usage, volume_condition=condition)
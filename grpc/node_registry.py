@@ -0,0 +1,197 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import logging
+import threading
+
+from state_store import NODE_VOLUMES
+
+logger = logging.getLogger("springfield-csi")
+
+
+class NodeVolume:
+    """
+    A volume staged on this node: its device, staging path and the
+    targets it is published on, each with its read-only flag.  Raw
+    `block` volumes are not mounted on their staging path, their device
+    is bound on each target.
+    """
+
+    def __init__(self, volume_id, device, staging_path, fs_type, targets=None, block=False):
+        self.volume_id = volume_id
+        self.device = device
+        self.staging_path = staging_path
+        self.fs_type = fs_type
+        self.targets = dict(targets or {})
+        self.block = block
+
+    @property
+    def refcount(self):
+        return len(self.targets)
+
+    def to_record(self):
+        return {
+            "volume_id": self.volume_id,
+            "device": self.device,
+            "staging_path": self.staging_path,
+            "fs_type": self.fs_type,
+            "targets": self.targets,
+            "block": self.block,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            record["volume_id"],
+            record["device"],
+            record["staging_path"],
+            record.get("fs_type", ""),
+            record.get("targets"),
+            record.get("block", False),
+        )
+
+
+class NodeRegistry:
+    """
+    The volumes staged and published on this node, indexed by volume_id
+    and by path.  Every change is written through to the store in its
+    own transaction, so a restarted plugin finds what it had mounted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._volumes = dict()
+        self._by_path = dict()
+        self.store = None
+
+    def __len__(self):
+        return len(self._volumes)
+
+    def open(self, store):
+        """
+        Load the registry from store and keep it up to date there.
+        """
+        volumes = [NodeVolume.from_record(record) for record in store.load(NODE_VOLUMES).values()]
+        with self._lock:
+            self.store = store
+            for volume in volumes:
+                self._add(volume)
+        logger.info("NodeRegistry: loaded %d volumes", len(volumes))
+
+    def _add(self, volume):
+        self._volumes[volume.volume_id] = volume
+        self._by_path[volume.staging_path] = volume.volume_id
+        for target in volume.targets:
+            self._by_path[target] = volume.volume_id
+
+    def _save(self, volume):
+        if self.store is not None:
+            self.store.put(NODE_VOLUMES, volume.volume_id, volume.to_record())
+
+    def stage(self, volume_id, device, staging_path, fs_type, block=False):
+        """
+        Record volume_id as staged, keeping the targets of an earlier stage.
+        :return: its NodeVolume
+        """
+        with self._lock:
+            volume = self._volumes.get(volume_id)
+            if volume is None:
+                volume = NodeVolume(volume_id, device, staging_path, fs_type)
+            elif volume.staging_path != staging_path:
+                self._by_path.pop(volume.staging_path, None)
+                volume.staging_path = staging_path
+            volume.device = device
+            volume.fs_type = fs_type
+            volume.block = block
+            self._add(volume)
+            self._save(volume)
+            return volume
+
+    def unstage(self, volume_id):
+        """
+        :return: the removed NodeVolume, or None
+        """
+        with self._lock:
+            volume = self._volumes.pop(volume_id, None)
+            if volume is None:
+                return None
+            for path in [volume.staging_path] + list(volume.targets):
+                self._by_path.pop(path, None)
+            if self.store is not None:
+                self.store.delete(NODE_VOLUMES, volume_id)
+            return volume
+
+    def publish(self, volume_id, target, readonly=False):
+        """
+        :return: the NodeVolume, or None if volume_id is not staged
+        """
+        with self._lock:
+            volume = self._volumes.get(volume_id)
+            if volume is None:
+                return None
+            volume.targets[target] = readonly
+            self._by_path[target] = volume_id
+            self._save(volume)
+            return volume
+
+    def claim(self, volume_id, target, readonly=False):
+        """
+        Publish volume_id on target unless it is already published on
+        another target, for volumes that may have one target only.  Meant
+        to run before target is mounted, so two publishes cannot both
+        get through.
+        :return: False if another target has the volume
+        """
+        with self._lock:
+            volume = self._volumes.get(volume_id)
+            if volume is None:
+                return True
+            if any(path != target for path in volume.targets):
+                return False
+            volume.targets[target] = readonly
+            self._by_path[target] = volume_id
+            self._save(volume)
+            return True
+
+    def unpublish(self, volume_id, target):
+        """
+        :return: the NodeVolume, or None if volume_id is not staged
+        """
+        with self._lock:
+            volume = self._volumes.get(volume_id)
+            if volume is None:
+                return None
+            if volume.targets.pop(target, None) is not None:
+                self._by_path.pop(target, None)
+                self._save(volume)
+            return volume
+
+    def get(self, volume_id):
+        return self._volumes.get(volume_id)
+
+    def by_path(self, path):
+        """
+        :return: the NodeVolume staged or published on path, or None
+        """
+        with self._lock:
+            volume_id = self._by_path.get(path)
+            return self._volumes.get(volume_id) if volume_id is not None else None
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._volumes.values())
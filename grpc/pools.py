@@ -0,0 +1,372 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import hashlib
+import logging
+import threading
+
+import blivet_interface
+from blivet_interface import StorageType, SIZE_POLICY_MAX, DEVICE_INTERFACE
+from allocator import ExtentAllocator, BEST_FIT
+from thin_pool import THIN_POOL_LV, DEFAULT_OVERCOMMIT
+from raid_layout import RaidLayout
+
+logger = logging.getLogger("springfield-csi")
+
+POOL_PREFIX = {
+    StorageType.DEVICE_TYPE_LVM: "sflvm",
+    StorageType.DEVICE_TYPE_LVM_THINP: "sfthin",
+    StorageType.DEVICE_TYPE_MD: "sfmd",
+    StorageType.DEVICE_TYPE_BTRFS: "sfbtrfs",
+    StorageType.DEVICE_TYPE_STRATIS: "sfstratis",
+}
+
+
+class PoolError(Exception):
+    pass
+
+
+def pool_name(storage_type, disks):
+    digest = hashlib.sha1(",".join(sorted(disks)).encode()).hexdigest()[:8]
+    return "%s_%s" % (POOL_PREFIX[storage_type], digest)
+
+
+class StoragePool:
+    """
+    A long-lived container built once from the disks of a StorageClass:
+    a VG for LVM, a VG with one thin pool LV for thinp, a VG on an MD
+    array for MD, a btrfs volume or a Stratis pool.  Volumes are carved
+    out of it as LVs, thin LVs, subvolumes or Stratis filesystems.
+    """
+
+    def __init__(self, name, storage_type, disks):
+        self.name = name
+        self.storage_type = storage_type
+        self.disks = list(disks)
+        self.disk_object_paths = None
+        self.initialized = False
+        self.overcommit = DEFAULT_OVERCOMMIT
+        # The MD array level or btrfs profile all volumes share.
+        self.raid = None
+
+    @property
+    def thin(self):
+        return self.storage_type == StorageType.DEVICE_TYPE_LVM_THINP
+
+    @property
+    def shared_raid(self):
+        """
+        True if the RAID layout belongs to the pool rather than the volume.
+        """
+        return self.storage_type in [StorageType.DEVICE_TYPE_MD, StorageType.DEVICE_TYPE_BTRFS]
+
+    def raid_layout(self, raid=None):
+        """
+        :return: the RaidLayout a volume asking for `raid` gets in this pool
+        """
+        if self.shared_raid:
+            raid = self.raid
+        return raid or RaidLayout.default(self.storage_type)
+
+    def layout(self, raid=None):
+        """
+        :return: (copies, stripes, parity) of the volumes blivet builds in
+                 this pool with RaidLayout `raid`
+        """
+        raid = self.raid_layout(raid)
+        if raid is None:
+            return (1, 1, 0)
+        return raid.geometry(self.storage_type, len(self.disks))
+
+    def factory_kwargs(self, fs_name, size, raid=None):
+        # Blivet takes the disks of the whole container, not of this one
+        # volume.  Fewer disks would shrink the container, so the
+        # allocator's placement cannot be passed down.
+        kwargs = blivet_interface.factory_kwargs(
+            self.storage_type, self.disk_object_paths, fs_name, str(size)
+        )
+        kwargs["container_name"] = self.name
+        if self.thin:
+            kwargs["pool_name"] = THIN_POOL_LV
+
+        raid = self.raid_layout(raid)
+        if raid is not None:
+            kwargs.update(raid.factory_kwargs(self.storage_type))
+
+        if self.storage_type == StorageType.DEVICE_TYPE_MD:
+            # blivet's MD factory builds one array per device.  Pool the
+            # array instead and hand out linear LVs from a VG on top of it.
+            kwargs["device_type"] = StorageType.DEVICE_TYPE_LVM
+            kwargs.pop("raid_level", None)
+
+        if not self.initialized:
+            kwargs["container_size"] = SIZE_POLICY_MAX
+
+        return kwargs
+
+
+class PoolManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = dict()
+        self._disk_owner = dict()
+        self.allocator = ExtentAllocator()
+
+    def get_pool(self, storage_type, disks):
+        """
+        :return: the StoragePool for this StorageClass disk set
+        :raises PoolError: if a disk already belongs to a different pool
+        """
+        if storage_type not in POOL_PREFIX:
+            raise PoolError("Unsupported storage type: %s" % storage_type)
+        if not disks:
+            raise PoolError("StorageClass has no disks")
+
+        name = pool_name(storage_type, disks)
+        with self._lock:
+            pool = self._pools.get(name)
+            if pool is not None:
+                return pool
+
+            for disk in disks:
+                owner = self._disk_owner.get(disk)
+                if owner is not None and owner != name:
+                    raise PoolError(
+                        "Disk %s already belongs to pool %s" % (disk, owner)
+                    )
+
+            pool = StoragePool(name, storage_type, disks)
+            self._pools[name] = pool
+            for disk in disks:
+                self._disk_owner[disk] = name
+            return pool
+
+    def pools(self):
+        with self._lock:
+            return list(self._pools.values())
+
+    def to_record(self, pool):
+        record = {
+            "name": pool.name,
+            "storage_type": pool.storage_type,
+            "disks": pool.disks,
+            "initialized": pool.initialized,
+            "overcommit": pool.overcommit,
+            "raid": pool.raid.to_record() if pool.raid else None,
+        }
+        if self.allocator.has_pool(pool.name):
+            record["disk_sizes"] = self.allocator.disk_sizes(pool.name)
+        return record
+
+    def restore(self, record):
+        """
+        Re-create a pool saved with to_record().
+        """
+        pool = self.get_pool(record["storage_type"], record["disks"])
+        pool.initialized = record.get("initialized", False)
+        pool.overcommit = record.get("overcommit", DEFAULT_OVERCOMMIT)
+        pool.raid = RaidLayout.from_record(record.get("raid"))
+        if "disk_sizes" in record and not self.allocator.has_pool(pool.name):
+            self.allocator.add_pool(
+                pool.name,
+                record["disk_sizes"],
+                overcommit=pool.overcommit if pool.thin else None,
+            )
+        return pool
+
+    def get_pool_by_name(self, name):
+        with self._lock:
+            return self._pools.get(name)
+
+    def _ensure_space(self, pool):
+        if self.allocator.has_pool(pool.name):
+            return
+        disk_object_paths = blivet_interface.get_object_paths(pool.disks)
+        sizes = blivet_interface.get_properties_bulk(
+            disk_object_paths, DEVICE_INTERFACE, ["Size"]
+        )
+        self.allocator.add_pool(
+            pool.name,
+            {
+                disk: int(sizes[object_path]["Size"] or 0)
+                for disk, object_path in zip(pool.disks, disk_object_paths)
+            },
+            overcommit=pool.overcommit if pool.thin else None,
+        )
+
+    def set_overcommit(self, pool, overcommit):
+        """
+        Change how many times its size a thin pool may promise to volumes.
+        Volumes already allocated keep their space.
+        """
+        if not pool.thin or pool.overcommit == overcommit:
+            return
+        logger.info("set_overcommit(): %s %.2f -> %.2f", pool.name, pool.overcommit, overcommit)
+        pool.overcommit = overcommit
+        if self.allocator.has_pool(pool.name):
+            self.allocator.set_overcommit(pool.name, overcommit)
+
+    def configure_raid(self, pool, raid):
+        """
+        Settle the layout of a pool whose volumes share one.  The first
+        class to use the pool chooses it.
+        :raises PoolError: if the pool was already built with another one
+        """
+        if not pool.shared_raid:
+            return
+        wanted = raid or RaidLayout.default(pool.storage_type)
+        if pool.raid is None:
+            if pool.initialized and raid is not None and wanted != RaidLayout.default(pool.storage_type):
+                raise PoolError("Pool %s was built with the default layout" % pool.name)
+            pool.raid = wanted
+        elif pool.raid != wanted:
+            raise PoolError("Pool %s is built as %s, not %s" % (pool.name, pool.raid, wanted))
+
+    def allocate(self, pool, volume, size, policy=BEST_FIT, raid=None):
+        """
+        Reserve space for volume in pool.
+        :return: the size to create, rounded to the pool's extents and stripes
+        :raises AllocationError: if the pool cannot hold it
+        """
+        self._ensure_space(pool)
+        copies, stripes, parity = pool.layout(raid)
+        return self.allocator.allocate(
+            pool.name, volume, size, copies=copies, stripes=stripes, policy=policy, parity=parity
+        )
+
+    def resize(self, pool, volume, size, policy=BEST_FIT, raid=None):
+        """
+        Grow volume's reservation in pool.
+        :return: the new size, rounded like allocate()
+        :raises AllocationError: if the pool cannot hold it
+        """
+        self._ensure_space(pool)
+        copies, stripes, parity = pool.layout(raid)
+        return self.allocator.resize(
+            pool.name, volume, size, copies=copies, stripes=stripes, policy=policy, parity=parity
+        )
+
+    def round_size(self, pool, size, raid=None):
+        """
+        :return: the size allocate() and resize() would make a volume of size
+        """
+        self._ensure_space(pool)
+        _, stripes, _ = pool.layout(raid)
+        return self.allocator.round_size(pool.name, size, stripes)
+
+    def release(self, pool_name, volume):
+        self.allocator.free(pool_name, volume)
+
+    def usable(self, pool):
+        """
+        :return: (free bytes, largest allocatable volume) for pool
+        """
+        self._ensure_space(pool)
+        copies, stripes, parity = pool.layout()
+        return self.allocator.usable(pool.name, copies=copies, stripes=stripes, parity=parity)
+
+    def queue_create(self, pool, fs_name, size, raid=None):
+        """
+        Queue a new volume in pool, initializing the pool's disks first if
+        this is the first volume.  Meant to run under GroupCommit, which
+        serializes the calls.  If the factory fails the disks stay queued
+        for initialization and the pool counts as initialized, the next
+        volume goes onto them.
+        :return: object path of the new device
+        """
+        logger.info("queue_create(): pool = %s, name = %s", pool.name, fs_name)
+
+        if not pool.initialized and self.container_exists(pool):
+            logger.info("Adopting existing pool %s", pool.name)
+            pool.initialized = True
+
+        if pool.initialized:
+            if pool.disk_object_paths is None:
+                pool.disk_object_paths = blivet_interface.get_object_paths(pool.disks)
+            return blivet_interface.factory(pool.factory_kwargs(fs_name, size, raid))
+
+        pool.disk_object_paths = blivet_interface.initialize_disks(
+            pool.disks, commit_changes=False
+        )
+        # Later requests must not wipe the disks again.
+        pool.initialized = True
+        return blivet_interface.factory(pool.factory_kwargs(fs_name, size, raid))
+
+    def unqueue_create(self, object_path):
+        """
+        Take back a volume queued by queue_create() whose Commit() failed.
+        Blivet drops both actions if the device was not created yet and
+        removes it with the next Commit() otherwise.
+        """
+        if object_path is not None:
+            blivet_interface.queue_remove_device(object_path, [])
+
+    def queue_resize(self, pool, object_path, fs_name, size, raid=None):
+        """
+        Queue growing an existing volume of pool to size.  The factory
+        adjusts the device it is given instead of creating one.  Meant to
+        run under GroupCommit.
+        :return: object path of the device
+        """
+        logger.info("queue_resize(): pool = %s, name = %s, size = %d", pool.name, fs_name, size)
+        if pool.disk_object_paths is None:
+            pool.disk_object_paths = blivet_interface.get_object_paths(pool.disks)
+        # Object paths do not survive the controller restarting, which
+        # resets blivetd.  Go by name first.
+        object_path = self.find_device(pool, fs_name) or object_path
+        kwargs = pool.factory_kwargs(fs_name, size, raid)
+        kwargs["device"] = object_path
+        return blivet_interface.factory(kwargs)
+
+    def device_names(self, pool, fs_name):
+        """
+        :return: the names blivet may give volume fs_name of pool
+        """
+        # LVs are named <vg>-<lv> by blivet, subvolumes and Stratis
+        # filesystems keep their own name.
+        return ["%s-%s" % (pool.name, fs_name), "%s/%s" % (pool.name, fs_name), fs_name]
+
+    def find_device(self, pool, fs_name):
+        """
+        Look for a volume that an earlier, interrupted request created.
+        :return: its object path, or None
+        """
+        for name in self.device_names(pool, fs_name):
+            object_path = blivet_interface.object_cache.get_object_path_by_name(name)
+            if object_path is not None:
+                return object_path
+        return None
+
+    def container_exists(self, pool):
+        return blivet_interface.object_cache.get_object_path_by_name(pool.name) is not None
+
+    def reconcile(self, pool):
+        """
+        Re-derive pool.initialized from Blivet, e.g. after a failed Commit().
+        """
+        pool.initialized = self.container_exists(pool)
+        logger.info("reconcile(): pool %s initialized = %s", pool.name, pool.initialized)
+
+    def refresh(self):
+        """
+        Re-derive which pools are initialized after a failed Commit(),
+        which may have carried out only part of its actions.
+        """
+        for pool in self.pools():
+            self.reconcile(pool)
@@ -0,0 +1,183 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+from blivet_interface import StorageType
+
+RAID0 = "raid0"
+RAID1 = "raid1"
+RAID5 = "raid5"
+RAID6 = "raid6"
+RAID10 = "raid10"
+
+LEVELS = [RAID0, RAID1, RAID5, RAID6, RAID10]
+
+MIN_DISKS = {RAID0: 2, RAID1: 2, RAID5: 3, RAID6: 4, RAID10: 4}
+PARITY = {RAID5: 1, RAID6: 2}
+
+# What the driver always built before layouts were configurable.
+DEFAULT_LEVELS = {
+    StorageType.DEVICE_TYPE_LVM: RAID1,
+    StorageType.DEVICE_TYPE_MD: RAID1,
+    StorageType.DEVICE_TYPE_BTRFS: RAID0,
+}
+
+MIN_STRIPE_SIZE = 4096
+
+
+def normalize_level(value):
+    level = value if value.startswith("raid") else "raid" + value
+    if level not in LEVELS:
+        raise ValueError("Unsupported raidLevel: %s" % value)
+    return level
+
+
+class RaidLayout:
+    """
+    The RAID level, stripe count and stripe (chunk) size of a StorageClass.
+
+    For LVM it applies to each LV.  For MD it is the level of the array
+    the pool's VG sits on, and for btrfs the data and metadata profile of
+    the pool's filesystem, so all classes sharing those pools must agree.
+    A stripe count or size of 0 leaves the choice to Blivet.
+    """
+
+    def __init__(self, level, stripes=0, stripe_size=0):
+        self.level = level
+        self.stripes = stripes
+        self.stripe_size = stripe_size
+
+    def __eq__(self, other):
+        return isinstance(other, RaidLayout) and self.to_record() == other.to_record()
+
+    def __repr__(self):
+        return "RaidLayout(%s, stripes=%d, stripe_size=%d)" % (
+            self.level,
+            self.stripes,
+            self.stripe_size,
+        )
+
+    @classmethod
+    def default(cls, storage_type):
+        level = DEFAULT_LEVELS.get(storage_type)
+        return cls(level) if level else None
+
+    @classmethod
+    def from_parameters(cls, parameters, storage_type, disks):
+        """
+        :return: the RaidLayout asked for by the raidLevel, stripes and
+                 stripeSize parameters, or None if none is set
+        :raises ValueError: if the layout does not fit the disks or type
+        """
+        level = parameters.get("raidLevel")
+        stripes = parameters.get("stripes")
+        stripe_size = parameters.get("stripeSize")
+        if level is None and stripes is None and stripe_size is None:
+            return None
+
+        if storage_type not in DEFAULT_LEVELS:
+            raise ValueError("raidLevel, stripes and stripeSize need LVM, MD or btrfs")
+
+        try:
+            stripes = int(stripes or 0)
+            stripe_size = int(stripe_size or 0)
+        except ValueError:
+            raise ValueError("stripes and stripeSize must be integers")
+
+        layout = cls(
+            normalize_level(level) if level else DEFAULT_LEVELS[storage_type],
+            stripes,
+            stripe_size,
+        )
+        layout.validate(storage_type, len(disks))
+        return layout
+
+    def validate(self, storage_type, disk_count):
+        if disk_count < MIN_DISKS[self.level]:
+            raise ValueError(
+                "%s needs at least %d disks, the class has %d"
+                % (self.level, MIN_DISKS[self.level], disk_count)
+            )
+
+        if self.stripes:
+            if self.level == RAID1:
+                raise ValueError("raid1 is not striped")
+            if storage_type != StorageType.DEVICE_TYPE_LVM:
+                raise ValueError("stripes can only be chosen for LVM, MD and btrfs stripe over every disk")
+            if self.stripes < 2 or self.stripes > self._max_stripes(disk_count):
+                raise ValueError(
+                    "%s on %d disks takes 2 to %d stripes"
+                    % (self.level, disk_count, self._max_stripes(disk_count))
+                )
+
+        if self.stripe_size:
+            if storage_type == StorageType.DEVICE_TYPE_BTRFS:
+                raise ValueError("btrfs has a fixed stripe size")
+            if self.stripe_size < MIN_STRIPE_SIZE or self.stripe_size & (self.stripe_size - 1):
+                raise ValueError("stripeSize must be a power of two of at least 4096")
+
+    def _max_stripes(self, disk_count):
+        if self.level == RAID10:
+            return disk_count // 2
+        return disk_count - PARITY.get(self.level, 0)
+
+    def geometry(self, storage_type, disk_count):
+        """
+        :return: (copies, stripes, parity) as used by the extent allocator
+        """
+        if self.level == RAID1:
+            # blivet mirrors LVs twice, an MD array and btrfs raid1 mirror
+            # on every disk or pair of disks.
+            if storage_type == StorageType.DEVICE_TYPE_MD:
+                return (disk_count, 1, 0)
+            return (2, 1, 0)
+        stripes = self.stripes or self._max_stripes(disk_count)
+        if self.level == RAID10:
+            return (2, stripes, 0)
+        return (1, stripes, PARITY.get(self.level, 0))
+
+    def factory_kwargs(self, storage_type):
+        """
+        :return: the Factory() arguments that select this layout
+        """
+        if storage_type == StorageType.DEVICE_TYPE_MD:
+            kwargs = {"container_raid_level": self.level}
+            if self.stripe_size:
+                kwargs["chunk_size"] = self.stripe_size
+            return kwargs
+
+        kwargs = {"raid_level": self.level}
+        if storage_type == StorageType.DEVICE_TYPE_BTRFS:
+            kwargs["container_raid_level"] = self.level
+        if self.stripes:
+            kwargs["stripes"] = self.stripes
+        if self.stripe_size:
+            kwargs["stripe_size"] = self.stripe_size
+        return kwargs
+
+    def to_record(self):
+        return {
+            "level": self.level,
+            "stripes": self.stripes,
+            "stripe_size": self.stripe_size,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        if record is None:
+            return None
+        return cls(record["level"], record.get("stripes", 0), record.get("stripe_size", 0))
@@ -45,22 +45,55 @@ from pathlib import Path
 from node import SpringfieldNodeService
 from identity import SpringfieldIdentityService
 from controller import SpringfieldControllerService
-
-
-def run_server(port, addr, nodeid, nodeonly):
+from state_store import DEFAULT_STATE_DIR
+from warm_pool import DEFAULT_REFILL_RATE
+from thin_pool import DEFAULT_EXTEND_THRESHOLD, DEFAULT_EXTEND_PERCENT
+from volume_stats import DEFAULT_SAMPLE_INTERVAL
+
+
+def run_server(
+    port,
+    addr,
+    nodeid,
+    nodeonly,
+    commit_window,
+    state_dir,
+    warm_refill_rate,
+    thin_extend_threshold,
+    thin_extend_percent,
+    stats_interval,
+    workers,
+):
     logger.info("Starting grpc server.  NodeID : %s", nodeid)
 
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    controller = SpringfieldControllerService(nodeid=nodeid)
+    # Every RPC holds one of these threads until it is done, including
+    # the wait for its Blivet actions to be committed.
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers))
+    controller = SpringfieldControllerService(
+        nodeid=nodeid,
+        commit_window=commit_window / 1000.0,
+        state_dir=state_dir,
+        warm_refill_rate=warm_refill_rate,
+        thin_extend_threshold=thin_extend_threshold,
+        thin_extend_percent=thin_extend_percent,
+    )
     csi_pb2_grpc.add_ControllerServicer_to_server(
         controller, server
     )
     csi_pb2_grpc.add_IdentityServicer_to_server(SpringfieldIdentityService(), server)
-    csi_pb2_grpc.add_NodeServicer_to_server(
-        SpringfieldNodeService(nodeid=nodeid), server
+    node = SpringfieldNodeService(
+        nodeid=nodeid,
+        stats_interval=stats_interval,
+        state_dir=state_dir,
     )
+    csi_pb2_grpc.add_NodeServicer_to_server(node, server)
 
-    if not nodeonly:
+    # The controller shares the state directory with the node plugin on
+    # its host but not kubelet's mounts, so only the node plugin may open
+    # and check node.db.
+    if nodeonly:
+        node.setup_node()
+    else:
         controller.setup_controller()
 
     server.add_insecure_port("unix://csi/csi.sock")
@@ -90,6 +123,55 @@ if __name__ == "__main__":
     parser.add_argument(
         "--nodeonly", dest="nodeonly", action=argparse.BooleanOptionalAction
     )
+    parser.add_argument(
+        "--commit-window",
+        dest="commit_window",
+        type=int,
+        help="milliseconds to gather blivet actions before a shared Commit()",
+        default=50,
+    )
+    parser.add_argument(
+        "--state-dir",
+        dest="state_dir",
+        type=str,
+        help="directory holding the driver's persistent state",
+        default=DEFAULT_STATE_DIR,
+    )
+    parser.add_argument(
+        "--warm-refill-rate",
+        dest="warm_refill_rate",
+        type=float,
+        help="warm volumes per second the controller may create in the background",
+        default=DEFAULT_REFILL_RATE,
+    )
+    parser.add_argument(
+        "--thin-extend-threshold",
+        dest="thin_extend_threshold",
+        type=int,
+        help="percent of data or metadata use at which a thin pool is extended",
+        default=DEFAULT_EXTEND_THRESHOLD,
+    )
+    parser.add_argument(
+        "--thin-extend-percent",
+        dest="thin_extend_percent",
+        type=int,
+        help="percent of its size by which a thin pool is extended",
+        default=DEFAULT_EXTEND_PERCENT,
+    )
+    parser.add_argument(
+        "--stats-interval",
+        dest="stats_interval",
+        type=float,
+        help="seconds between samples of the usage of staged volumes",
+        default=DEFAULT_SAMPLE_INTERVAL,
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help="threads serving gRPC requests",
+        default=10,
+    )
 
     args = parser.parse_args()
 
@@ -105,4 +187,16 @@ if __name__ == "__main__":
         logger.info("Running in node mode")
 
     logger.info("node id = %s", nodeid)
-    run_server(port, addr, nodeid, args.nodeonly)
+    run_server(
+        port,
+        addr,
+        nodeid,
+        args.nodeonly,
+        args.commit_window,
+        args.state_dir,
+        args.warm_refill_rate,
+        args.thin_extend_threshold,
+        args.thin_extend_percent,
+        args.stats_interval,
+        args.workers,
+    )
@@ -0,0 +1,282 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import sh
+
+from blivet_interface import StorageType
+
+logger = logging.getLogger("springfield-csi")
+
+SNAPSHOT_PREFIX = "sfsnap"
+
+# Top-level btrfs volumes are mounted here to reach their subvolumes.
+BTRFS_MOUNT_DIR = "/run/springfield-csi/btrfs"
+BTRFS_SNAPSHOT_DIR = ".snapshots"
+
+COW_TYPES = [
+    StorageType.DEVICE_TYPE_LVM_THINP,
+    StorageType.DEVICE_TYPE_BTRFS,
+    StorageType.DEVICE_TYPE_STRATIS,
+]
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def snapshot_name(snapshot_id):
+    """
+    Backend name of a snapshot.  It only depends on the CSI name, so a
+    retried CreateSnapshot finds what an interrupted one created.
+    """
+    return "%s%s" % (SNAPSHOT_PREFIX, hashlib.sha1(snapshot_id.encode()).hexdigest()[:12])
+
+
+class SnapshotMap:
+    def __init__(
+        self,
+        snapshot_id,
+        source_volume_id,
+        name,
+        pool_name,
+        storage_type,
+        size_bytes,
+        device,
+        creation_time=None,
+    ):
+        self.snapshot_id = snapshot_id
+        self.source_volume_id = source_volume_id
+        self.name = name
+        self.pool_name = pool_name
+        self.storage_type = storage_type
+        self.size_bytes = size_bytes
+        self.device = device
+        self.creation_time = creation_time if creation_time is not None else time.time()
+
+    def to_record(self):
+        return {
+            "snapshot_id": self.snapshot_id,
+            "source_volume_id": self.source_volume_id,
+            "name": self.name,
+            "pool_name": self.pool_name,
+            "storage_type": self.storage_type,
+            "size_bytes": self.size_bytes,
+            "device": self.device,
+            "creation_time": self.creation_time,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            record["snapshot_id"],
+            record["source_volume_id"],
+            record["name"],
+            record["pool_name"],
+            record["storage_type"],
+            record["size_bytes"],
+            record["device"],
+            record["creation_time"],
+        )
+
+
+class SnapshotRegistry:
+    """
+    SnapshotMap objects indexed by snapshot_id and by source volume, in
+    creation order, so ListSnapshots for one volume only walks that
+    volume's snapshots.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_id = dict()
+        self._by_source = dict()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def add(self, snapshot):
+        with self._lock:
+            self._by_id[snapshot.snapshot_id] = snapshot
+            self._by_source.setdefault(snapshot.source_volume_id, dict())[
+                snapshot.snapshot_id
+            ] = snapshot
+
+    def remove(self, snapshot_id):
+        """
+        :return: the removed SnapshotMap, or None
+        """
+        with self._lock:
+            snapshot = self._by_id.pop(snapshot_id, None)
+            if snapshot is not None:
+                by_source = self._by_source[snapshot.source_volume_id]
+                del by_source[snapshot_id]
+                if not by_source:
+                    del self._by_source[snapshot.source_volume_id]
+            return snapshot
+
+    def get(self, snapshot_id):
+        return self._by_id.get(snapshot_id)
+
+    def list_by_source(self, source_volume_id):
+        with self._lock:
+            return list(self._by_source.get(source_volume_id, {}).values())
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._by_id.values())
+
+
+def btrfs_top(pool_name, device):
+    """
+    Mount the top-level subvolume of a btrfs pool, once.
+    :return: the mount point
+    """
+    top = os.path.join(BTRFS_MOUNT_DIR, pool_name)
+    if not os.path.ismount(top):
+        os.makedirs(top, exist_ok=True)
+        run_tool(sh.mount, "-o", "subvolid=5", device, top)
+    os.makedirs(os.path.join(top, BTRFS_SNAPSHOT_DIR), exist_ok=True)
+    return top
+
+
+def btrfs_path(pool_name, device, name, snapshot=True):
+    top = btrfs_top(pool_name, device)
+    if snapshot:
+        return os.path.join(top, BTRFS_SNAPSHOT_DIR, name)
+    return os.path.join(top, name)
+
+
+def run_tool(command, *args, **kwargs):
+    """
+    Run an sh command, turning its failure into a SnapshotError.
+    """
+    try:
+        return command(*args, **kwargs)
+    except sh.ErrorReturnCode as e:
+        raise SnapshotError(e.stderr.decode(errors="replace").strip())
+
+
+def cow_exists(storage_type, pool_name, device, name, snapshot=True):
+    """
+    :return: True if the snapshot, or with snapshot=False the CoW clone,
+             `name` exists in pool_name
+    """
+    if storage_type == StorageType.DEVICE_TYPE_LVM_THINP:
+        try:
+            sh.lvs("%s/%s" % (pool_name, name))
+        except sh.ErrorReturnCode:
+            return False
+        return True
+    if storage_type == StorageType.DEVICE_TYPE_BTRFS:
+        return os.path.isdir(btrfs_path(pool_name, device, name, snapshot))
+    if storage_type == StorageType.DEVICE_TYPE_STRATIS:
+        output = str(run_tool(sh.stratis, "filesystem", "list", pool_name))
+        return any(line.split()[1:2] == [name] for line in output.splitlines()[1:])
+    return False
+
+
+def create_cow_snapshot(storage_type, pool_name, device, source, name):
+    """
+    Snapshot the volume `source` of pool_name as `name` with the backend's
+    copy-on-write primitive.  No data is copied, so this takes the same
+    time whatever the size of the volume.
+    :raises SnapshotError: if the backend has no CoW snapshots or the
+                           command fails
+    """
+    logger.info("create_cow_snapshot(): %s/%s -> %s", pool_name, source, name)
+    if storage_type == StorageType.DEVICE_TYPE_LVM_THINP:
+        # No size makes it a thin snapshot sharing the origin's pool.
+        run_tool(sh.lvcreate, "--snapshot", "--name", name, "%s/%s" % (pool_name, source))
+    elif storage_type == StorageType.DEVICE_TYPE_BTRFS:
+        run_tool(
+            sh.btrfs, "subvolume", "snapshot", "-r",
+            btrfs_path(pool_name, device, source, snapshot=False),
+            btrfs_path(pool_name, device, name),
+        )
+    elif storage_type == StorageType.DEVICE_TYPE_STRATIS:
+        run_tool(sh.stratis, "filesystem", "snapshot", pool_name, source, name)
+    else:
+        raise SnapshotError("Snapshots need a thinp, btrfs or stratis volume")
+
+
+def clone_cow_volume(storage_type, pool_name, device, source, name, from_snapshot):
+    """
+    Create the writable volume `name` sharing all blocks with the volume
+    or snapshot `source` in the same pool.
+    :raises SnapshotError: if the backend has no CoW clones or the command
+                           fails
+    """
+    logger.info("clone_cow_volume(): %s/%s -> %s", pool_name, source, name)
+    if storage_type == StorageType.DEVICE_TYPE_LVM_THINP:
+        # Thin snapshots are skipped at activation by default, a volume
+        # must not be.
+        run_tool(
+            sh.lvcreate, "--snapshot", "--setactivationskip", "n",
+            "--name", name, "%s/%s" % (pool_name, source),
+        )
+        run_tool(sh.lvchange, "--activate", "y", "%s/%s" % (pool_name, name))
+    elif storage_type == StorageType.DEVICE_TYPE_BTRFS:
+        run_tool(
+            sh.btrfs, "subvolume", "snapshot",
+            btrfs_path(pool_name, device, source, snapshot=from_snapshot),
+            btrfs_path(pool_name, device, name, snapshot=False),
+        )
+    elif storage_type == StorageType.DEVICE_TYPE_STRATIS:
+        # Stratis snapshots are ordinary, writable filesystems.
+        run_tool(sh.stratis, "filesystem", "snapshot", pool_name, source, name)
+    else:
+        raise SnapshotError("CoW clones need a thinp, btrfs or stratis volume")
+
+
+def resize_cow_volume(storage_type, pool_name, name, size):
+    """
+    Grow a CoW clone to size.  Only thin LVs have a size of their own,
+    subvolumes and Stratis filesystems share the pool.
+    """
+    if storage_type == StorageType.DEVICE_TYPE_LVM_THINP:
+        run_tool(sh.lvextend, "--size", "%db" % size, "%s/%s" % (pool_name, name))
+
+
+def cow_device(storage_type, pool_name, device, name):
+    """
+    :return: the block device of a snapshot or CoW clone, activating thin
+             snapshots first
+    :raises SnapshotError: for btrfs, whose subvolumes have no device
+    """
+    if storage_type == StorageType.DEVICE_TYPE_LVM_THINP:
+        run_tool(sh.lvchange, "--activate", "y", "--ignoreactivationskip", "%s/%s" % (pool_name, name))
+        return "/dev/%s/%s" % (pool_name, name)
+    if storage_type == StorageType.DEVICE_TYPE_STRATIS:
+        return "/dev/stratis/%s/%s" % (pool_name, name)
+    raise SnapshotError("%s/%s has no block device of its own" % (pool_name, name))
+
+
+def delete_cow(storage_type, pool_name, device, name, snapshot=True):
+    logger.info("delete_cow(): %s/%s", pool_name, name)
+    if storage_type == StorageType.DEVICE_TYPE_LVM_THINP:
+        run_tool(sh.lvremove, "--yes", "%s/%s" % (pool_name, name))
+    elif storage_type == StorageType.DEVICE_TYPE_BTRFS:
+        run_tool(sh.btrfs, "subvolume", "delete", btrfs_path(pool_name, device, name, snapshot))
+    elif storage_type == StorageType.DEVICE_TYPE_STRATIS:
+        run_tool(sh.stratis, "filesystem", "destroy", pool_name, name)
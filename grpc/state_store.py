@@ -0,0 +1,111 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger("springfield-csi")
+
+DEFAULT_STATE_DIR = "/var/lib/springfield-csi"
+
+VOLUMES = "volumes"
+POOLS = "pools"
+INTENTS = "intents"
+WARM = "warm"
+SNAPSHOTS = "snapshots"
+
+TABLES = [VOLUMES, POOLS, INTENTS, WARM, SNAPSHOTS]
+
+# The node plugin's own database.
+NODE_VOLUMES = "node_volumes"
+
+NODE_TABLES = [NODE_VOLUMES]
+
+
+class StateStore:
+    """
+    Durable key/record store on SQLite in WAL mode.
+
+    Every table maps a text key to a JSON record.  Each put() and delete()
+    is its own transaction, so a crash leaves either the old or the new
+    record.  load() reads a whole table with one query.
+    """
+
+    def __init__(self, path, tables=TABLES):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only loses the last transactions on power loss,
+        # never on a process crash, and the database stays consistent.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+        self.tables = list(tables)
+        for table in self.tables:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+                % table
+            )
+        logger.info("StateStore: opened %s", path)
+
+    def _check(self, table):
+        if table not in self.tables:
+            raise KeyError("Unknown table: %s" % table)
+
+    def put(self, table, key, record):
+        self._check(table)
+        value = json.dumps(record)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)" % table,
+                (key, value),
+            )
+
+    def delete(self, table, key):
+        self._check(table)
+        with self._lock:
+            self._conn.execute("DELETE FROM %s WHERE key = ?" % table, (key,))
+
+    def get(self, table, key):
+        self._check(table)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM %s WHERE key = ?" % table, (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load(self, table):
+        """
+        :return: dict of key to record for the whole table
+        """
+        self._check(table)
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM %s" % table).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
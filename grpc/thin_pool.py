@@ -0,0 +1,144 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import json
+import logging
+import threading
+
+import sh
+
+logger = logging.getLogger("springfield-csi")
+
+# Name of the thin pool LV inside a thinp pool's VG.
+THIN_POOL_LV = "thinpool"
+
+DEFAULT_OVERCOMMIT = 1.0
+DEFAULT_MONITOR_INTERVAL = 10
+# Extend a thin pool once its data or metadata is this full (percent) ...
+DEFAULT_EXTEND_THRESHOLD = 80
+# ... by this much of its current size (percent).
+DEFAULT_EXTEND_PERCENT = 20
+
+
+def _report(command, *args):
+    output = command("--reportformat", "json", "--units", "b", "--nosuffix", *args)
+    report = json.loads(str(output))["report"][0]
+    return report
+
+
+def thin_pool_usage(vg_name, lv_name=THIN_POOL_LV):
+    """
+    :return: dict with lv_size, data_percent, lv_metadata_size and
+             metadata_percent of the thin pool, or None if it does not exist
+    """
+    try:
+        report = _report(
+            sh.lvs,
+            "-o",
+            "lv_size,data_percent,lv_metadata_size,metadata_percent",
+            "%s/%s" % (vg_name, lv_name),
+        )
+    except sh.ErrorReturnCode:
+        return None
+
+    if not report["lv"]:
+        return None
+    lv = report["lv"][0]
+    return {
+        "lv_size": int(lv["lv_size"]),
+        "data_percent": float(lv["data_percent"] or 0),
+        "lv_metadata_size": int(lv["lv_metadata_size"] or 0),
+        "metadata_percent": float(lv["metadata_percent"] or 0),
+    }
+
+
+def vg_free(vg_name):
+    report = _report(sh.vgs, "-o", "vg_free,vg_extent_size", vg_name)
+    vg = report["vg"][0]
+    return int(vg["vg_free"]), int(vg["vg_extent_size"])
+
+
+class ThinPoolMonitor:
+    """
+    Watches the thin pools of thinp StoragePools and grows them into the
+    free space of their VG before they fill up.  A full thin pool stalls
+    every volume in it, so data and metadata are both checked.
+
+    `thin_pools` is called every `interval` seconds and returns the VG
+    names to check.
+    """
+
+    def __init__(
+        self,
+        thin_pools,
+        interval=DEFAULT_MONITOR_INTERVAL,
+        threshold=DEFAULT_EXTEND_THRESHOLD,
+        extend_percent=DEFAULT_EXTEND_PERCENT,
+    ):
+        self.thin_pools = thin_pools
+        self.interval = interval
+        self.threshold = threshold
+        self.extend_percent = extend_percent
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _grow(self, vg_name, current, option):
+        free, extent_size = vg_free(vg_name)
+        grow = max(current * self.extend_percent // 100, extent_size)
+        grow = min(grow, free) // extent_size * extent_size
+        if grow == 0:
+            logger.error("thin pool %s/%s is filling up and its VG is full", vg_name, THIN_POOL_LV)
+            return False
+
+        logger.info("extending %s of %s/%s by %d bytes", option, vg_name, THIN_POOL_LV, grow)
+        sh.lvextend(option, "+%db" % grow, "%s/%s" % (vg_name, THIN_POOL_LV))
+        return True
+
+    def check(self, vg_name):
+        """
+        Extend one thin pool if it is over the threshold.
+        :return: True if it was extended
+        """
+        usage = thin_pool_usage(vg_name)
+        if usage is None:
+            return False
+
+        extended = False
+        if usage["metadata_percent"] >= self.threshold:
+            extended |= self._grow(vg_name, usage["lv_metadata_size"], "--poolmetadatasize")
+        if usage["data_percent"] >= self.threshold:
+            extended |= self._grow(vg_name, usage["lv_size"], "--size")
+        return extended
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(self.interval):
+                for vg_name in self.thin_pools():
+                    try:
+                        self.check(vg_name)
+                    except Exception as e:
+                        logger.error("thin pool monitor: %s: %s", vg_name, e)
+
+        self._thread = threading.Thread(target=run, name="thin-pool-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,112 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import threading
+
+LOCK_STRIPES = 64
+
+
+def volume_node(volume_map):
+    for topology in volume_map.csi_volume.accessible_topology:
+        node = topology.segments.get("hostname")
+        if node:
+            return node
+    return None
+
+
+class VolumeRegistry:
+    """
+    The controller's VolumeMap objects, indexed by volume_id, short name,
+    block path and node.
+
+    Lookups are single dict reads and take no lock.  Adds and removes
+    update all indexes under one lock, and snapshot() returns a consistent
+    list in creation order to iterate over.  volume_lock() hands out one
+    of a fixed set of striped locks for callers that need to serialize
+    work on a single volume.
+    """
+
+    def __init__(self, stripes=LOCK_STRIPES):
+        self._lock = threading.Lock()
+        self._by_id = dict()
+        self._by_short_name = dict()
+        self._by_block_path = dict()
+        self._by_node = dict()
+        self._volume_locks = [threading.Lock() for _ in range(stripes)]
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def volume_lock(self, volume_id):
+        return self._volume_locks[hash(volume_id) % len(self._volume_locks)]
+
+    def add(self, volume_map):
+        volume_id = volume_map.csi_volume.volume_id
+        with self._lock:
+            old = self._by_id.get(volume_id)
+            if old is not None:
+                self._unindex(old)
+            self._by_id[volume_id] = volume_map
+            if volume_map.short_name:
+                self._by_short_name[volume_map.short_name] = volume_map
+            if volume_map.block_path:
+                self._by_block_path[volume_map.block_path] = volume_map
+            node = volume_node(volume_map)
+            if node:
+                self._by_node.setdefault(node, dict())[volume_id] = volume_map
+
+    def _unindex(self, volume_map):
+        volume_id = volume_map.csi_volume.volume_id
+        self._by_id.pop(volume_id, None)
+        if self._by_short_name.get(volume_map.short_name) is volume_map:
+            del self._by_short_name[volume_map.short_name]
+        if self._by_block_path.get(volume_map.block_path) is volume_map:
+            del self._by_block_path[volume_map.block_path]
+        node = volume_node(volume_map)
+        if node in self._by_node:
+            self._by_node[node].pop(volume_id, None)
+            if not self._by_node[node]:
+                del self._by_node[node]
+
+    def remove(self, volume_id):
+        """
+        :return: the removed VolumeMap, or None
+        """
+        with self._lock:
+            volume_map = self._by_id.get(volume_id)
+            if volume_map is not None:
+                self._unindex(volume_map)
+            return volume_map
+
+    def get(self, volume_id):
+        return self._by_id.get(volume_id)
+
+    def get_by_short_name(self, short_name):
+        return self._by_short_name.get(short_name)
+
+    def get_by_block_path(self, block_path):
+        return self._by_block_path.get(block_path)
+
+    def list_by_node(self, node):
+        with self._lock:
+            return list(self._by_node.get(node, {}).values())
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._by_id.values())
@@ -0,0 +1,194 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("springfield-csi")
+
+DEFAULT_SAMPLE_INTERVAL = 15
+SECTOR_SIZE = 512
+
+
+class VolumeSample:
+    """
+    The latest usage and I/O counters of one staged volume.  `error` is
+    set instead when the volume could not be sampled.
+    """
+
+    __slots__ = [
+        "time",
+        "bytes_total",
+        "bytes_available",
+        "bytes_used",
+        "inodes_total",
+        "inodes_free",
+        "inodes_used",
+        "read_bytes",
+        "write_bytes",
+        "in_flight",
+        "error",
+    ]
+
+    def __init__(self):
+        self.time = 0.0
+        self.bytes_total = self.bytes_available = self.bytes_used = 0
+        self.inodes_total = self.inodes_free = self.inodes_used = 0
+        self.read_bytes = self.write_bytes = self.in_flight = 0
+        self.error = None
+
+
+def read_block_stat(rdev):
+    """
+    :return: (bytes read, bytes written, I/Os in flight) of a block device
+             since boot, from its sysfs stat file
+    """
+    with open("/sys/dev/block/%d:%d/stat" % (os.major(rdev), os.minor(rdev))) as f:
+        fields = f.read().split()
+    return (
+        int(fields[2]) * SECTOR_SIZE,
+        int(fields[6]) * SECTOR_SIZE,
+        int(fields[8]),
+    )
+
+
+def read_block_size(rdev):
+    with open("/sys/dev/block/%d:%d/size" % (os.major(rdev), os.minor(rdev))) as f:
+        return int(f.read()) * SECTOR_SIZE
+
+
+def sample_volume(path, rdev):
+    """
+    Take a VolumeSample of the filesystem mounted on path, on device rdev,
+    or with path None of the raw block device rdev.
+    """
+    sample = VolumeSample()
+    sample.time = time.monotonic()
+    if path is None:
+        try:
+            sample.bytes_total = read_block_size(rdev)
+            sample.read_bytes, sample.write_bytes, sample.in_flight = read_block_stat(rdev)
+        except (OSError, ValueError, IndexError) as e:
+            sample.error = "block device %d:%d: %s" % (os.major(rdev), os.minor(rdev), e)
+        return sample
+
+    try:
+        st = os.statvfs(path)
+    except OSError as e:
+        sample.error = "statvfs %s: %s" % (path, e.strerror)
+        return sample
+
+    sample.bytes_total = st.f_blocks * st.f_frsize
+    sample.bytes_available = st.f_bavail * st.f_frsize
+    sample.bytes_used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    sample.inodes_total = st.f_files
+    sample.inodes_free = st.f_ffree
+    sample.inodes_used = st.f_files - st.f_ffree
+
+    if rdev:
+        try:
+            sample.read_bytes, sample.write_bytes, sample.in_flight = read_block_stat(rdev)
+        except (OSError, ValueError, IndexError) as e:
+            # btrfs and Stratis volumes have no block device of their own.
+            logger.debug("sample_volume(): no block stats for %s: %s", path, e)
+    return sample
+
+
+class StatsSampler:
+    """
+    Samples every staged volume in the background, so NodeGetVolumeStats
+    only reads the latest VolumeSample.
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        # volume id -> (path, device)
+        self._volumes = dict()
+        self._samples = dict()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def track(self, volume_id, path, rdev):
+        """
+        Start sampling volume_id, mounted on path from device rdev.  A
+        raw block volume has no path.
+        """
+        with self._lock:
+            self._volumes[volume_id] = (path, rdev)
+
+    def untrack(self, volume_id):
+        with self._lock:
+            self._volumes.pop(volume_id, None)
+            self._samples.pop(volume_id, None)
+
+    def tracked(self, volume_id):
+        """
+        :return: (path, device) of a tracked volume, or None
+        """
+        with self._lock:
+            return self._volumes.get(volume_id)
+
+    def get(self, volume_id):
+        """
+        :return: the latest VolumeSample of volume_id, or None
+        """
+        with self._lock:
+            return self._samples.get(volume_id)
+
+    def sample(self, volume_id):
+        """
+        Sample one volume now.
+        :return: the new VolumeSample, or None if it is not tracked
+        """
+        volume = self.tracked(volume_id)
+        if volume is None:
+            return None
+        sample = sample_volume(*volume)
+        with self._lock:
+            # It may have been unstaged meanwhile.
+            if volume_id in self._volumes:
+                self._samples[volume_id] = sample
+        return sample
+
+    def sample_all(self):
+        with self._lock:
+            volume_ids = list(self._volumes)
+        for volume_id in volume_ids:
+            self.sample(volume_id)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                try:
+                    self.sample_all()
+                except Exception as e:
+                    logger.error("stats sampler: %s", e)
+                if self._stop.wait(self.interval):
+                    break
+
+        self._thread = threading.Thread(target=run, name="stats-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
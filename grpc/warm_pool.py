@@ -0,0 +1,251 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+import collections
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger("springfield-csi")
+
+WARM_PREFIX = "warm"
+
+# Volumes per second the filler may create, across all pools.
+DEFAULT_REFILL_RATE = 0.2
+DEFAULT_REFILL_BURST = 4
+
+
+def warm_name():
+    return "%s%s" % (WARM_PREFIX, uuid.uuid4().hex[:8])
+
+
+class WarmVolume:
+    """
+    A formatted volume created ahead of time, waiting for CreateVolume to
+    claim it.  `size` is the class size it was made for, `capacity` what
+    the allocator actually reserved and `mkfs` the geometry it was
+    formatted with.
+    """
+
+    def __init__(self, name, pool_name, size, capacity, object_path, block_path, mkfs=None):
+        self.name = name
+        self.pool_name = pool_name
+        self.size = size
+        self.capacity = capacity
+        self.object_path = object_path
+        self.block_path = block_path
+        self.mkfs = mkfs or dict()
+
+    def to_record(self):
+        return {
+            "name": self.name,
+            "pool_name": self.pool_name,
+            "size": self.size,
+            "capacity": self.capacity,
+            "object_path": self.object_path,
+            "block_path": self.block_path,
+            "mkfs": self.mkfs,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            record["name"],
+            record["pool_name"],
+            record["size"],
+            record["capacity"],
+            record.get("object_path"),
+            record["block_path"],
+            record.get("mkfs"),
+        )
+
+
+class WarmPool:
+    """
+    Ready volumes per pool and size, kept topped up by a background filler.
+
+    configure() sets how many volumes of which sizes a pool should have
+    ready; it is called from CreateVolume with the StorageClass's
+    parameters, and at start-up with the targets saved by target().  claim() pops one in O(1).  The filler calls `fill(pool,
+    size)` for every missing volume, no faster than `refill_rate` volumes
+    per second with bursts of up to `burst`.
+    """
+
+    def __init__(self, refill_rate=DEFAULT_REFILL_RATE, burst=DEFAULT_REFILL_BURST):
+        self.refill_rate = refill_rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._targets = dict()
+        self._ready = collections.defaultdict(collections.deque)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.fill_failures = 0
+
+    def configure(self, pool, sizes, count):
+        """
+        :return: True if the pool's target changed
+        """
+        with self._lock:
+            target = (pool, tuple(sorted(sizes)), count)
+            if self._targets.get(pool.name, (None, None, None))[1:] == target[1:]:
+                return False
+            self._targets[pool.name] = target
+        logger.info("warm pool %s: %d volumes each of %s", pool.name, count, sizes)
+        self._wake.set()
+        return True
+
+    def target(self, pool_name):
+        """
+        :return: {"sizes": ..., "count": ...} as configured for pool_name,
+                 or None
+        """
+        with self._lock:
+            target = self._targets.get(pool_name)
+        if target is None:
+            return None
+        return {"sizes": list(target[1]), "count": target[2]}
+
+    def add(self, warm):
+        with self._lock:
+            self._ready[(warm.pool_name, warm.size)].append(warm)
+
+    def claim(self, pool_name, required, limit=0):
+        """
+        Take a ready volume of the smallest configured size that covers
+        `required` without going over `limit`.
+        :return: a WarmVolume, or None on a miss
+        """
+        with self._lock:
+            target = self._targets.get(pool_name)
+            warm = None
+            if target is not None:
+                # Sizes are sorted, so is what they round up to.
+                for size in target[1]:
+                    if size < required:
+                        continue
+                    if limit and size > limit:
+                        break
+                    ready = self._ready.get((pool_name, size))
+                    if not ready:
+                        continue
+                    if not limit or ready[0].capacity <= limit:
+                        warm = ready.popleft()
+                    break
+
+            if warm is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            hits, misses = self.hits, self.misses
+
+        logger.info(
+            "warm pool %s: %s for %d bytes (hits %d, misses %d)",
+            pool_name, "hit" if warm else "miss", required, hits, misses,
+        )
+        if warm is not None:
+            self._wake.set()
+        return warm
+
+    def ready(self, pool_name=None):
+        with self._lock:
+            return [
+                warm
+                for (name, _), ready in self._ready.items()
+                if pool_name is None or name == pool_name
+                for warm in ready
+            ]
+
+    def remove(self, name):
+        with self._lock:
+            for ready in self._ready.values():
+                for warm in ready:
+                    if warm.name == name:
+                        ready.remove(warm)
+                        return warm
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "fills": self.fills,
+                "fill_failures": self.fill_failures,
+                "ready": sum(len(ready) for ready in self._ready.values()),
+            }
+
+    def _deficits(self):
+        with self._lock:
+            return [
+                (pool, size)
+                for pool, sizes, count in self._targets.values()
+                for size in sizes
+                for _ in range(count - len(self._ready.get((pool.name, size), ())))
+            ]
+
+    def start_filler(self, fill):
+        if self._thread is not None or self.refill_rate <= 0:
+            return
+
+        def run():
+            tokens = float(self.burst)
+            last = time.monotonic()
+
+            while not self._stop.is_set():
+                deficits = self._deficits()
+                if not deficits:
+                    self._wake.wait()
+                    self._wake.clear()
+                    continue
+
+                for pool, size in deficits:
+                    now = time.monotonic()
+                    tokens = min(self.burst, tokens + (now - last) * self.refill_rate)
+                    last = now
+                    if tokens < 1:
+                        if self._stop.wait((1 - tokens) / self.refill_rate):
+                            return
+                        continue
+                    tokens -= 1
+
+                    try:
+                        warm = fill(pool, size)
+                    except Exception as e:
+                        logger.error("warm pool %s: fill failed: %s", pool.name, e)
+                        with self._lock:
+                            self.fill_failures += 1
+                        # Back off so a full pool does not spin.
+                        if self._stop.wait(1 / self.refill_rate):
+                            return
+                        break
+
+                    self.add(warm)
+                    with self._lock:
+                        self.fills += 1
+
+        self._thread = threading.Thread(target=run, name="warm-pool-filler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
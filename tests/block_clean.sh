@@ -0,0 +1,7 @@
+#!/bin/bash -x
+
+export KUBECTL=../bin/kubectl
+
+$KUBECTL delete pod springfield-pvc-block-test
+
+$KUBECTL delete pvc springfield-block-pvc-claim
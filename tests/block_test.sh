@@ -0,0 +1,11 @@
+#!/bin/bash -x
+
+export KUBECTL=../bin/kubectl
+$KUBECTL apply -f ./block_test.yaml
+
+$KUBECTL wait --for=condition=Ready pod/springfield-pvc-block-test --timeout=300s
+
+# The pod gets the device itself, with no filesystem on it.
+$KUBECTL exec springfield-pvc-block-test -- test -b /dev/springfield-volume
+$KUBECTL exec springfield-pvc-block-test -- sh -c 'echo springfield | dd of=/dev/springfield-volume conv=fsync'
+test "$($KUBECTL exec springfield-pvc-block-test -- head -c 11 /dev/springfield-volume)" = springfield
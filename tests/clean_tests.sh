@@ -6,9 +6,15 @@ $KUBECTL delete pod springfield-pvc-lvm-test
 $KUBECTL delete pod springfield-pvc-btrfs-test
 $KUBECTL delete pod springfield-pvc-md-test
 $KUBECTL delete pod springfield-pvc-stratis-test
+$KUBECTL delete pod springfield-pvc-thinp-test
 
 $KUBECTL delete pvc springfield-pvc-lvm-claim
 $KUBECTL delete pvc springfield-pvc-btrfs-claim
 $KUBECTL delete pvc springfield-pvc-md-claim
 $KUBECTL delete pvc springfield-pvc-stratis-claim
+$KUBECTL delete pvc springfield-thinp-pvc-claim
 
+./snapshot_clean.sh
+./clone_clean.sh
+./expand_clean.sh
+./block_clean.sh
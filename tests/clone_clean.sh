@@ -0,0 +1,13 @@
+#!/bin/bash -x
+
+export KUBECTL=../bin/kubectl
+
+for type in lvm btrfs; do
+    $KUBECTL delete pod springfield-pvc-clone-$type
+    $KUBECTL delete pod springfield-pvc-clone-$type-source
+done
+
+for type in lvm btrfs; do
+    $KUBECTL delete pvc springfield-clone-$type-claim
+    $KUBECTL delete pvc springfield-clone-$type-source-claim
+done
@@ -0,0 +1,17 @@
+#!/bin/bash -x
+
+export KUBECTL=../bin/kubectl
+$KUBECTL apply -f ./clone_test.yaml
+
+# LVM clones are block copies, btrfs clones are subvolume snapshots.
+for type in lvm btrfs; do
+    $KUBECTL wait --for=condition=Ready pod/springfield-pvc-clone-$type-source --timeout=300s
+    $KUBECTL exec springfield-pvc-clone-$type-source -- sh -c "echo $type > /springfield-volume/data && sync"
+done
+
+$KUBECTL apply -f ./clone_copy.yaml
+
+for type in lvm btrfs; do
+    $KUBECTL wait --for=condition=Ready pod/springfield-pvc-clone-$type --timeout=300s
+    test "$($KUBECTL exec springfield-pvc-clone-$type -- cat /springfield-volume/data)" = $type
+done
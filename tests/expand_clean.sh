@@ -0,0 +1,7 @@
+#!/bin/bash -x
+
+export KUBECTL=../bin/kubectl
+
+$KUBECTL delete pod springfield-pvc-expand-test
+
+$KUBECTL delete pvc springfield-expand-pvc-claim
@@ -0,0 +1,12 @@
+#!/bin/bash -x
+
+export KUBECTL=../bin/kubectl
+$KUBECTL apply -f ./expand_test.yaml
+
+$KUBECTL wait --for=condition=Ready pod/springfield-pvc-expand-test --timeout=300s
+
+# Grow the claim while it is mounted, the filesystem must follow.
+$KUBECTL patch pvc springfield-expand-pvc-claim --type merge -p '{"spec":{"resources":{"requests":{"storage":"2Gi"}}}}'
+$KUBECTL wait --for=jsonpath='{.status.capacity.storage}'=2Gi pvc/springfield-expand-pvc-claim --timeout=300s
+size=$($KUBECTL exec springfield-pvc-expand-test -- df -k /springfield-volume | awk 'NR == 2 { print $2 }')
+test "$size" -gt $((1024 * 1024))
@@ -0,0 +1,11 @@
+#!/bin/bash -x
+
+export KUBECTL=../bin/kubectl
+
+$KUBECTL delete pod springfield-pvc-snapshot-restore
+$KUBECTL delete pod springfield-pvc-snapshot-source
+
+$KUBECTL delete pvc springfield-snapshot-restore-claim
+$KUBECTL delete volumesnapshot springfield-snapshot
+$KUBECTL delete pvc springfield-snapshot-source-claim
+$KUBECTL delete volumesnapshotclass springfield-csi-snapclass
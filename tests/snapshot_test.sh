@@ -0,0 +1,15 @@
+#!/bin/bash -x
+
+export KUBECTL=../bin/kubectl
+$KUBECTL apply -f ./snapshot_test.yaml
+
+$KUBECTL wait --for=condition=Ready pod/springfield-pvc-snapshot-source --timeout=300s
+$KUBECTL exec springfield-pvc-snapshot-source -- sh -c 'echo before > /springfield-volume/data && sync'
+
+# Snapshot, then change the source: the restored volume must see the old data.
+$KUBECTL apply -f ./snapshot_restore.yaml
+$KUBECTL wait --for=jsonpath='{.status.readyToUse}'=true volumesnapshot/springfield-snapshot --timeout=300s
+$KUBECTL exec springfield-pvc-snapshot-source -- sh -c 'echo after > /springfield-volume/data && sync'
+
+$KUBECTL wait --for=condition=Ready pod/springfield-pvc-snapshot-restore --timeout=300s
+test "$($KUBECTL exec springfield-pvc-snapshot-restore -- cat /springfield-volume/data)" = before
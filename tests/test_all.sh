@@ -3,4 +3,9 @@
 ./lvm_test.sh
 ./stratis_test.sh
 ./md_test.sh
+./thinp_test.sh
+./snapshot_test.sh
+./clone_test.sh
+./expand_test.sh
+./block_test.sh
 
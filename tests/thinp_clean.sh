@@ -0,0 +1,7 @@
+#!/bin/bash -x
+
+export KUBECTL=../bin/kubectl
+
+$KUBECTL delete pod springfield-pvc-thinp-test
+
+$KUBECTL delete pvc springfield-thinp-pvc-claim
@@ -0,0 +1,9 @@
+#!/bin/bash -x
+
+export KUBECTL=../bin/kubectl
+$KUBECTL apply -f ./thinp_test.yaml
+
+# The volume is thin, writing to it must still work.
+$KUBECTL wait --for=condition=Ready pod/springfield-pvc-thinp-test --timeout=300s
+$KUBECTL exec springfield-pvc-thinp-test -- dd if=/dev/urandom of=/springfield-volume/data bs=1M count=64
+$KUBECTL exec springfield-pvc-thinp-test -- df -h /springfield-volume
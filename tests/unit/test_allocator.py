@@ -0,0 +1,150 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import pytest
+
+from allocator import (
+    AllocationError,
+    BEST_FIT,
+    DISK_RESERVE,
+    EXTENT_SIZE,
+    SPREAD,
+    ExtentAllocator,
+)
+
+GiB = 1024 * 1024 * 1024
+DISK = GiB + DISK_RESERVE
+EXTENTS = GiB // EXTENT_SIZE
+
+
+def allocator(*sizes, overcommit=None):
+    alloc = ExtentAllocator()
+    disks = {"/dev/sd%s" % chr(ord("b") + i): size for i, size in enumerate(sizes)}
+    alloc.add_pool("pool", disks, overcommit=overcommit)
+    return alloc
+
+
+def test_sizes_round_up_to_extents():
+    alloc = allocator(DISK)
+    assert alloc.allocate("pool", "a", 1) == EXTENT_SIZE
+    assert alloc.allocate("pool", "b", EXTENT_SIZE + 1) == 2 * EXTENT_SIZE
+    assert alloc.capacity("pool") == (GiB, GiB - 3 * EXTENT_SIZE)
+
+
+def test_stripes_round_to_whole_extents_per_stripe():
+    alloc = allocator(DISK, DISK)
+    assert alloc.allocate("pool", "a", EXTENT_SIZE, stripes=2) == 2 * EXTENT_SIZE
+    assert alloc.placement("pool", "a") == ["/dev/sdb", "/dev/sdc"]
+
+
+def test_full_pool_raises():
+    alloc = allocator(DISK)
+    alloc.allocate("pool", "a", GiB)
+    with pytest.raises(AllocationError):
+        alloc.allocate("pool", "b", 1)
+
+
+def test_duplicate_volume_raises():
+    alloc = allocator(DISK)
+    alloc.allocate("pool", "a", 1)
+    with pytest.raises(AllocationError):
+        alloc.allocate("pool", "a", 1)
+
+
+def test_mirror_needs_distinct_disks():
+    alloc = allocator(DISK)
+    with pytest.raises(AllocationError):
+        alloc.allocate("pool", "a", EXTENT_SIZE, copies=2)
+
+
+def test_best_fit_and_spread_pick_different_disks():
+    alloc = allocator(DISK, 2 * GiB + DISK_RESERVE)
+    alloc.allocate("pool", "small", 1, policy=BEST_FIT)
+    alloc.allocate("pool", "wide", 1, policy=SPREAD)
+    assert alloc.placement("pool", "small") == ["/dev/sdb"]
+    assert alloc.placement("pool", "wide") == ["/dev/sdc"]
+
+
+def test_free_merges_runs():
+    alloc = allocator(DISK)
+    for name in "abc":
+        alloc.allocate("pool", name, EXTENT_SIZE)
+    alloc.free("pool", "b")
+    assert alloc.fragmentation("pool") > 0
+    alloc.free("pool", "a")
+    alloc.free("pool", "c")
+    assert alloc.fragmentation("pool") == 0.0
+    assert alloc.capacity("pool") == (GiB, GiB)
+
+
+def test_resize_prefers_the_volumes_disks():
+    alloc = allocator(DISK, DISK)
+    alloc.allocate("pool", "a", EXTENT_SIZE)
+    disks = alloc.placement("pool", "a")
+    assert alloc.resize("pool", "a", 3 * EXTENT_SIZE) == 3 * EXTENT_SIZE
+    assert alloc.placement("pool", "a") == disks
+    # Shrinking is a no-op.
+    assert alloc.resize("pool", "a", EXTENT_SIZE) == 3 * EXTENT_SIZE
+
+
+def test_resize_unknown_volume_raises():
+    alloc = allocator(DISK)
+    with pytest.raises(AllocationError):
+        alloc.resize("pool", "a", EXTENT_SIZE)
+
+
+def test_restore_reapplies_an_allocation():
+    alloc = allocator(DISK, DISK)
+    alloc.allocate("pool", "a", 5 * EXTENT_SIZE, copies=2)
+    saved = alloc.get_allocation("pool", "a")
+
+    restored = allocator(DISK, DISK)
+    restored.restore("pool", "a", *saved)
+    assert restored.capacity("pool") == alloc.capacity("pool")
+    assert restored.placement("pool", "a") == alloc.placement("pool", "a")
+    # The restored extents are taken.
+    with pytest.raises(AllocationError):
+        restored.restore("pool", "b", *saved)
+
+
+def test_rename_moves_the_allocation():
+    alloc = allocator(DISK)
+    alloc.allocate("pool", "warm", EXTENT_SIZE)
+    alloc.rename("pool", "warm", "pvc")
+    assert alloc.get_allocation("pool", "warm") is None
+    assert alloc.get_allocation("pool", "pvc")[0] == EXTENT_SIZE
+
+
+def test_thin_pool_overcommits_without_extents():
+    alloc = allocator(DISK, overcommit=2.0)
+    assert alloc.allocate("pool", "a", GiB) == GiB
+    assert alloc.allocate("pool", "b", GiB) == GiB
+    assert alloc.get_allocation("pool", "a") == (GiB, [])
+    with pytest.raises(AllocationError):
+        alloc.allocate("pool", "c", 1)
+    alloc.free("pool", "b")
+    assert alloc.capacity("pool") == (2 * GiB, GiB)
+
+
+def test_usable_accounts_for_the_layout():
+    alloc = allocator(DISK, DISK, DISK)
+    free, largest = alloc.usable("pool", copies=2)
+    assert free == 3 * GiB // 2
+    assert largest == GiB
+    assert alloc.usable("pool", copies=4) == (0, 0)
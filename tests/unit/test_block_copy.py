@@ -0,0 +1,89 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import os
+
+import pytest
+
+from block_copy import ALIGNMENT, MiB, ZERO_BLOCK, CopyError, copy_device, zero_runs
+
+
+def image(path, size, holes=()):
+    data = bytearray(os.urandom(size))
+    for start, length in holes:
+        data[start:start + length] = bytes(length)
+    with open(path, "wb") as f:
+        f.write(data)
+    return bytes(data)
+
+
+def target(path, size):
+    with open(path, "wb") as f:
+        f.truncate(size)
+    return str(path)
+
+
+def test_zero_runs():
+    buf = bytearray(os.urandom(4 * ZERO_BLOCK))
+    buf[ZERO_BLOCK:3 * ZERO_BLOCK] = bytes(2 * ZERO_BLOCK)
+    assert zero_runs(memoryview(buf), len(buf)) == [
+        (0, ZERO_BLOCK, False),
+        (ZERO_BLOCK, 2 * ZERO_BLOCK, True),
+        (3 * ZERO_BLOCK, ZERO_BLOCK, False),
+    ]
+    assert zero_runs(memoryview(bytes(100)), 100) == [(0, 100, True)]
+
+
+@pytest.mark.parametrize("direct", [True, False])
+def test_copy_skips_zeroes(tmp_path, direct):
+    size = 6 * MiB
+    data = image(tmp_path / "src", size, holes=[(MiB, 2 * MiB)])
+    dst = target(tmp_path / "dst", size)
+
+    state = copy_device(str(tmp_path / "src"), dst, chunk_size=MiB, workers=3, direct=direct)
+
+    assert open(dst, "rb").read() == data
+    assert state.copied == 4 * MiB
+    assert state.skipped == 2 * MiB
+
+
+@pytest.mark.parametrize("extra", [0, MiB])
+def test_unaligned_image(tmp_path, extra):
+    # The end of the image cannot be written with O_DIRECT as it is.
+    size = 3 * MiB + 123
+    data = image(tmp_path / "src", size)
+    dst = target(tmp_path / "dst", size + extra)
+
+    copy_device(str(tmp_path / "src"), dst, chunk_size=MiB)
+
+    assert open(dst, "rb").read()[:size] == data
+
+
+def test_target_too_small(tmp_path):
+    image(tmp_path / "src", 2 * MiB)
+    dst = target(tmp_path / "dst", MiB)
+    with pytest.raises(CopyError):
+        copy_device(str(tmp_path / "src"), dst)
+
+
+def test_chunk_size_must_be_aligned(tmp_path):
+    image(tmp_path / "src", MiB)
+    dst = target(tmp_path / "dst", MiB)
+    with pytest.raises(CopyError):
+        copy_device(str(tmp_path / "src"), dst, chunk_size=ALIGNMENT + 1)
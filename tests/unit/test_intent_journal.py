@@ -0,0 +1,81 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import pytest
+
+from intent_journal import COMMITTED, CREATE, DELETE, STARTED, IntentJournal
+from state_store import StateStore
+
+
+@pytest.fixture
+def journal(tmp_path):
+    store = StateStore(str(tmp_path / "controller.db"))
+    yield IntentJournal(store)
+    store.close()
+
+
+def test_begin_advance_finish(journal):
+    journal.begin(CREATE, "pvc-1", pool="vg", short_name="pvc")
+    intent = journal.get(CREATE, "pvc-1")
+    assert intent["phase"] == STARTED
+    assert intent["params"] == {"pool": "vg", "short_name": "pvc"}
+    assert intent["started"] > 0
+
+    journal.advance(CREATE, "pvc-1", COMMITTED, object_path="/obj/1")
+    intent = journal.get(CREATE, "pvc-1")
+    assert intent["phase"] == COMMITTED
+    assert intent["params"]["object_path"] == "/obj/1"
+    assert intent["params"]["pool"] == "vg"
+
+    journal.finish(CREATE, "pvc-1")
+    assert journal.get(CREATE, "pvc-1") is None
+    assert journal.pending() == []
+
+
+def test_operations_on_one_name_are_separate(journal):
+    journal.begin(CREATE, "pvc-1")
+    journal.begin(DELETE, "pvc-1")
+    journal.finish(CREATE, "pvc-1")
+    assert [(i["op"], i["name"]) for i in journal.pending()] == [(DELETE, "pvc-1")]
+
+
+def test_advance_without_begin_is_ignored(journal):
+    journal.advance(DELETE, "pvc-1", COMMITTED)
+    assert journal.get(DELETE, "pvc-1") is None
+
+
+def test_pending_survives_a_restart(tmp_path):
+    path = str(tmp_path / "controller.db")
+    store = StateStore(path)
+    IntentJournal(store).begin(CREATE, "pvc-1", pool="vg")
+    store.close()
+
+    store = StateStore(path)
+    pending = IntentJournal(store).pending()
+    store.close()
+    assert [(i["op"], i["name"], i["phase"]) for i in pending] == [(CREATE, "pvc-1", STARTED)]
+
+
+def test_without_a_store_everything_is_a_no_op():
+    journal = IntentJournal()
+    journal.begin(CREATE, "pvc-1")
+    journal.advance(CREATE, "pvc-1", COMMITTED)
+    assert journal.get(CREATE, "pvc-1") is None
+    assert journal.pending() == []
+    journal.finish(CREATE, "pvc-1")
@@ -0,0 +1,114 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import os
+
+import pytest
+
+from mount_table import MountEntry, MountTable
+
+ROOT = "1 0 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw"
+STAGED = "30 1 253:4 / /var/lib/kubelet/staging rw shared:7 - xfs /dev/mapper/vg-pvc rw"
+BIND = "31 1 253:4 / /var/lib/kubelet/pods/a/mount ro - xfs /dev/mapper/vg-pvc rw"
+OVER = "32 30 253:5 / /var/lib/kubelet/staging rw - xfs /dev/mapper/vg-other rw"
+
+
+@pytest.fixture
+def mountinfo(tmp_path):
+    path = tmp_path / "mountinfo"
+
+    def write(*lines):
+        path.write_text("".join(line + "\n" for line in lines))
+        return str(path)
+
+    return write
+
+
+def reload(table, path, *lines):
+    # poll() only reports changes on the real mountinfo.
+    with open(path, "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+    with table._lock:
+        table._reload()
+
+
+def test_parse():
+    entry = MountEntry.parse(
+        r"36 35 98:0 /sub /mnt/with\040space rw,noatime master:1 - btrfs /dev/sdb rw,subvol=/sub"
+    )
+    assert entry.mount_id == 36
+    assert entry.parent_id == 35
+    assert entry.device == (98, 0)
+    assert entry.root == "/sub"
+    assert entry.target == "/mnt/with space"
+    assert entry.fstype == "btrfs"
+    assert entry.source == "/dev/sdb"
+    assert not entry.readonly
+    assert MountEntry.parse(BIND).readonly
+
+
+def test_lookups(mountinfo):
+    table = MountTable(mountinfo(ROOT, STAGED, BIND))
+    try:
+        assert table.get("/var/lib/kubelet/staging/").mount_id == 30
+        assert table.is_mount("/")
+        assert not table.is_mount("/var/lib/kubelet")
+        rdev = os.makedev(253, 4)
+        assert [entry.mount_id for entry in table.by_device(rdev)] == [30, 31]
+    finally:
+        table.close()
+
+
+def test_stacked_mounts_follow_parents(mountinfo):
+    # The covering mount is listed first, as after a remount of the lower one.
+    table = MountTable(mountinfo(ROOT, OVER, STAGED))
+    try:
+        assert [entry.mount_id for entry in table.stacked("/var/lib/kubelet/staging")] == [30, 32]
+        assert table.get("/var/lib/kubelet/staging").source == "/dev/mapper/vg-other"
+    finally:
+        table.close()
+
+
+def test_changes_are_reindexed(mountinfo):
+    path = mountinfo(ROOT, STAGED, OVER)
+    table = MountTable(path)
+    try:
+        # Remounting the lower mount read-only changes its line only.
+        reload(table, path, ROOT, STAGED.replace(" rw shared", " ro shared"), OVER)
+        stacked = table.stacked("/var/lib/kubelet/staging")
+        assert [entry.mount_id for entry in stacked] == [30, 32]
+        assert stacked[0].readonly
+
+        reload(table, path, ROOT, STAGED)
+        assert table.get("/var/lib/kubelet/staging").mount_id == 30
+        assert table.by_device(os.makedev(253, 5)) == []
+
+        reload(table, path, ROOT)
+        assert not table.is_mount("/var/lib/kubelet/staging")
+        assert table.by_device(os.makedev(253, 4)) == []
+    finally:
+        table.close()
+
+
+def test_reads_this_process_mountinfo():
+    table = MountTable()
+    try:
+        assert table.is_mount("/")
+    finally:
+        table.close()
@@ -0,0 +1,50 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import pytest
+
+from node_registry import NodeRegistry
+from state_store import StateStore, NODE_TABLES
+
+
+@pytest.fixture
+def registry(tmp_path):
+    store = StateStore(str(tmp_path / "node.db"), tables=NODE_TABLES)
+    registry = NodeRegistry()
+    registry.open(store)
+    yield registry
+    store.close()
+
+
+def test_claim_allows_one_target(registry):
+    registry.stage("pvc-1", "/dev/vg/pvc", "/staging/pvc-1", "xfs")
+
+    assert registry.claim("pvc-1", "/pods/a/mount")
+    assert registry.claim("pvc-1", "/pods/a/mount")
+    assert not registry.claim("pvc-1", "/pods/b/mount")
+    assert list(registry.get("pvc-1").targets) == ["/pods/a/mount"]
+
+    registry.unpublish("pvc-1", "/pods/a/mount")
+    assert registry.claim("pvc-1", "/pods/b/mount")
+    assert registry.by_path("/pods/b/mount").volume_id == "pvc-1"
+
+
+def test_claim_of_unstaged_volume_is_left_to_publish(registry):
+    assert registry.claim("pvc-2", "/pods/a/mount")
+    assert registry.get("pvc-2") is None
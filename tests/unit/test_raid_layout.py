@@ -0,0 +1,102 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import pytest
+
+# StorageType comes from blivet_interface, which connects to blivetd on
+# the system bus when imported.
+try:
+    from blivet_interface import StorageType
+except Exception as e:
+    pytest.skip("blivet_interface cannot be imported: %s" % e, allow_module_level=True)
+
+from raid_layout import RaidLayout, normalize_level
+
+LVM = StorageType.DEVICE_TYPE_LVM
+MD = StorageType.DEVICE_TYPE_MD
+BTRFS = StorageType.DEVICE_TYPE_BTRFS
+STRATIS = StorageType.DEVICE_TYPE_STRATIS
+
+DISKS = ["/dev/sdb", "/dev/sdc", "/dev/sdd", "/dev/sde"]
+
+
+def test_levels_are_normalized():
+    assert normalize_level("5") == "raid5"
+    assert normalize_level("raid10") == "raid10"
+    with pytest.raises(ValueError):
+        normalize_level("raid3")
+
+
+def test_no_parameters_means_no_layout():
+    assert RaidLayout.from_parameters({}, LVM, DISKS) is None
+
+
+def test_default_level_per_type():
+    assert RaidLayout.from_parameters({"stripeSize": "65536"}, LVM, DISKS).level == "raid1"
+    assert RaidLayout.default(BTRFS).level == "raid0"
+    assert RaidLayout.default(STRATIS) is None
+
+
+def test_layout_must_fit_the_disks():
+    with pytest.raises(ValueError):
+        RaidLayout.from_parameters({"raidLevel": "raid6"}, LVM, DISKS[:3])
+    with pytest.raises(ValueError):
+        RaidLayout.from_parameters({"raidLevel": "raid5", "stripes": "4"}, LVM, DISKS)
+    with pytest.raises(ValueError):
+        RaidLayout.from_parameters({"raidLevel": "raid1", "stripes": "2"}, LVM, DISKS)
+
+
+def test_stripes_only_for_lvm():
+    with pytest.raises(ValueError):
+        RaidLayout.from_parameters({"raidLevel": "raid0", "stripes": "2"}, MD, DISKS)
+    with pytest.raises(ValueError):
+        RaidLayout.from_parameters({"raidLevel": "raid0"}, STRATIS, DISKS)
+
+
+def test_stripe_size_is_a_power_of_two():
+    with pytest.raises(ValueError):
+        RaidLayout.from_parameters({"raidLevel": "raid0", "stripeSize": "6000"}, LVM, DISKS)
+    with pytest.raises(ValueError):
+        RaidLayout.from_parameters({"raidLevel": "raid0", "stripeSize": "65536"}, BTRFS, DISKS)
+
+
+def test_geometry():
+    assert RaidLayout("raid1").geometry(LVM, 4) == (2, 1, 0)
+    assert RaidLayout("raid1").geometry(MD, 4) == (4, 1, 0)
+    assert RaidLayout("raid5").geometry(LVM, 4) == (1, 3, 1)
+    assert RaidLayout("raid10").geometry(LVM, 4) == (2, 2, 0)
+    assert RaidLayout("raid0", stripes=2).geometry(LVM, 4) == (1, 2, 0)
+
+
+def test_factory_kwargs():
+    assert RaidLayout("raid5", stripe_size=65536).factory_kwargs(MD) == {
+        "container_raid_level": "raid5",
+        "chunk_size": 65536,
+    }
+    assert RaidLayout("raid0", stripes=2).factory_kwargs(LVM) == {"raid_level": "raid0", "stripes": 2}
+    assert RaidLayout("raid1").factory_kwargs(BTRFS) == {
+        "raid_level": "raid1",
+        "container_raid_level": "raid1",
+    }
+
+
+def test_record_round_trip():
+    layout = RaidLayout("raid6", stripes=2, stripe_size=131072)
+    assert RaidLayout.from_record(layout.to_record()) == layout
+    assert RaidLayout.from_record(None) is None
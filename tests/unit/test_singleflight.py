@@ -0,0 +1,96 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+from concurrent import futures
+import threading
+
+import logging
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def wait_for_joiners(caplog, count):
+    # Joiners log before they block on the leader's result.
+    for _ in range(500):
+        if sum("joining" in record.getMessage() for record in caplog.records) >= count:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("%d joiners did not arrive" % count)
+
+
+def test_concurrent_callers_share_one_call(caplog):
+    caplog.set_level(logging.INFO, logger="springfield-csi")
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = list()
+
+    def work(value):
+        calls.append(value)
+        started.set()
+        release.wait(5)
+        return value * 2
+
+    with futures.ThreadPoolExecutor(max_workers=4) as pool:
+        leader = pool.submit(flight.do, "key", work, 21)
+        assert started.wait(5)
+        assert flight.in_flight("key")
+        joiners = [pool.submit(flight.do, "key", work, 0) for _ in range(3)]
+        wait_for_joiners(caplog, 3)
+        release.set()
+        results = [leader.result(5)] + [joiner.result(5) for joiner in joiners]
+
+    assert calls == [21]
+    assert results == [42] * 4
+    assert not flight.in_flight("key")
+
+
+def test_exceptions_reach_every_caller(caplog):
+    caplog.set_level(logging.INFO, logger="springfield-csi")
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("boom")
+
+    with futures.ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flight.do, "key", fail)
+        assert started.wait(5)
+        joiner = pool.submit(flight.do, "key", fail)
+        wait_for_joiners(caplog, 1)
+        release.set()
+        for future in [leader, joiner]:
+            with pytest.raises(ValueError):
+                future.result(5)
+
+
+def test_later_calls_run_again():
+    flight = SingleFlight()
+    assert flight.do("key", lambda: 1) == 1
+    assert flight.do("key", lambda: 2) == 2
+
+
+def test_keys_are_independent():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: flight.do("b", lambda: "inner")) == "inner"
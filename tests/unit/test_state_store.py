@@ -0,0 +1,69 @@
+# Copyright (C) 2023  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+# Red Hat Author(s): Todd Gill <tgill@redhat.com>
+#
+
+import os
+
+import pytest
+
+from state_store import NODE_TABLES, NODE_VOLUMES, POOLS, VOLUMES, StateStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = StateStore(str(tmp_path / "state" / "controller.db"))
+    yield store
+    store.close()
+
+
+def test_creates_the_directory(tmp_path, store):
+    assert os.path.exists(store.path)
+
+
+def test_put_get_delete(store):
+    store.put(VOLUMES, "pvc-1", {"size": 1, "disks": ["/dev/sdb"]})
+    assert store.get(VOLUMES, "pvc-1") == {"size": 1, "disks": ["/dev/sdb"]}
+    store.put(VOLUMES, "pvc-1", {"size": 2})
+    assert store.get(VOLUMES, "pvc-1") == {"size": 2}
+    store.delete(VOLUMES, "pvc-1")
+    assert store.get(VOLUMES, "pvc-1") is None
+    # Deleting twice is fine.
+    store.delete(VOLUMES, "pvc-1")
+
+
+def test_tables_are_separate(store):
+    store.put(VOLUMES, "a", {"table": VOLUMES})
+    store.put(POOLS, "a", {"table": POOLS})
+    assert store.load(VOLUMES) == {"a": {"table": VOLUMES}}
+    assert store.load(POOLS) == {"a": {"table": POOLS}}
+
+
+def test_unknown_table(store):
+    with pytest.raises(KeyError):
+        store.put(NODE_VOLUMES, "a", {})
+
+
+def test_survives_reopening(tmp_path):
+    path = str(tmp_path / "node.db")
+    store = StateStore(path, tables=NODE_TABLES)
+    store.put(NODE_VOLUMES, "pvc-1", {"staged": "/staging"})
+    store.close()
+
+    store = StateStore(path, tables=NODE_TABLES)
+    assert store.load(NODE_VOLUMES) == {"pvc-1": {"staged": "/staging"}}
+    store.close()